@@ -0,0 +1,117 @@
+import sys
+
+sys.path.append("..")
+
+import json
+import time
+import argparse
+import platform
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from synthetic import synthetic_corpus
+from bench_models import METRICS, build_model
+
+PHASES = ["moments", "objective_step", "state_update"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Per-time-step cost of continual training of ContinualPSIKT on "
+        "synthetic data, as in VCLRunner.fit: the predictive and posterior moments, the "
+        "objective with its backward pass and optimizer step, and the stored posteriors."
+    )
+    parser.add_argument("--num_learner", type=int, default=256)
+    parser.add_argument("--num_skill", type=int, default=20)
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_sample", type=int, default=10)
+    parser.add_argument(
+        "--warmup", type=int, default=3, help="time steps excluded from the statistics"
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="torch intra-op threads; 0 keeps the default",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--output", type=str, default="bench_continual.json")
+    return parser.parse_args()
+
+
+def train_step(model, batch: dict, idx: int) -> list:
+    """
+    One time step of VCLRunner.fit on a batch, returning the duration of every phase.
+    """
+    start = time.perf_counter()
+    pred_dist, post_dist = model.filtering_step(feed_dict=batch, idx=idx)
+    moments = time.perf_counter()
+
+    output_dict = model.objective_function(
+        batch, idx=idx, pred_dist=pred_dist, post_dist=post_dist
+    )
+    loss_dict = model.loss(batch, output_dict, metrics=METRICS)
+    model.optimizer.zero_grad(set_to_none=True)
+    loss_dict["loss_total"].backward()
+    model.optimizer.step()
+    objective_step = time.perf_counter()
+
+    with torch.no_grad():
+        model.inference_model(feed_dict=batch, idx=idx, update=True, eval=False)
+    state_update = time.perf_counter()
+    return [moments - start, objective_step - moments, state_update - objective_step]
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    if bench_args.num_threads > 0:
+        torch.set_num_threads(bench_args.num_threads)
+    torch.manual_seed(bench_args.random_seed)
+
+    args, logs, corpus = synthetic_corpus(
+        bench_args.num_learner,
+        bench_args.num_skill,
+        bench_args.seq_len,
+        random_seed=bench_args.random_seed,
+        num_sample=bench_args.num_sample,
+    )
+    args.log_path = str(Path(args.save_folder))
+    model = build_model("ContinualPSIKT", args, corpus, logs)
+    model.train()
+    model.optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    batch = model.prepare_batches(
+        corpus, corpus.data_df["whole"], bench_args.batch_size, "whole"
+    )[0]
+    batch = model.batch_to_gpu(batch, args.device)
+
+    times = np.asarray(
+        [train_step(model, batch, idx) for idx in range(batch["time_seq"].shape[1])]
+    )[bench_args.warmup :]
+    times_ms = np.concatenate([times, times.sum(1, keepdims=True)], 1) * 1e3
+
+    results = {
+        phase: {
+            "p50_ms": float(np.percentile(times_ms[:, i], 50)),
+            "mean_ms": float(times_ms[:, i].mean()),
+        }
+        for i, phase in enumerate(PHASES + ["total"])
+    }
+    print(
+        "  ".join(
+            "{} {:.2f} ms".format(phase, result["p50_ms"])
+            for phase, result in results.items()
+        )
+    )
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        num_threads=torch.get_num_threads(),
+        platform=platform.platform(),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
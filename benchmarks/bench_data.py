@@ -0,0 +1,239 @@
+import sys
+
+sys.path.append("..")
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+
+import torch
+
+from synthetic import generate_interactions, write_interactions, default_args
+from bench_models import ALL_MODELS, build_model
+
+from knowledge_tracing.data.data_loader import DataReader
+from knowledge_tracing.utils import logger
+from knowledge_tracing.utils.profiler import peak_rss_mb
+
+# One model per distinct get_feed_dict implementation (PSI-KT, HLR, PPE and GKT share
+# the one of BaseModel)
+DEFAULT_MODELS = ["AmortizedPSIKT", "DKT", "DKTForgetting", "AKT", "HKT", "QIKT"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time and memory benchmark of the corpus and batching pipeline."
+    )
+    parser.add_argument(
+        "--rows",
+        type=str,
+        default="10000,100000,1000000,10000000",
+        help="comma-separated numbers of interactions; every scale runs in a fresh process",
+    )
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--num_skill", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument(
+        "--models",
+        type=str,
+        default=",".join(DEFAULT_MODELS),
+        help="models whose prepare_batches/get_feed_dict are timed, from: "
+        + ", ".join(ALL_MODELS),
+    )
+    parser.add_argument(
+        "--feed_dict_batches",
+        type=int,
+        default=20,
+        help="number of batches get_feed_dict is timed on",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--work_dir", type=str, default="")
+    parser.add_argument("--output", type=str, default="bench_data.json")
+    return parser.parse_args()
+
+
+def current_rss_mb() -> float:
+    """
+    Resident set size of the current process in MB (None if it cannot be queried).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RSSSampler:
+    """
+    Track the peak resident set size while a stage runs, by sampling the current RSS on a
+    background thread. Where the current RSS is not available (e.g. macOS), the process-wide
+    peak of getrusage is reported instead, which only grows over the stages of one process.
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.records = {}
+
+    def _sample(self, stop: threading.Event, peak: list) -> None:
+        while not stop.wait(self.interval):
+            peak[0] = max(peak[0], current_rss_mb())
+
+    @contextmanager
+    def stage(self, name: str):
+        start_rss = current_rss_mb()
+        if start_rss is None:
+            start = time.perf_counter()
+            yield
+            self.records[name] = {
+                "time_s": time.perf_counter() - start,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            self._print(name)
+            return
+
+        peak = [start_rss]
+        stop = threading.Event()
+        thread = threading.Thread(target=self._sample, args=(stop, peak), daemon=True)
+        thread.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stop.set()
+            thread.join()
+            end_rss = current_rss_mb()
+            peak[0] = max(peak[0], end_rss)
+            self.records[name] = {
+                "time_s": elapsed,
+                "peak_rss_mb": peak[0],
+                "peak_increase_mb": peak[0] - start_rss,
+                "retained_mb": end_rss - start_rss,
+            }
+            self._print(name)
+
+    def _print(self, name: str) -> None:
+        record = self.records[name]
+        print(
+            "{:<32s} {:10.3f} s {:10.1f} MB".format(
+                name, record["time_s"], record["peak_rss_mb"]
+            )
+        )
+
+
+def bench_scale(num_rows: int, bench_args: argparse.Namespace) -> dict:
+    """
+    Run the data path once on a synthetic table of num_rows interactions:
+    DataReader (read_csv), create_corpus, load_corpus (which includes the time split),
+    gen_time_split_data alone, and prepare_batches / get_feed_dict of every model.
+    """
+    num_learner = max(num_rows // bench_args.seq_len, 1)
+    work_dir = Path(
+        tempfile.mkdtemp(prefix="psikt_bench_data_", dir=bench_args.work_dir or None)
+    )
+    sampler = RSSSampler()
+
+    try:
+        args = default_args(
+            work_dir,
+            max_step=bench_args.seq_len,
+            random_seed=bench_args.random_seed,
+            batch_size=bench_args.batch_size,
+            num_sample=1,  # only needed to build PSI-KT, not used by the data path
+        )
+        args.log_path = str(Path(args.save_folder))
+        logs = logger.Logger(args)
+
+        with sampler.stage("generate"):
+            inter_df = generate_interactions(
+                num_learner,
+                bench_args.num_skill,
+                bench_args.seq_len,
+                random_seed=bench_args.random_seed,
+            )
+        write_interactions(inter_df, args.data_dir, args.dataset, args.max_step)
+        del inter_df
+
+        with sampler.stage("read_csv"):
+            data = DataReader(args, logs)
+        with sampler.stage("create_corpus"):
+            data.create_corpus()
+        with sampler.stage("load_corpus"):
+            corpus = data.load_corpus(args)
+        del data
+        with sampler.stage("gen_time_split_data"):
+            corpus.gen_time_split_data(
+                args.train_time_ratio,
+                args.test_time_ratio,
+                args.val_time_ratio,
+                args.random_seed,
+                args.num_learner,
+            )
+
+        train_df = corpus.data_df["train"]
+        num_batches = min(
+            bench_args.feed_dict_batches,
+            (len(train_df) + args.batch_size - 1) // args.batch_size,
+        )
+        for name in bench_args.models.split(","):
+            name = name.strip()
+            model = build_model(name, args, corpus, logs)
+            with sampler.stage("prepare_batches/" + name):
+                batches = model.prepare_batches(
+                    corpus, train_df, args.batch_size, "train"
+                )
+            del batches
+
+            start = time.perf_counter()
+            for batch in range(num_batches):
+                model.get_feed_dict(
+                    corpus, train_df, batch * args.batch_size, args.batch_size, "train"
+                )
+            sampler.records["get_feed_dict/" + name] = {
+                "time_s": (time.perf_counter() - start) / num_batches,
+                "batches": num_batches,
+            }
+            del model
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "rows": num_learner * bench_args.seq_len,
+        "num_learner": num_learner,
+        "stages": sampler.records,
+    }
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    torch.manual_seed(bench_args.random_seed)
+
+    results = []
+    for num_rows in bench_args.rows.split(","):
+        num_rows = int(float(num_rows))
+        print("# {} rows".format(num_rows))
+        # A fresh process per scale, so the memory of one scale does not carry over
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results.append(executor.submit(bench_scale, num_rows, bench_args).result())
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        numpy=np.__version__,
+        platform=platform.platform(),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
@@ -0,0 +1,355 @@
+import sys
+
+sys.path.append("..")
+
+import json
+import time
+import argparse
+import platform
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from synthetic import synthetic_corpus
+
+from knowledge_tracing.psikt.psikt import AmortizedPSIKT, ContinualPSIKT
+from knowledge_tracing.baseline import ppe
+from knowledge_tracing.baseline.pykt import qikt, gkt
+from knowledge_tracing.baseline.HawkesKT import dktforgetting, hkt
+from knowledge_tracing.baseline.EduKTM import dkt, akt
+from knowledge_tracing.baseline.halflife_regression import hlr
+
+BASELINES = {
+    "HLR": hlr.HLR,
+    "PPE": ppe.PPE,
+    "DKT": dkt.DKT,
+    "DKTForgetting": dktforgetting.DKTFORGETTING,
+    "AKT": akt.AKT,
+    "HKT": hkt.HKT,
+    "GKT": gkt.GKT,
+    "QIKT": qikt.QIKT,
+}
+PSIKT_MODELS = ["AmortizedPSIKT", "ContinualPSIKT"]
+ALL_MODELS = PSIKT_MODELS + list(BASELINES)
+
+# Defaults of scripts/predict_learner_performance_psikt.py (num_sample is lowered to keep
+# the CPU benchmark short; it can be changed with --num_sample)
+PSIKT_ARGS = {
+    "learned_graph": "w_gt",
+    "em_train": 0,
+    "node_dim": 16,
+    "var_log_max": 10,
+    "num_category": 10,
+    "s_entropy_weight": 1e-1,
+    "z_entropy_weight": 1e-1,
+    "s_log_weight": 1,
+    "z_log_weight": 1,
+    "y_log_weight": 1,
+    "sparsity_loss_weight": 1e-12,
+    "cat_weight": 10,
+    "objective": "mc",
+    "sampler": "mc",
+    "qs_pooling": 0,
+    "graph_topk": 0,
+    "graph_refresh": 100,
+    "state_window": 2,
+    "state_var_dtype": "float32",
+    "state_path": "",
+    "state_capacity": 0,
+}
+
+PHASES = ["forward", "backward", "predict"]
+# Metrics evaluated in the loss, as in the training runners
+METRICS = ["accuracy", "f1", "auc"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Throughput/latency benchmark of the KT models on synthetic data."
+    )
+    parser.add_argument("--num_learner", type=int, default=256)
+    parser.add_argument("--num_skill", type=int, default=20)
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_sample", type=int, default=10)
+    parser.add_argument(
+        "--objective",
+        type=str,
+        default="mc",
+        choices=["mc", "analytic"],
+        help="objective of the PSI-KT models",
+    )
+    parser.add_argument(
+        "--graph_topk",
+        type=int,
+        default=0,
+        help="number of graph sources per skill of the PSI-KT models; 0 uses the dense graph",
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        default=",".join(ALL_MODELS),
+        help="comma-separated list of models, from: " + ", ".join(ALL_MODELS),
+    )
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="torch intra-op threads; 0 keeps the default",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--output", type=str, default="bench_models.json")
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default="",
+        help="previous result file; the run fails if a model got slower than allowed",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative increase of the median latency over the baseline",
+    )
+    return parser.parse_args()
+
+
+def latency_stats(times: list, num_samples: int) -> dict:
+    """
+    Summarize the latencies (in seconds) of repeated calls processing num_samples learners each.
+    """
+    times_ms = np.asarray(times) * 1e3
+    return {
+        "mean_ms": float(times_ms.mean()),
+        "p50_ms": float(np.percentile(times_ms, 50)),
+        "p95_ms": float(np.percentile(times_ms, 95)),
+        "min_ms": float(times_ms.min()),
+        "samples_per_sec": float(num_samples / times_ms.mean() * 1e3),
+        "num_samples": num_samples,
+        "repeats": len(times),
+    }
+
+
+def time_calls(fn, warmup: int, repeats: int) -> list:
+    """
+    Call fn() `warmup` times, then return the wall-clock time of `repeats` further calls.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def build_model(
+    name: str, args: argparse.Namespace, corpus, logs, overrides: dict = None
+):
+    """
+    Initialize a model with the default arguments of its training script, except for the
+    arguments in `overrides`.
+    """
+    if name in BASELINES:
+        model_class = BASELINES[name]
+        model_parser = model_class.parse_model_args(argparse.ArgumentParser())
+        model_args, _ = model_parser.parse_known_args([])
+        for key, value in {**vars(model_args), **(overrides or {})}.items():
+            setattr(args, key, value)
+        model = model_class(args, corpus, logs)
+    else:
+        for key, value in {**PSIKT_ARGS, **(overrides or {})}.items():
+            setattr(args, key, value)
+        adj = np.zeros((corpus.n_skills, corpus.n_skills))
+        kwargs = dict(
+            mode=args.train_mode,
+            num_node=corpus.n_skills,
+            nx_graph=adj,
+            device=args.device,
+            args=args,
+            logs=logs,
+        )
+        if name == "AmortizedPSIKT":
+            model = AmortizedPSIKT(**kwargs)
+        else:
+            model = ContinualPSIKT(num_seq=corpus.n_users, **kwargs)
+    return model.to(args.device)
+
+
+def bench_model(name: str, args: argparse.Namespace, corpus, logs, bench_args) -> dict:
+    """
+    Time the forward pass, forward + loss + backward pass and the predictive model of one model.
+
+    Amortized models are timed on a full training batch (forward/backward) and on a batch
+    spanning the training and test steps (predictive_model). ContinualPSIKT is timed on one
+    continual step: predictive + inference model and objective (forward), loss + backward,
+    and the multi-step prediction of eval_model.
+    """
+    model = build_model(name, args, corpus, logs)
+    model.train()
+
+    bs = bench_args.batch_size
+    train_batch = model.prepare_batches(corpus, corpus.data_df["train"], bs, "train")[0]
+    whole_batch = model.prepare_batches(corpus, corpus.data_df["whole"], bs, "whole")[0]
+    train_batch = model.batch_to_gpu(train_batch, args.device)
+    whole_batch = model.batch_to_gpu(whole_batch, args.device)
+    num_samples = whole_batch["label_seq"].shape[0]
+
+    if name == "ContinualPSIKT":
+        idx = 0
+        # eval_model starts from the stored posterior of step idx
+        with torch.no_grad():
+            model.inference_model(feed_dict=whole_batch, idx=idx, update=True)
+
+        def forward():
+            pred_dist, post_dist = model.filtering_step(feed_dict=whole_batch, idx=idx)
+            return model.objective_function(
+                whole_batch, idx=idx, pred_dist=pred_dist, post_dist=post_dist
+            )
+
+        def backward():
+            model.zero_grad(set_to_none=True)
+            loss_dict = model.loss(whole_batch, forward(), metrics=METRICS)
+            loss_dict["loss_total"].backward()
+
+        def predict():
+            with torch.no_grad():
+                model.eval_model(whole_batch, idx)
+
+    else:
+        num_samples = train_batch["label_seq"].shape[0]
+
+        def forward():
+            return model(train_batch)
+
+        def backward():
+            model.zero_grad(set_to_none=True)
+            loss_dict = model.loss(train_batch, forward(), metrics=METRICS)
+            loss_dict["loss_total"].backward()
+
+        def predict():
+            with torch.no_grad():
+                model.predictive_model(whole_batch)
+
+    result = {
+        "status": "ok",
+        "num_params": sum(p.numel() for p in model.parameters() if p.requires_grad),
+    }
+    for phase, fn in zip(PHASES, [forward, backward, predict]):
+        times = time_calls(fn, bench_args.warmup, bench_args.repeats)
+        result[phase] = latency_stats(times, num_samples)
+    return result
+
+
+def check_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare the median latencies with a previous run.
+
+    A phase regresses when its p50 latency exceeds the baseline p50 by more than `tolerance`
+    (relative). The threshold is stored next to each measured phase.
+
+    Returns:
+        A list of (model, phase, p50_ms, threshold_ms) tuples, one per regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        prev = baseline.get("results", {}).get(name)
+        if result["status"] != "ok" or prev is None or prev.get("status") != "ok":
+            continue
+        for phase in PHASES:
+            threshold = prev[phase]["p50_ms"] * (1 + tolerance)
+            result[phase]["baseline_p50_ms"] = prev[phase]["p50_ms"]
+            result[phase]["threshold_ms"] = threshold
+            result[phase]["regression"] = result[phase]["p50_ms"] > threshold
+            if result[phase]["regression"]:
+                regressions.append((name, phase, result[phase]["p50_ms"], threshold))
+    return regressions
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    PSIKT_ARGS["objective"] = bench_args.objective
+    PSIKT_ARGS["graph_topk"] = bench_args.graph_topk
+    if bench_args.num_threads > 0:
+        torch.set_num_threads(bench_args.num_threads)
+    torch.manual_seed(bench_args.random_seed)
+    np.random.seed(bench_args.random_seed)
+
+    args, logs, corpus = synthetic_corpus(
+        bench_args.num_learner,
+        bench_args.num_skill,
+        bench_args.seq_len,
+        random_seed=bench_args.random_seed,
+        batch_size=bench_args.batch_size,
+        num_sample=bench_args.num_sample,
+    )
+    args.log_path = str(Path(args.save_folder))
+
+    results = {}
+    for name in bench_args.models.split(","):
+        name = name.strip()
+        if name not in ALL_MODELS:
+            raise ValueError("Unknown model: " + name)
+        try:
+            results[name] = bench_model(name, args, corpus, logs, bench_args)
+        except Exception as e:
+            traceback.print_exc()
+            results[name] = {
+                "status": "error",
+                "error": "{}: {}".format(type(e).__name__, str(e).splitlines()[0]),
+            }
+
+        if results[name]["status"] == "ok":
+            print(
+                "{:<15s}".format(name)
+                + "".join(
+                    " {} p50 {:8.2f} ms ({:8.1f}/s)".format(
+                        phase,
+                        results[name][phase]["p50_ms"],
+                        results[name][phase]["samples_per_sec"],
+                    )
+                    for phase in PHASES
+                )
+            )
+        else:
+            print("{:<15s} {}".format(name, results[name]["error"]))
+
+    regressions = []
+    if bench_args.baseline:
+        with open(bench_args.baseline) as f:
+            regressions = check_regressions(results, json.load(f), bench_args.tolerance)
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        num_threads=torch.get_num_threads(),
+        platform=platform.platform(),
+        device=str(args.device),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump(
+            {
+                "config": config,
+                "results": results,
+                "regressions": [list(r) for r in regressions],
+            },
+            f,
+            indent=2,
+        )
+
+    for name, phase, p50, threshold in regressions:
+        print(
+            "REGRESSION {} {}: p50 {:.2f} ms > threshold {:.2f} ms".format(
+                name, phase, p50, threshold
+            )
+        )
+    failures = [name for name, result in results.items() if result["status"] != "ok"]
+    for name in failures:
+        print("FAILED {}: {}".format(name, results[name]["error"]))
+    sys.exit(1 if regressions or failures else 0)
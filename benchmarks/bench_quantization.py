@@ -0,0 +1,193 @@
+import sys
+
+sys.path.append("..")
+
+import io
+import json
+import argparse
+import platform
+from pathlib import Path
+
+import numpy as np
+
+import torch
+from sklearn.metrics import roc_auc_score
+
+from synthetic import synthetic_corpus
+from bench_models import build_model, latency_stats, time_calls
+
+from knowledge_tracing.baseline.basemodel import BaseModel
+from knowledge_tracing.runner.quantization import quantize_model
+
+METRICS = ["accuracy", "f1", "precision", "recall"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Accuracy and throughput of the predictive models with dynamic int8 "
+        "quantization against float32, on the held-out (test) split of synthetic data. "
+        "Every model is first trained for a few epochs on the training split."
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        default="AmortizedPSIKT,DKT,DKTForgetting",
+        help="comma-separated list of models",
+    )
+    parser.add_argument("--num_learner", type=int, default=512)
+    parser.add_argument("--num_skill", type=int, default=20)
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_sample", type=int, default=10)
+    parser.add_argument("--num_epoch", type=int, default=5)
+    parser.add_argument(
+        "--hidden_size",
+        type=int,
+        default=0,
+        help="width of the layers (node_dim of PSI-KT, emb_size and hidden_size of the "
+        "baselines); 0 keeps the defaults of the training scripts",
+    )
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="torch intra-op threads; 0 keeps the default",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--output", type=str, default="bench_quantization.json")
+    return parser.parse_args()
+
+
+def train(model, batches: list, num_epoch: int) -> None:
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=model.args.lr)
+    for _ in range(num_epoch):
+        for batch in batches:
+            optimizer.zero_grad(set_to_none=True)
+            loss_dict = model.loss(batch, model(batch))
+            loss_dict["loss_total"].backward()
+            optimizer.step()
+    model.eval()
+
+
+def evaluate(model, batches: list, random_seed: int) -> tuple:
+    """
+    Metrics of the predictive model on the batches, with the same random samples (PSI-KT)
+    for every model.
+
+    Returns:
+        The metrics and the concatenated predictions.
+    """
+    torch.manual_seed(random_seed)
+    predictions, labels = [], []
+    with torch.no_grad():
+        for batch in batches:
+            out_dict = model.predictive_model(batch)
+            predictions.append(out_dict["prediction"].flatten().numpy())
+            labels.append(out_dict["label"].flatten().numpy())
+    predictions, labels = np.concatenate(predictions), np.concatenate(labels)
+    metrics = BaseModel.pred_evaluate_method(predictions, labels, METRICS)
+    metrics["auc"] = roc_auc_score(labels, predictions)
+    return {key: float(value) for key, value in metrics.items()}, predictions
+
+
+def state_dict_bytes(model) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def bench_quantization(name: str, args, corpus, logs, bench_args) -> dict:
+    overrides = {}
+    if bench_args.hidden_size > 0:
+        overrides = {
+            "node_dim": bench_args.hidden_size,
+            "emb_size": bench_args.hidden_size,
+            "hidden_size": bench_args.hidden_size,
+        }
+    model = build_model(name, args, corpus, logs, overrides)
+    bs = bench_args.batch_size
+    train_batches = model.prepare_batches(corpus, corpus.data_df["train"], bs, "train")
+    test_batches = model.prepare_batches(corpus, corpus.data_df["test"], bs, "test")
+    train(model, train_batches, bench_args.num_epoch)
+    quantized = quantize_model(model)
+
+    result = {}
+    predictions = {}
+    for precision, m in [("fp32", model), ("int8", quantized)]:
+        metrics, predictions[precision] = evaluate(
+            m, test_batches, bench_args.random_seed
+        )
+
+        def predict():
+            with torch.no_grad():
+                m.predictive_model(test_batches[0])
+
+        times = time_calls(predict, bench_args.warmup, bench_args.repeats)
+        result[precision] = {
+            "metrics": metrics,
+            "predict": latency_stats(times, test_batches[0]["label_seq"].shape[0]),
+            "state_dict_bytes": state_dict_bytes(m),
+        }
+    result["metric_delta"] = {
+        key: result["int8"]["metrics"][key] - result["fp32"]["metrics"][key]
+        for key in result["fp32"]["metrics"]
+    }
+    result["max_abs_diff_prediction"] = float(
+        np.abs(predictions["int8"] - predictions["fp32"]).max()
+    )
+    result["speedup"] = (
+        result["fp32"]["predict"]["p50_ms"] / result["int8"]["predict"]["p50_ms"]
+    )
+    return result
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    if bench_args.num_threads > 0:
+        torch.set_num_threads(bench_args.num_threads)
+    torch.manual_seed(bench_args.random_seed)
+    np.random.seed(bench_args.random_seed)
+
+    args, logs, corpus = synthetic_corpus(
+        bench_args.num_learner,
+        bench_args.num_skill,
+        bench_args.seq_len,
+        random_seed=bench_args.random_seed,
+        batch_size=bench_args.batch_size,
+        num_sample=bench_args.num_sample,
+    )
+    args.log_path = str(Path(args.save_folder))
+
+    results = {}
+    for name in bench_args.models.split(","):
+        name = name.strip()
+        results[name] = result = bench_quantization(
+            name, args, corpus, logs, bench_args
+        )
+        print(
+            "{:<15s} predict p50 fp32 {:8.2f} ms  int8 {:8.2f} ms  speedup {:5.2f}x  "
+            "auc {:.4f} -> {:.4f}  accuracy {:.4f} -> {:.4f}  max |dp| {:.2e}".format(
+                name,
+                result["fp32"]["predict"]["p50_ms"],
+                result["int8"]["predict"]["p50_ms"],
+                result["speedup"],
+                result["fp32"]["metrics"]["auc"],
+                result["int8"]["metrics"]["auc"],
+                result["fp32"]["metrics"]["accuracy"],
+                result["int8"]["metrics"]["accuracy"],
+                result["max_abs_diff_prediction"],
+            )
+        )
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        num_threads=torch.get_num_threads(),
+        quantized_engine=torch.backends.quantized.engine,
+        platform=platform.platform(),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
@@ -0,0 +1,117 @@
+import sys
+
+sys.path.append("..")
+
+import json
+import argparse
+import platform
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from synthetic import synthetic_corpus
+from bench_models import build_model, latency_stats, time_calls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Latency of the multi-step forecasts of AmortizedPSIKT, with the z "
+        "recursion solved step by step (sequential) or with an associative scan in the "
+        "eigenbasis of the graph (scan)."
+    )
+    parser.add_argument(
+        "--horizons",
+        type=str,
+        default="10,100,1000",
+        help="comma-separated numbers of forecast steps",
+    )
+    parser.add_argument("--num_skill", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_sample", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="torch intra-op threads; 0 keeps the default",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--output", type=str, default="bench_rollout.json")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    if bench_args.num_threads > 0:
+        torch.set_num_threads(bench_args.num_threads)
+    torch.manual_seed(bench_args.random_seed)
+
+    # The model only needs the number of skills; a minimal corpus is enough
+    args, logs, corpus = synthetic_corpus(
+        bench_args.batch_size,
+        bench_args.num_skill,
+        10,
+        random_seed=bench_args.random_seed,
+        num_sample=bench_args.num_sample,
+    )
+    args.log_path = str(Path(args.save_folder))
+    model = build_model("AmortizedPSIKT", args, corpus, logs)
+    model.eval()
+    device = args.device
+
+    with torch.no_grad():
+        # Keep long horizons finite: the untrained transition matrix may be expanding
+        gen_st_h = model.gen_st_h
+        gen_st_h.div_(torch.linalg.matrix_norm(gen_st_h, ord=2) / 0.99)
+
+    bs = bench_args.batch_size
+    s_last_mean = torch.randn(bs, 1, model.dim_s, device=device)
+    s_last_cov_mat = torch.diag_embed(torch.rand(bs, 1, model.dim_s, device=device))
+    z_last_mean = torch.randn(bs, 1, model.num_node, device=device)
+
+    results = {}
+    for horizon in bench_args.horizons.split(","):
+        horizon = int(horizon)
+        # Exponential gaps with a mean of one hour, scaled as in predictive_model
+        dt = torch.distributions.Exponential(1 / 3600.0).sample((bs, horizon, 1))
+        dt = dt.to(device) / 86400000 + 1e-6
+
+        result = {}
+        z_means = {}
+        with torch.no_grad():
+            for method, parallel in [("sequential", False), ("scan", True)]:
+                rollout = lambda: model.predictive_rollout(
+                    s_last_mean, s_last_cov_mat, z_last_mean, dt, parallel=parallel
+                )
+                times = time_calls(rollout, bench_args.warmup, bench_args.repeats)
+                result[method] = latency_stats(times, bs)
+                z_means[method] = rollout()[2]
+        result["speedup"] = result["sequential"]["p50_ms"] / result["scan"]["p50_ms"]
+        result["max_abs_diff_z_mean"] = float(
+            (z_means["sequential"] - z_means["scan"]).abs().max()
+        )
+        results[horizon] = result
+        print(
+            "horizon {:5d}  sequential p50 {:9.2f} ms  scan p50 {:9.2f} ms  "
+            "speedup {:6.2f}x  max |dz| {:.2e}".format(
+                horizon,
+                result["sequential"]["p50_ms"],
+                result["scan"]["p50_ms"],
+                result["speedup"],
+                result["max_abs_diff_z_mean"],
+            )
+        )
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        numpy=np.__version__,
+        num_threads=torch.get_num_threads(),
+        platform=platform.platform(),
+        device=str(device),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
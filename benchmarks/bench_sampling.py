@@ -0,0 +1,182 @@
+import sys
+
+sys.path.append("..")
+
+import json
+import time
+import argparse
+import platform
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from synthetic import synthetic_corpus
+from bench_models import build_model
+from bench_quantization import train
+
+from knowledge_tracing.psikt.modules import SAMPLERS, DiagonalNormal
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Variance of the sampled estimates of AmortizedPSIKT with every "
+        "sampler (see --sampler of the training script) against their cost, on synthetic "
+        "data: the ELBO and its gradient with respect to the posterior moments of a "
+        "training batch, and the predicted probabilities of a test batch."
+    )
+    parser.add_argument("--num_learner", type=int, default=256)
+    parser.add_argument("--num_skill", type=int, default=20)
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument(
+        "--num_samples",
+        type=str,
+        default="4,16,64,256",
+        help="comma-separated numbers of samples per estimate",
+    )
+    parser.add_argument("--num_epoch", type=int, default=3)
+    parser.add_argument(
+        "--repeats", type=int, default=50, help="independent estimates per setting"
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="torch intra-op threads; 0 keeps the default",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--output", type=str, default="bench_sampling.json")
+    return parser.parse_args()
+
+
+def fixed_dists(model, batch: dict) -> tuple:
+    """
+    The posterior and prior of a batch, computed once so that the repeated estimates only
+    differ by the samples of get_objective_values. The posterior moments are leaves of the
+    gradient.
+    """
+    with torch.no_grad():
+        emb_history = model.embedding_process(
+            time=batch["time_seq"], label=batch["label_seq"], item=batch["skill_seq"]
+        )
+        qs_dist, qz_dist = model.inference_process(emb_history, batch)
+        ps_dist, pz_dist = model.generative_process(qs_dist, qz_dist, batch)
+    leaves = [
+        tensor.detach().clone().requires_grad_()
+        for tensor in [qs_dist.loc, qs_dist.scale, qz_dist.loc, qz_dist.scale]
+    ]
+    q_dists = [DiagonalNormal(*leaves[:2]), DiagonalNormal(*leaves[2:])]
+    return q_dists, [ps_dist, pz_dist], leaves
+
+
+def objective_estimate(model, q_dists, p_dists, leaves, batch) -> tuple:
+    elbo = model.get_objective_values(q_dists, p_dists, batch)["elbo"]
+    grads = torch.autograd.grad(elbo, leaves)
+    return elbo.detach().reshape(1), torch.cat([grad.flatten() for grad in grads])
+
+
+def prediction_estimate(model, batch) -> tuple:
+    with torch.no_grad():
+        prediction = model.predictive_model(batch)["prediction"].mean(1)
+    return (prediction.flatten(),)
+
+
+def repeated_estimates(estimate, repeats: int) -> dict:
+    """
+    Repeat an estimate, returning the variances of its outputs (summed over their entries)
+    and the mean time of one estimate.
+    """
+    estimates, times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        values = estimate()
+        times.append(time.perf_counter() - start)
+        estimates.append(values)
+    variances = [float(torch.stack(values).var(0).sum()) for values in zip(*estimates)]
+    return dict(variances=variances, mean_ms=float(np.mean(times[1:]) * 1e3))
+
+
+def efficiency(result: dict, mc_result: dict, num_sample: int) -> dict:
+    """
+    The number of independent samples with the same variance, and the gain in variance per
+    unit of compute over independent samples of the same number.
+    """
+    return dict(
+        equivalent_mc_samples=num_sample * mc_result["variance"] / result["variance"],
+        work_normalized_gain=(mc_result["variance"] * mc_result["mean_ms"])
+        / (result["variance"] * result["mean_ms"]),
+    )
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    if bench_args.num_threads > 0:
+        torch.set_num_threads(bench_args.num_threads)
+    torch.manual_seed(bench_args.random_seed)
+    np.random.seed(bench_args.random_seed)
+    num_samples = [int(num_sample) for num_sample in bench_args.num_samples.split(",")]
+
+    args, logs, corpus = synthetic_corpus(
+        bench_args.num_learner,
+        bench_args.num_skill,
+        bench_args.seq_len,
+        random_seed=bench_args.random_seed,
+        batch_size=bench_args.batch_size,
+        num_sample=num_samples[0],
+    )
+    args.log_path = str(Path(args.save_folder))
+    model = build_model("AmortizedPSIKT", args, corpus, logs)
+    bs = bench_args.batch_size
+    train_batches = model.prepare_batches(corpus, corpus.data_df["train"], bs, "train")
+    test_batch = model.prepare_batches(corpus, corpus.data_df["test"], bs, "test")[0]
+    train(model, train_batches, bench_args.num_epoch)
+    q_dists, p_dists, leaves = fixed_dists(model, train_batches[0])
+
+    estimates = {
+        "elbo": lambda: objective_estimate(
+            model, q_dists, p_dists, leaves, train_batches[0]
+        ),
+        "prediction": lambda: prediction_estimate(model, test_batch),
+    }
+    outputs = {"elbo": ["elbo", "elbo_grad"], "prediction": ["prediction"]}
+
+    results = {}
+    for num_sample in num_samples:
+        model.num_sample = num_sample
+        results[num_sample] = {}
+        for sampler in SAMPLERS:
+            model.sampler = sampler
+            result = results[num_sample][sampler] = {}
+            for name, estimate in estimates.items():
+                stats = repeated_estimates(estimate, bench_args.repeats)
+                for output, variance in zip(outputs[name], stats["variances"]):
+                    result[output] = dict(variance=variance, mean_ms=stats["mean_ms"])
+            for output, output_result in result.items():
+                output_result.update(
+                    efficiency(
+                        output_result, results[num_sample]["mc"][output], num_sample
+                    )
+                )
+                print(
+                    "n {:4d}  {:<10s}  {:<10s}  variance {:.3e}  {:7.2f} ms  "
+                    "equivalent mc samples {:8.1f}  work-normalized gain {:6.2f}x".format(
+                        num_sample,
+                        sampler,
+                        output,
+                        output_result["variance"],
+                        output_result["mean_ms"],
+                        output_result["equivalent_mc_samples"],
+                        output_result["work_normalized_gain"],
+                    )
+                )
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        num_threads=torch.get_num_threads(),
+        platform=platform.platform(),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
@@ -0,0 +1,194 @@
+import sys
+
+sys.path.append("..")
+
+import json
+import time
+import asyncio
+import argparse
+import platform
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from synthetic import synthetic_corpus
+from bench_models import ALL_MODELS, build_model
+
+from knowledge_tracing.runner.prediction_server import (
+    MicroBatcher,
+    PredictionServer,
+    predict_requests,
+    open_connection,
+    post_request,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Load test of the prediction server: latency and throughput of "
+        "concurrent clients. Without --port/--unix_socket, a server with an untrained "
+        "model on synthetic data is started in this process for every batch size."
+    )
+    parser.add_argument(
+        "--model", type=str, default="AmortizedPSIKT", choices=ALL_MODELS
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=0, help="port of a running server; 0 starts one"
+    )
+    parser.add_argument(
+        "--unix_socket", type=str, default="", help="Unix socket of a running server"
+    )
+    parser.add_argument("--num_learner", type=int, default=256)
+    parser.add_argument("--num_skill", type=int, default=20)
+    parser.add_argument("--seq_len", type=int, default=50)
+    parser.add_argument("--num_sample", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--num_requests", type=int, default=2000)
+    parser.add_argument(
+        "--max_batch_sizes",
+        type=str,
+        default="1,32",
+        help="comma-separated micro-batch sizes of the started servers",
+    )
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=0,
+        help="torch intra-op threads; 0 keeps the default",
+    )
+    parser.add_argument("--random_seed", type=int, default=2022)
+    parser.add_argument("--output", type=str, default="bench_server.json")
+    return parser.parse_args()
+
+
+def make_requests(corpus, train_step: int, test_step: int) -> list:
+    """
+    One request per learner of the corpus: the first train_step interactions as history
+    and the following test_step items to predict.
+    """
+    requests = []
+    for _, row in corpus.data_df["whole"].iterrows():
+        end = train_step + test_step
+        requests.append(
+            {
+                "learner": int(row["user_id"]),
+                "skill_seq": list(row["skill_seq"][:train_step]),
+                "correct_seq": list(row["correct_seq"][:train_step]),
+                "time_seq": list(row["time_seq"][:train_step]),
+                "next_skill_seq": list(row["skill_seq"][train_step:end]),
+                "next_time_seq": list(row["time_seq"][train_step:end]),
+            }
+        )
+    return requests
+
+
+async def load_test(bench_args, requests: list) -> dict:
+    """
+    Send num_requests requests from `concurrency` keep-alive connections, each waiting for
+    its answer before sending the next request.
+    """
+    latencies = []
+    num_errors = 0
+    next_request = iter(range(bench_args.num_requests))
+
+    async def client():
+        nonlocal num_errors
+        reader, writer = await open_connection(
+            bench_args.host, bench_args.port, bench_args.unix_socket
+        )
+        for i in next_request:
+            start = time.perf_counter()
+            status, _ = await post_request(reader, writer, requests[i % len(requests)])
+            latencies.append(time.perf_counter() - start)
+            num_errors += status != 200
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(bench_args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.asarray(latencies) * 1e3
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+        "requests_per_sec": len(latencies) / elapsed,
+        "num_requests": len(latencies),
+        "num_errors": num_errors,
+    }
+
+
+async def bench_local_server(bench_args, model, corpus, requests, max_batch_size):
+    batcher = MicroBatcher(
+        lambda batch: predict_requests(model, corpus, batch),
+        max_batch_size=max_batch_size,
+        max_wait_ms=bench_args.max_wait_ms,
+    )
+    train_step = int(model.args.max_step * model.args.train_time_ratio)
+    test_step = int(model.args.max_step * model.args.test_time_ratio)
+    server = PredictionServer(batcher, train_step, test_step)
+    listener = await server.start(bench_args.host, 0)
+    bench_args.port = listener.sockets[0].getsockname()[1]
+    result = await load_test(bench_args, requests)
+    result["mean_batch_size"] = batcher.num_requests / max(batcher.num_batches, 1)
+    listener.close()
+    server.worker.cancel()
+    return result
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    if bench_args.num_threads > 0:
+        torch.set_num_threads(bench_args.num_threads)
+    torch.manual_seed(bench_args.random_seed)
+
+    args, logs, corpus = synthetic_corpus(
+        bench_args.num_learner,
+        bench_args.num_skill,
+        bench_args.seq_len,
+        random_seed=bench_args.random_seed,
+        num_sample=bench_args.num_sample,
+    )
+    args.log_path = str(Path(args.save_folder))
+    train_step = int(args.max_step * args.train_time_ratio)
+    test_step = int(args.max_step * args.test_time_ratio)
+    requests = make_requests(corpus, train_step, test_step)
+
+    results = {}
+    if bench_args.port or bench_args.unix_socket:
+        results["remote"] = asyncio.run(load_test(bench_args, requests))
+    else:
+        model = build_model(bench_args.model, args, corpus, logs)
+        model.eval()
+        for max_batch_size in bench_args.max_batch_sizes.split(","):
+            max_batch_size = int(max_batch_size)
+            results[max_batch_size] = asyncio.run(
+                bench_local_server(bench_args, model, corpus, requests, max_batch_size)
+            )
+            bench_args.port = 0
+
+    for name, result in results.items():
+        print(
+            "max_batch_size {:>6}  p50 {:8.2f} ms  p99 {:8.2f} ms  {:8.1f} req/s  "
+            "mean batch {:5.1f}  errors {}".format(
+                name,
+                result["p50_ms"],
+                result["p99_ms"],
+                result["requests_per_sec"],
+                result.get("mean_batch_size", float("nan")),
+                result["num_errors"],
+            )
+        )
+
+    config = dict(vars(bench_args))
+    config.update(
+        torch=torch.__version__,
+        num_threads=torch.get_num_threads(),
+        platform=platform.platform(),
+    )
+    with open(bench_args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
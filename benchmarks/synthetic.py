@@ -0,0 +1,165 @@
+import sys
+
+sys.path.append("..")
+
+import argparse
+import datetime
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+from knowledge_tracing.data.data_loader import DataReader
+from knowledge_tracing.utils import arg_parser, logger
+
+
+def generate_interactions(
+    num_learner: int,
+    num_skill: int,
+    seq_len: int,
+    num_problem: int = None,
+    random_seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Generate a synthetic interaction table in the format read by DataReader.
+
+    Every learner has exactly `seq_len` interactions, so the table has
+    num_learner * seq_len rows. Correctness follows a simple Rasch model (learner ability
+    minus skill difficulty) with a practice effect, which is enough to give the models a
+    learnable signal while keeping generation vectorized for tens of millions of rows.
+
+    Args:
+        num_learner: The number of learners.
+        num_skill: The number of skills (knowledge components).
+        seq_len: The number of interactions per learner.
+        num_problem: The number of problems; if None, every skill is its own problem.
+        random_seed: Seed of the random generator.
+
+    Returns:
+        A DataFrame with the columns user_id, skill_id, problem_id, timestamp, correct.
+    """
+    rng = np.random.default_rng(random_seed)
+    num_inter = num_learner * seq_len
+
+    user_id = np.repeat(np.arange(num_learner), seq_len)
+    skill_id = rng.integers(num_skill, size=num_inter)
+    if num_problem is None:
+        problem_id = skill_id
+    else:
+        problem_id = rng.integers(num_problem, size=num_inter)
+
+    # Exponential gaps (mean one hour) between consecutive interactions of a learner
+    gaps = rng.exponential(3600.0, size=(num_learner, seq_len))
+    timestamp = np.cumsum(gaps, axis=1).astype(np.int64).reshape(-1)
+
+    ability = rng.normal(size=num_learner)[user_id]
+    difficulty = rng.normal(size=num_skill)[skill_id]
+    practice = 0.5 * np.tile(np.linspace(0, 1, seq_len), num_learner)
+    prob = 1 / (1 + np.exp(-(ability - difficulty + practice)))
+    correct = (rng.random(num_inter) < prob).astype(np.int64)
+
+    return pd.DataFrame(
+        {
+            "user_id": user_id,
+            "skill_id": skill_id,
+            "problem_id": problem_id,
+            "timestamp": timestamp,
+            "correct": correct,
+        }
+    )
+
+
+def write_interactions(
+    inter_df: pd.DataFrame,
+    data_dir: Path,
+    dataset: str,
+    max_step: int,
+) -> Path:
+    """
+    Save the interactions where DataReader expects them: <data_dir>/<dataset>/interactions_<max_step>.csv
+    """
+    path = Path(data_dir, dataset, "interactions_{}.csv".format(max_step))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    inter_df.to_csv(path, sep="\t", index=False)
+    return path
+
+
+def default_args(
+    work_dir: Path,
+    dataset: str = "synthetic",
+    max_step: int = 50,
+    **kwargs,
+) -> argparse.Namespace:
+    """
+    Build the global arguments of a run with their command-line defaults.
+
+    Args:
+        work_dir: Folder holding the synthetic data set and the logs of the run.
+        dataset: The name of the synthetic data set.
+        max_step: Max time steps per sequence.
+        **kwargs: Overrides of any other argument.
+
+    Returns:
+        The global arguments.
+    """
+    parser = arg_parser.parse_args(argparse.ArgumentParser(description="Global"))
+    args, _ = parser.parse_known_args([])
+
+    args.data_dir = str(Path(work_dir, "data"))
+    args.save_folder = str(Path(work_dir, "logs"))
+    args.dataset = dataset
+    args.max_step = max_step
+    args.kfold = 5
+    args.metric = "Accuracy, F1, Recall, Precision, AUC"
+    args.model_name = "synthetic"
+    args.overfit = 0
+    args.num_learner = 0
+    args.plot_interval = -1
+    args.time = datetime.datetime.now().isoformat()
+    args.device = torch.device("cpu")
+    args.num_GPU = None
+    args.batch_size_multiGPU = args.batch_size
+
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def build_corpus(
+    args: argparse.Namespace,
+    logs: logger.Logger,
+    inter_df: pd.DataFrame,
+) -> DataReader:
+    """
+    Write the interactions and run the regular corpus pipeline on them
+    (create_corpus, load_corpus with the time split of the arguments).
+    """
+    write_interactions(inter_df, args.data_dir, args.dataset, args.max_step)
+    data = DataReader(args, logs)
+    data.create_corpus()
+    return data.load_corpus(args)
+
+
+def synthetic_corpus(
+    num_learner: int,
+    num_skill: int,
+    seq_len: int,
+    work_dir: Path = None,
+    random_seed: int = 0,
+    **kwargs,
+) -> tuple:
+    """
+    Convenience wrapper returning (args, logs, corpus) for a synthetic data set of the given scale.
+    """
+    if work_dir is None:
+        work_dir = Path(tempfile.mkdtemp(prefix="psikt_bench_"))
+    args = default_args(work_dir, max_step=seq_len, random_seed=random_seed, **kwargs)
+    logs = logger.Logger(args)
+    inter_df = generate_interactions(
+        num_learner, num_skill, seq_len, random_seed=random_seed
+    )
+    corpus = build_corpus(args, logs, inter_df)
+    return args, logs, corpus
@@ -584,7 +584,7 @@ class TransformerLayer(nn.Module):
         seqlen, batch_size = query.size(1), query.size(0)
         nopeek_mask = np.triu(np.ones((1, 1, seqlen, seqlen)), k=mask).astype("uint8")
         src_mask = torch.from_numpy(nopeek_mask) == 0
-        src_mask = src_mask.cuda() if self.gpu != "" else src_mask
+        src_mask = src_mask.to(query.device)
         if mask == 0:  # If 0, zero-padding is needed.
             # Calls block.masked_attn_head.forward() method
             query2 = self.masked_attn_head(
@@ -725,13 +725,12 @@ class MultiHeadAttention(nn.Module):
         bs, head, seqlen = scores.size(0), scores.size(1), scores.size(2)
 
         x1 = torch.arange(seqlen).expand(seqlen, -1)
-        x1 = x1.cuda() if self.gpu != "" else x1
+        x1 = x1.to(scores.device)
         x2 = x1.transpose(0, 1).contiguous()
 
         with torch.no_grad():
             scores_ = F.softmax(scores, dim=-1)  # batch_size,8,seqlen,seqlen
             scores_ = scores_ * mask.float()
-            scores_ = scores_.cuda() if self.gpu != "" else scores_
             distcum_scores = torch.cumsum(scores_, dim=-1)  # batch_size, 8, sl, sl
             disttotal_scores = torch.sum(
                 scores_, dim=-1, keepdim=True
@@ -739,9 +738,6 @@ class MultiHeadAttention(nn.Module):
             position_effect = torch.abs(x1 - x2)[
                 None, None, :, :
             ].float()  # 1, 1, seqlen, seqlen
-            position_effect = (
-                position_effect.cuda() if self.gpu != "" else position_effect
-            )
             # batch_size, 8, sl, sl positive distance
             dist_scores = torch.clamp(
                 (disttotal_scores - distcum_scores) * position_effect, min=0.0
@@ -759,8 +755,7 @@ class MultiHeadAttention(nn.Module):
         scores = scores.masked_fill(mask == 0, maxim)  # float('-inf'))
         scores = F.softmax(scores, dim=-1)  # batch_size, head, seqlen, seqlen
         if zero_pad:
-            pad_zero = torch.zeros(bs, head, 1, seqlen).float()
-            pad_zero = pad_zero.cuda() if self.gpu != "" else pad_zero
+            pad_zero = torch.zeros(bs, head, 1, seqlen, device=scores.device)
             scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2)
         scores = dropout(scores)
 
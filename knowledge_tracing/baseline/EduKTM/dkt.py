@@ -1,7 +1,7 @@
 import argparse
 from pathlib import Path
 from collections import defaultdict
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -134,6 +134,45 @@ class DKT(BaseModel):
         out_dict = self.forward(cur_feed_dict)
         return out_dict
 
+    def forward_cl_step(
+        self,
+        feed_dict: Dict[str, torch.Tensor],
+        idx: int,
+        state: Tuple[torch.Tensor, torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Incremental counterpart of forward_cl: predict the item at index idx from the LSTM
+        state over the items before idx - 1, running the LSTM on the item at idx - 1 only.
+        The loss back-propagates through this last LSTM step.
+
+        Args:
+            feed_dict: A dictionary containing the input tensors for the model.
+            idx: The current time index (at least 1).
+            state: The LSTM state (h, c) over the items before idx - 1, None if idx is 1.
+
+        Returns:
+            A dictionary with the prediction and label [batch_size, 1] of the item at idx,
+            and the detached LSTM state over the items before idx, to pass at idx + 1.
+        """
+        items = feed_dict["skill_seq"]  # [batch_size, history_max]
+        labels = feed_dict["label_seq"]  # [batch_size, history_max]
+
+        last_emb = self.skill_embeddings(
+            items[:, idx - 1 : idx] + labels[:, idx - 1 : idx] * self.skill_num
+        )  # [batch_size, 1, emb_size]
+        output, (h, c) = self.rnn(last_emb, state)
+        pred_vector = self.out(output)  # [batch_size, 1, skill_num]
+        prediction = torch.gather(
+            pred_vector, dim=-1, index=items[:, idx : idx + 1].unsqueeze(dim=-1)
+        ).squeeze(dim=-1)
+
+        out_dict = {
+            "prediction": torch.sigmoid(prediction),
+            "label": labels[:, idx : idx + 1].double(),
+            "state": (h.detach(), c.detach()),
+        }
+        return out_dict
+
     def evaluate_cl(
         self,
         feed_dict: Dict[str, torch.Tensor],
@@ -204,6 +204,7 @@ class DKTFORGETTING(BaseModel):
                 "past_trial_counts_seq",
                 "user_id",
                 "inverse_indice",
+                "length",
             ],
             data=feed_dict,
             idx=idx,
@@ -214,6 +215,61 @@ class DKTFORGETTING(BaseModel):
 
         return out_dict
 
+    def forward_cl_step(
+        self,
+        feed_dict: Dict[str, torch.Tensor],
+        idx: int,
+        state: Tuple[torch.Tensor, torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Incremental counterpart of forward_cl: predict the item at index idx from the LSTM
+        state over the items before idx - 1, running the LSTM on the item at idx - 1 only.
+        The loss back-propagates through this last LSTM step.
+
+        Args:
+            feed_dict: A dictionary containing input data.
+            idx: The current time index (at least 1).
+            state: The LSTM state (h, c) over the items before idx - 1, None if idx is 1.
+
+        Returns:
+            A dictionary with the prediction and label [batch_size, 1] of the item at idx,
+            and the detached LSTM state over the items before idx, to pass at idx + 1.
+        """
+        items = feed_dict["skill_seq"]  # [batch_size, max_step]
+        labels = feed_dict["label_seq"]  # [batch_size, max_step]
+        time_features = torch.cat(
+            (
+                feed_dict["repeated_time_gap_seq"][:, idx - 1 : idx + 1],
+                feed_dict["sequence_time_gap_seq"][:, idx - 1 : idx + 1],
+                feed_dict["past_trial_counts_seq"][:, idx - 1 : idx + 1],
+            ),
+            dim=-1,
+        )  # [batch_size, 2, 3]
+
+        # Feature interaction of the item at idx - 1, as in forward
+        embed_history_i = self.skill_embeddings(
+            items[:, idx - 1 : idx] + labels[:, idx - 1 : idx] * self.skill_num
+        )  # [batch_size, 1, emb_size]
+        fin = self.fin(time_features[:, :1])
+        embed_history_i = torch.cat(
+            (embed_history_i.mul(fin), time_features[:, :1]), dim=-1
+        )
+        rnn_output, (h, c) = self.rnn(embed_history_i, state)
+
+        fout = self.fout(time_features[:, 1:])
+        output = torch.cat((rnn_output.mul(fout), time_features[:, 1:]), dim=-1)
+        pred_vector = self.out(output)  # [batch_size, 1, skill_num]
+        prediction = torch.gather(
+            pred_vector, dim=-1, index=items[:, idx : idx + 1].unsqueeze(dim=-1)
+        ).squeeze(dim=-1)
+
+        out_dict = {
+            "prediction": torch.sigmoid(prediction),
+            "label": labels[:, idx : idx + 1].double(),
+            "state": (h.detach(), c.detach()),
+        }
+        return out_dict
+
     def evaluate_cl(
         self,
         feed_dict: Dict[str, torch.Tensor],
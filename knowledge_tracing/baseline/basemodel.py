@@ -39,6 +39,7 @@ class BaseModel(torch.nn.Module):
     @staticmethod
     def parse_model_args(
         parser: argparse.ArgumentParser,
+        model_name: str = "BaseModel",
     ):
         parser.add_argument(
             "--model_path", type=str, default="", help="Model save path."
@@ -542,9 +543,7 @@ class BaseLearnerModel(BaseModel):
         self.num_seq = batch_size
 
         # Set initial state x0 for simulation
-        x0 = torch.zeros((batch_size, self.num_node), requires_grad=True).to(
-            labels.device
-        )
+        x0 = torch.zeros((batch_size, self.num_node), device=labels.device)
         if self.num_node > 1:
             x0[torch.arange(batch_size), skills[:, 0]] += labels[:, 0]
             items = skills
@@ -4,6 +4,8 @@ from typing import List, Dict, Optional
 
 from pathlib import Path
 
+import pandas as pd
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
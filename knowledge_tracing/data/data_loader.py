@@ -91,11 +91,11 @@ class DataReader(object):
             df = user_df[: self.max_step]
 
             # TODO current only work with binary correct
-            df = df.groupby("skill_id").apply(
-                lambda x: x.assign(
-                    num_history=np.arange(len(x)),
-                    num_success=x["correct"].cumsum(),
-                )
+            # per-skill running counts; keeps the time order of the rows
+            skill_groups = df.groupby("skill_id")
+            df = df.assign(
+                num_history=skill_groups.cumcount(),
+                num_success=skill_groups["correct"].cumsum(),
             )
             df["num_success"] = np.maximum(df["num_success"] - 1, 0)
             df["num_failure"] = df["num_history"] - df["num_success"]
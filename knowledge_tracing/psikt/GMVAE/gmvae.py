@@ -20,12 +20,28 @@ DIM = 64
 
 
 class InferenceNet(nn.Module):
-    def __init__(self, in_dim, latent_dim, cate_dim, time_step):
+    """
+    Inference network q(category|history) q(s|history, category) of the GMVAE.
+
+    Args:
+        in_dim (int): Dimensionality of the embeddings of the history.
+        latent_dim (int): Dimensionality of s.
+        cate_dim (int): Number of categories.
+        time_step (int): Length of the histories, read by q(category|history) as one
+            flattened vector.
+        pooling (bool): If True, q(category|history) reads the mean of per-step features
+            instead, so that it accepts histories of any length with parameters independent
+            of it, and its input can be accumulated one step at a time (see qyx_features).
+    """
+
+    def __init__(self, in_dim, latent_dim, cate_dim, time_step, pooling=False):
         super(InferenceNet, self).__init__()
+        self.pooling = pooling
+        self.feature_dim = DIM
 
         # q(class|input)
         self.inference_qyx = torch.nn.ModuleList([
-            nn.Linear(in_dim * time_step, DIM),
+            nn.Linear(in_dim if pooling else in_dim * time_step, DIM),
             nn.LeakyReLU(0.2),
             nn.Linear(DIM, DIM),
             nn.LeakyReLU(0.2),
@@ -41,18 +57,17 @@ class InferenceNet(nn.Module):
             Gaussian(in_dim, latent_dim)
         ])
 
-    # q(y|x) -> q(category|emb_history)
-    def qyx(self, x, temperature, hard):
-        num_layers = len(self.inference_qyx)
-        
-        for i, layer in enumerate(self.inference_qyx):
-            if i == num_layers - 1:
-                #last layer is gumbel softmax
-                x = layer(x, temperature, hard)
-            else:
-                x = layer(x)
+    # features of q(y|x): of every step [bs, seq_len, DIM] with pooling, else of the flattened history
+    def qyx_features(self, x):
+        for layer in self.inference_qyx[:-1]:
+            x = layer(x)
         return x
 
+    # q(y|x) -> q(category|features of emb_history)
+    def qyx(self, features, temperature, hard):
+        #last layer is gumbel softmax
+        return self.inference_qyx[-1](features, temperature, hard)
+
     # q(z|x,y) -> q(s|emb_history, category)
     def qzxy(self, x, y):
         concat = torch.cat((x, y), dim=-1)  
@@ -61,8 +76,19 @@ class InferenceNet(nn.Module):
         return concat
   
     def forward(self, inputs, temperature=1.0, hard=0, time_dependent_s=True):
-        input_faltten = inputs.reshape(inputs.size(0), -1) 
-        w_logits, w_prob, w_sample = self.qyx(input_faltten, temperature, hard) # [bs, num_categories]
+        if self.pooling:
+            features = self.qyx_features(inputs).mean(1)
+        else:
+            input_faltten = inputs.reshape(inputs.size(0), -1) 
+            features = self.qyx_features(input_faltten)
+        return self.posterior(features, inputs, temperature, hard, time_dependent_s)
+
+    def posterior(self, features, inputs, temperature=1.0, hard=0, time_dependent_s=True):
+        """
+        q(category|history) from the (pooled) features of q(y|x), and q(s|inputs, category) of
+        every step of inputs.
+        """
+        w_logits, w_prob, w_sample = self.qyx(features, temperature, hard) # [bs, num_categories]
 
         if time_dependent_s:
             w_sample_mc = w_sample.unsqueeze(1).repeat(1,inputs.shape[1],1)
@@ -3,4 +3,7 @@ EPS = 1e-6
 T_SCALE = 60
 T_SCALE = 60*60*24*1000
 
-COV_MIN = 0.05
\ No newline at end of file
+COV_MIN = 0.05
+
+# Largest condition number of the graph eigenbasis the parallel rollout relies on
+MAX_EIGENBASIS_COND = 1e4
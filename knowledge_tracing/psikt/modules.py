@@ -5,6 +5,264 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Dropout, Linear, Module, Sequential
+from torch import distributions
+
+# Noise of the reparameterized samples, see standard_normal_noise
+SAMPLERS = ["mc", "antithetic", "qmc"]
+
+
+def standard_normal_noise(
+    shape: torch.Size,
+    sampler: str = "mc",
+    dtype: torch.dtype = None,
+    device: torch.device = None,
+) -> torch.Tensor:
+    """
+    Standard normal noise for reparameterized samples, with the samples along the first
+    dimension of `shape`.
+
+    - mc: independent draws.
+    - antithetic: pairs (eps, -eps) (the last draw is independent for an odd number of
+      samples), which cancels the odd part of the estimated function: nearly linear
+      functions of the noise such as the predicted probabilities gain most, while the
+      even, quadratic part of Gaussian log-likelihoods is not reduced.
+    - qmc: randomized quasi-Monte Carlo. The samples of every index are a scrambled Sobol
+      sequence over the last dimension, shifted modulo 1 by an independent uniform vector
+      per index and mapped by the inverse normal CDF (computed in place, as it costs
+      more than drawing the normal noise). Every draw is still N(0, 1), so the
+      estimates stay unbiased; powers of 2 of samples are stratified best.
+
+    Args:
+        shape: [num_sample, ..., dim]
+        sampler: one of SAMPLERS
+
+    Returns:
+        The noise, of the given shape.
+    """
+    if sampler == "mc":
+        return torch.randn(shape, dtype=dtype, device=device)
+    num_sample = shape[0]
+    if sampler == "antithetic":
+        eps = torch.randn(
+            (num_sample // 2,) + tuple(shape[1:]), dtype=dtype, device=device
+        )
+        extra = torch.randn(
+            (num_sample % 2,) + tuple(shape[1:]), dtype=dtype, device=device
+        )
+        return torch.cat([eps, -eps, extra])
+    if sampler == "qmc":
+        dim = shape[-1]
+        if dim > torch.quasirandom.SobolEngine.MAXDIM:
+            raise ValueError(
+                "Sobol sequences have at most {} dimensions, got {}".format(
+                    torch.quasirandom.SobolEngine.MAXDIM, dim
+                )
+            )
+        seed = int(torch.randint(2**31 - 1, ()))
+        points = torch.quasirandom.SobolEngine(dim, scramble=True, seed=seed).draw(
+            num_sample
+        )  # [num_sample, dim]
+        points = points.to(device=device, dtype=dtype or torch.get_default_dtype())
+        shift = torch.rand(shape[1:], dtype=points.dtype, device=device)
+        noise = points.view((num_sample,) + (1,) * (len(shape) - 2) + (dim,)) + shift
+        noise.frac_().clamp_(1e-6, 1 - 1e-6)
+        return noise.mul_(2).sub_(1).erfinv_().mul_(math.sqrt(2))
+    raise ValueError(
+        "Unknown sampler: {}, expected one of {}".format(sampler, SAMPLERS)
+    )
+
+
+class DiagonalNormal(distributions.Independent):
+    """
+    A multivariate Gaussian with a diagonal scale, i.e. the distribution
+    `MultivariateNormal(loc, scale_tril=torch.diag_embed(scale))`, stored as the vector of
+    standard deviations instead of a [..., dim, dim] matrix.
+
+    log_prob, rsample and entropy cost O(dim) in memory and compute instead of O(dim^2).
+    They follow the computations of MultivariateNormal, so the results match it up to
+    floating-point rounding (samples drawn with the same random state are identical).
+    `scale_tril` and `covariance_matrix` are still available for code that needs the
+    dense matrices; they are built on access.
+
+    Args:
+        loc: the mean of the distribution, [..., dim]
+        scale: the standard deviations, broadcastable to loc
+    """
+
+    def __init__(
+        self,
+        loc: torch.Tensor,
+        scale: torch.Tensor,
+        validate_args: bool = None,
+    ) -> None:
+        super().__init__(
+            distributions.Normal(loc, scale, validate_args=validate_args),
+            1,
+            validate_args=validate_args,
+        )
+
+    @property
+    def loc(self) -> torch.Tensor:
+        return self.base_dist.loc
+
+    @property
+    def scale(self) -> torch.Tensor:
+        return self.base_dist.scale
+
+    @property
+    def scale_tril(self) -> torch.Tensor:
+        return torch.diag_embed(self.scale)
+
+    @property
+    def covariance_matrix(self) -> torch.Tensor:
+        return torch.diag_embed(self.scale * self.scale)
+
+    def rsample(
+        self, sample_shape: torch.Size = torch.Size(), sampler: str = "mc"
+    ) -> torch.Tensor:
+        """
+        Reparameterized samples loc + scale * eps, with the noise eps of `sampler` (see
+        standard_normal_noise) along the single dimension of sample_shape.
+        """
+        if sampler == "mc":
+            return super().rsample(sample_shape)
+        shape = self._extended_shape(sample_shape)
+        eps = standard_normal_noise(shape, sampler, self.loc.dtype, self.loc.device)
+        return self.loc + eps * self.scale
+
+    def sample(
+        self, sample_shape: torch.Size = torch.Size(), sampler: str = "mc"
+    ) -> torch.Tensor:
+        if sampler == "mc":
+            return super().sample(sample_shape)
+        with torch.no_grad():
+            return self.rsample(sample_shape, sampler)
+
+    def _half_log_det(self) -> torch.Tensor:
+        return self.scale.log().sum(-1)
+
+    def log_prob(self, value: torch.Tensor) -> torch.Tensor:
+        if self._validate_args:
+            self._validate_sample(value)
+        diff = value - self.loc
+        mahalanobis = (diff / self.scale).pow(2).sum(-1)
+        return (
+            -0.5 * (self.event_shape[0] * math.log(2 * math.pi) + mahalanobis)
+            - self._half_log_det()
+        )
+
+    def entropy(self) -> torch.Tensor:
+        return (
+            0.5 * self.event_shape[0] * (1.0 + math.log(2 * math.pi))
+            + self._half_log_det()
+        )
+
+
+def expected_log_prob(
+    q_dist: DiagonalNormal,
+    p_dist: distributions.Distribution,
+) -> torch.Tensor:
+    """
+    Closed form of E_q[log p(x)] for a diagonal Gaussian q and a Gaussian p, i.e. the
+    negative cross-entropy -KL(q || p) - H(q).
+
+    Args:
+        q_dist: the distribution the expectation is taken over
+        p_dist: a DiagonalNormal or a MultivariateNormal with the same event shape
+
+    Returns:
+        The expected log-probability, with the broadcast batch shape of q and p.
+    """
+    dim = q_dist.event_shape[0]
+    diff = q_dist.mean - p_dist.mean
+    q_var = q_dist.variance
+
+    if isinstance(p_dist, DiagonalNormal):
+        p_var = p_dist.variance
+        mahalanobis = ((q_var + diff * diff) / p_var).sum(-1)
+        half_log_det = p_dist.scale.log().sum(-1)
+    elif isinstance(p_dist, distributions.MultivariateNormal):
+        # (m_q - m_p)' S_p^-1 (m_q - m_p) + tr(S_p^-1 S_q) with S_p = L L'
+        scale_tril = p_dist.scale_tril
+        batch_shape = torch.broadcast_shapes(diff.shape[:-1], scale_tril.shape[:-2])
+        scale_tril = scale_tril.expand(batch_shape + (dim, dim))
+        solved_diff = torch.linalg.solve_triangular(
+            scale_tril, diff.expand(batch_shape + (dim,)).unsqueeze(-1), upper=False
+        )
+        solved_scale = torch.linalg.solve_triangular(
+            scale_tril,
+            torch.diag_embed(q_var.sqrt()).expand_as(scale_tril),
+            upper=False,
+        )
+        mahalanobis = solved_diff.pow(2).sum((-2, -1)) + solved_scale.pow(2).sum(
+            (-2, -1)
+        )
+        half_log_det = scale_tril.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+    else:
+        raise NotImplementedError("No closed form for {}".format(type(p_dist).__name__))
+
+    return -0.5 * (dim * math.log(2 * math.pi) + mahalanobis) - half_log_det
+
+
+def matrix_powers(matrix: torch.Tensor, num_power: int) -> torch.Tensor:
+    """
+    All powers I, H, H^2, ..., H^num_power of a square matrix, by repeated doubling, i.e.
+    with O(log(num_power)) batched matrix products instead of num_power sequential ones.
+
+    Args:
+        matrix: the matrix H, of shape [dim, dim]
+        num_power: the highest power
+
+    Returns:
+        The powers, of shape [num_power + 1, dim, dim].
+    """
+    powers = torch.eye(
+        matrix.shape[-1], dtype=matrix.dtype, device=matrix.device
+    ).unsqueeze(0)
+    doubling = matrix  # H^len(powers)
+    while powers.shape[0] <= num_power:
+        powers = torch.cat([powers, powers @ doubling])
+        doubling = doubling @ doubling
+    return powers[: num_power + 1]
+
+
+def affine_scan(
+    a: torch.Tensor,
+    b: torch.Tensor,
+    x0: torch.Tensor = None,
+    dim: int = 1,
+) -> torch.Tensor:
+    """
+    Solve the elementwise linear recursion x_t = a_t * x_{t-1} + b_t for all t = 1..T at once,
+    with an associative (Hillis-Steele) scan over the pairs (a_t, b_t): O(log T) batched
+    operations instead of T sequential steps, at the price of O(T log T) work.
+
+    Args:
+        a: the multiplicative terms, of shape [..., T, ...] along dim
+        b: the additive terms, broadcastable with a
+        x0: the initial value x_0, of size 1 along dim; zero if None
+        dim: the time dimension
+
+    Returns:
+        x_1, ..., x_T, stacked along dim.
+    """
+    a, b = torch.broadcast_tensors(a, b)
+    num_step = a.shape[dim]
+    if x0 is not None:
+        # fold x_0 into the first step: x_1 = a_1 x_0 + b_1
+        first = a.narrow(dim, 0, 1) * x0 + b.narrow(dim, 0, 1)
+        b = torch.cat([first, b.narrow(dim, 1, num_step - 1)], dim)
+
+    offset = 1
+    while offset < num_step:
+        length = num_step - offset
+        a_prev, b_prev = a.narrow(dim, 0, length), b.narrow(dim, 0, length)
+        a_next, b_next = a.narrow(dim, offset, length), b.narrow(dim, offset, length)
+        # (a_prev, b_prev) followed by (a_next, b_next) = (a_next a_prev, a_next b_prev + b_next)
+        b = torch.cat([b.narrow(dim, 0, offset), a_next * b_prev + b_next], dim)
+        a = torch.cat([a.narrow(dim, 0, offset), a_next * a_prev], dim)
+        offset *= 2
+    return b
 
 
 class VAEEncoder(nn.Module):
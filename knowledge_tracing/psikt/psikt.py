@@ -1,4 +1,4 @@
-import math, argparse
+import math, argparse, itertools
 from typing import List, Dict, Tuple, Optional
 from collections import defaultdict
 
@@ -9,11 +9,24 @@ import torch
 from torch import nn, distributions
 from torch.nn import functional as F
 
-from knowledge_tracing.psikt import T_SCALE, EPS, COV_MIN
-from knowledge_tracing.psikt.modules import build_dense_network, VAEEncoder
+from knowledge_tracing.psikt import T_SCALE, EPS, COV_MIN, MAX_EIGENBASIS_COND
+from knowledge_tracing.psikt.modules import (
+    build_dense_network,
+    VAEEncoder,
+    DiagonalNormal,
+    expected_log_prob,
+    matrix_powers,
+    affine_scan,
+)
 from knowledge_tracing.psikt.psikt_graph_representation import VarTransformation
+from knowledge_tracing.psikt.state_store import (
+    LearnerStateStore,
+    WindowedStateBuffers,
+    STATE_VAR_DTYPES,
+)
 from knowledge_tracing.psikt.GMVAE.gmvae import *
 from knowledge_tracing.utils.logger import Logger
+from knowledge_tracing.utils.diagnostics import DiagnosticsCapture
 from knowledge_tracing.baseline.basemodel import BaseModel
 
 
@@ -48,6 +61,7 @@ class PSIKT(BaseModel):
         self.device = device
         self.args = args
         self.num_sample = args.num_sample
+        self.sampler = args.sampler
         self.var_log_max = torch.tensor(args.var_log_max)
 
         # Set the device to use for computations
@@ -56,9 +70,52 @@ class PSIKT(BaseModel):
         # Store the arguments and logs for later use
         self.args = args
         self.logs = logs
+        # Debugging tensors are only recorded for the steps selected in the logger
+        self.diagnostics = (
+            logs.diagnostics if hasattr(logs, "diagnostics") else DiagnosticsCapture()
+        )
 
         BaseModel.__init__(self, model_path=Path(args.log_path, "Model"))
 
+        # sin/cos time encodings, see get_time_embedding; derived, so not saved
+        self.register_buffer(
+            "time_frequencies",
+            self._time_frequencies(self.node_dim).to(self.device),
+            persistent=False,
+        )
+        self.register_buffer(
+            "relative_time_table",
+            self._positional_encoding1d(
+                self.node_dim, args.max_step, frequencies=self.time_frequencies
+            ),
+            persistent=False,
+        )
+
+    # Debugging tensors that earlier versions registered as buffers in every forward pass;
+    # they are reported to DiagnosticsCapture now and skipped when loading old checkpoints
+    LEGACY_DIAGNOSTIC_BUFFERS = (
+        "ps_mean",
+        "ps_cov_mat",
+        "pz_decay",
+        "pz_empower",
+        "pz_empowered_mu",
+        "pz_mean",
+        "pz_var",
+        "qs_category",
+        "qz_mean",
+        "qz_var",
+        "output_emb_input",
+        "pred_y_all_sampled",
+        "pred_y_sampled",
+        "output_items",
+        "pred_z_sampled",
+    )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for name in self.LEGACY_DIAGNOSTIC_BUFFERS:
+            state_dict.pop(prefix + name, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @staticmethod
     def _normalize_timestamps(
         timestamps: torch.Tensor,
@@ -105,42 +162,50 @@ class PSIKT(BaseModel):
         return dist
 
     @staticmethod
-    def _positional_encoding1d(dim: int, length: int, actual_time=None) -> torch.Tensor:
+    def _time_frequencies(dim: int) -> torch.Tensor:
+        """
+        Frequencies of the sin/cos positional encoding, each repeated for the sin (even)
+        and cos (odd) dimension.
+
+        Returns:
+            [dim] frequencies
+        """
+        if dim % 2 != 0:
+            raise ValueError(
+                "Cannot use sin/cos positional encoding with "
+                "odd dim (got dim={:d})".format(dim)
+            )
+        return torch.exp(
+            torch.arange(0, dim, 2, dtype=torch.float) * -(math.log(10000.0) / dim)
+        ).repeat_interleave(2)
+
+    @staticmethod
+    def _positional_encoding1d(
+        dim: int,
+        length: int,
+        actual_time: torch.Tensor = None,
+        frequencies: torch.Tensor = None,
+    ) -> torch.Tensor:
         """
         Modified based on https://github.com/wzlxjtu/PositionalEncoding2D
         Args:
             d_model: dimension of the model
             length: length of positions
+            actual_time: [bs, length] times to encode; the positions 0..length-1 if None
+            frequencies: the output of _time_frequencies(dim), computed if None
 
         Returns:
-            length*d_model position matrix
+            length*d_model position matrix ([bs, length, d_model] for actual_time)
         """
-        if actual_time == None:
-            position = torch.arange(0, length).unsqueeze(1)
-
+        if frequencies is None:
+            frequencies = PSIKT._time_frequencies(dim)
+        if actual_time is None:
+            position = torch.arange(0, length, device=frequencies.device)
         else:
-            device = actual_time.device
-            if dim % 2 != 0:
-                raise ValueError(
-                    "Cannot use sin/cos positional encoding with "
-                    "odd dim (got dim={:d})".format(dim)
-                )
-            pe = torch.zeros(actual_time.shape[0], length, dim, device=device)
-            position = actual_time.unsqueeze(-1)  # [bs, times, 1]
-
-        div_term = (
-            torch.exp(
-                (
-                    torch.arange(0, dim, 2, dtype=torch.float)
-                    * -(math.log(10000.0) / dim)
-                )
-            )
-            .reshape(1, 1, -1)
-            .to(device)
-        )
-        pe[..., 0::2] = torch.sin(position.float() * div_term)
-        pe[..., 1::2] = torch.cos(position.float() * div_term)
-
+            position = actual_time
+        pe = position.float().unsqueeze(-1) * frequencies.to(position.device)
+        pe[..., 0::2].sin_()
+        pe[..., 1::2].cos_()
         return pe
 
     def get_time_embedding(
@@ -152,8 +217,9 @@ class PSIKT(BaseModel):
         Get time embeddings based on the given time tensor.
         Args:
             time (torch.Tensor): Input time tensor of shape [bs, times, ...].
-            type (str): Type of time embedding to compute. Can be 'dt' for time differences
-                        or 'absolute' for absolute time values. Defaults to 'dt'.
+            type (str): Type of time embedding to compute. Can be 'dt' for time differences,
+                        'absolute' for absolute time values or 'relative' for the positions
+                        in the sequence. Defaults to 'dt'.
 
         Returns:
             torch.Tensor: Time embeddings of shape [bs, times, dim].
@@ -161,17 +227,28 @@ class PSIKT(BaseModel):
         Note:
             The 'dt' option computes time differences by taking the differences between consecutive
             time steps. The 'absolute' option uses the original time values as time embeddings.
+            Both multiply the times with the cached frequencies; the 'relative' embeddings are
+            read from a table of max_step positions, extended for longer sequences.
 
         """
         if type == "dt":
             dt = torch.diff(time, dim=1)
             t_pe = self._positional_encoding1d(
-                self.node_dim, dt.shape[1], dt
+                self.node_dim, dt.shape[1], dt, self.time_frequencies
             )  # [bs, times, dim]
         elif type == "absolute":
             norm_t = time
             t_pe = self._positional_encoding1d(
-                self.node_dim, time.shape[1], norm_t
+                self.node_dim, time.shape[1], norm_t, self.time_frequencies
+            )  # [bs, times, dim]
+        elif type == "relative":
+            length = time.shape[1]
+            if length > self.relative_time_table.shape[0]:
+                self.relative_time_table = self._positional_encoding1d(
+                    self.node_dim, length, frequencies=self.time_frequencies
+                )
+            t_pe = self.relative_time_table[:length].expand(
+                time.shape[0], -1, -1
             )  # [bs, times, dim]
         return t_pe
 
@@ -339,7 +416,11 @@ class AmortizedPSIKT(PSIKT):
             latent_dim=self.node_dim,
             tau_gumbel=1,
             dense_init=False,
+            topk=self.args.graph_topk,
+            refresh_every=self.args.graph_refresh,
         )
+        # (adjacency, eigendecomposition) of the last expected graph, see predictive_rollout
+        self._graph_eigen = None
 
         # --------------- for parameters Theta ---------------
         # the initial distribution p(s0) p(z0), the transition distribution p(s|s') p(z|s,z'), the emission distribution p(y|s,z)
@@ -370,7 +451,11 @@ class AmortizedPSIKT(PSIKT):
 
         # ----- 2. variational posterior distribution q(s_1:t | y_1:t, c_1:t) = q(s_1:t | emb_1:t) -----
         self.infer_network_posterior_s = InferenceNet(
-            self.node_dim, self.dim_s, self.num_category, time_step
+            self.node_dim,
+            self.dim_s,
+            self.num_category,
+            time_step,
+            pooling=bool(self.args.qs_pooling),
         )
 
         # ----- 3. variational posterior distribution q(z_1:t | y_1:t, c_1:t) -----
@@ -408,7 +493,7 @@ class AmortizedPSIKT(PSIKT):
 
     def st_transition_gen(
         self,
-        qs_dist: distributions.MultivariateNormal,
+        qs_dist: DiagonalNormal,
         eval: bool = False,
     ) -> distributions.MultivariateNormal:
         """
@@ -419,7 +504,7 @@ class AmortizedPSIKT(PSIKT):
         transitions are returned as a new multivariate normal distribution.
 
         Args:
-            qs_dist (MultivariateNormal): A multivariate normal distribution representing
+            qs_dist (DiagonalNormal): A diagonal Gaussian distribution representing
                 the initial states. It contains mean and covariance information.
             eval (bool): A flag indicating whether to perform evaluation mode (default: False).
 
@@ -460,8 +545,7 @@ class AmortizedPSIKT(PSIKT):
         )
 
         if not eval:  # For debugging
-            self.register_buffer("ps_mean", ps_mean.clone().detach())
-            self.register_buffer("ps_cov_mat", ps_cov_mat.clone().detach())
+            self.diagnostics.capture(ps_mean=ps_mean, ps_cov_mat=ps_cov_mat)
 
         return ps_dist
 
@@ -469,8 +553,8 @@ class AmortizedPSIKT(PSIKT):
         self,
         feed_dict: Dict[str, torch.Tensor],
         idx: int = 0,
-        qs_dist: distributions.MultivariateNormal = None,
-        qz_dist: distributions.MultivariateNormal = None,
+        qs_dist: DiagonalNormal = None,
+        qz_dist: DiagonalNormal = None,
         eval: bool = False,
         qs_sampled: torch.Tensor = None,
     ):
@@ -484,13 +568,13 @@ class AmortizedPSIKT(PSIKT):
         Args:
             feed_dict (Dict[str, torch.Tensor]): A dictionary containing input data tensors.
             idx (int, optional): An index parameter used to limit the number of time steps (default: 0).
-            qs_dist (MultivariateNormal, optional): A multivariate normal distribution representing the latent variables qs (default: None).
-            qz_dist (MultivariateNormal, optional): A multivariate normal distribution representing the latent variables qz (default: None).
+            qs_dist (DiagonalNormal, optional): A diagonal Gaussian distribution representing the latent variables qs (default: None).
+            qz_dist (DiagonalNormal, optional): A diagonal Gaussian distribution representing the latent variables qz (default: None).
             eval (bool, optional): A flag indicating whether to perform evaluation mode (default: False).
             qs_sampled (torch.Tensor, optional): A tensor representing sampled qs values (default: None).
 
         Returns:
-            MultivariateNormal: A multivariate normal distribution representing the state transitions.
+            DiagonalNormal: A diagonal Gaussian distribution representing the state transitions.
                 It contains mean and covariance information for the generated states.
         """
         if idx:
@@ -524,10 +608,10 @@ class AmortizedPSIKT(PSIKT):
         # exp(-alpha * dt)
         pz_ou_decay = torch.exp(-q_alpha * dt)  # [bs, num_steps-1, 1]
         # empower^{\ell,k}_n = gamma^\ell_n * \sum_{i=1}^K (a^{ik} * (z^{\ell,k}_{n-1})) * (1/num_node)
-        pz_graph_adj = (
-            self.node_dist.sample_A(self.num_sample)[-1][:, 0].mean(0).to(device)
+        pz_graph_empower = self.node_dist.empowerment(
+            self.num_sample
         )  # adj_ij means i has influence on j
-        pz_empower = q_gamma * (qz_mean @ pz_graph_adj) / self.num_node
+        pz_empower = q_gamma * pz_graph_empower(qz_mean) / self.num_node
         # mu^{\ell,k}_n = q_mu^\ell_n + empower^{\ell,k}_n
         pz_empowered_mu = q_mu + pz_empower  # [bs, time-1, num_node]
 
@@ -551,21 +635,16 @@ class AmortizedPSIKT(PSIKT):
             1, 1, self.num_node
         )  # [bs, time, num_node]
 
-        pz_dist = distributions.MultivariateNormal(
-            loc=pz_mean, scale_tril=torch.tril(torch.diag_embed(pz_var + EPS))
-        )
-
-        if qs_sampled is None:
-            samples = qs_dist.rsample((self.num_sample,))  # [n, bs, time, dim_s]
-            qs_sampled = samples.transpose(1, 0).reshape(bsn, 1, num_steps, self.dim_s)
+        pz_dist = DiagonalNormal(loc=pz_mean, scale=pz_var + EPS)
 
         if not eval:
-            self.register_buffer("pz_decay", pz_ou_decay.clone().detach())
-            self.register_buffer("pz_empower", pz_empower.clone().detach())
-            self.register_buffer("pz_empowered_mu", pz_empowered_mu.clone().detach())
-
-            self.register_buffer(name="pz_mean", tensor=pz_mean.clone().detach())
-            self.register_buffer(name="pz_var", tensor=pz_var.clone().detach())
+            self.diagnostics.capture(
+                pz_decay=pz_ou_decay,
+                pz_empower=pz_empower,
+                pz_empowered_mu=pz_empowered_mu,
+                pz_mean=pz_mean,
+                pz_var=pz_var,
+            )
 
         return pz_dist
 
@@ -574,7 +653,8 @@ class AmortizedPSIKT(PSIKT):
         emb_inputs: torch.Tensor,
         num_sample: int = 0,
         eval: bool = False,
-    ) -> torch.distributions.MultivariateNormal:
+        carry: Dict[str, torch.Tensor] = None,
+    ) -> DiagonalNormal:
         """
         Perform state transition inference.
 
@@ -582,29 +662,46 @@ class AmortizedPSIKT(PSIKT):
             emb_inputs (torch.Tensor): Embedding inputs with dtype torch.Tensor.
             num_sample (int, optional): Number of samples (default: 0).
             eval (bool, optional): Flag to indicate evaluation mode (default: False).
+            carry (Dict[str, torch.Tensor], optional): State of the earlier chunks of the
+                sequences (see `forward`), updated in place; the category is inferred
+                from the pooled features of all the steps up to this chunk.
 
         Returns:
-            torch.distributions.MultivariateNormal: Multivariate Gaussian distribution.
+            DiagonalNormal: Diagonal Gaussian distribution.
         """
 
         num_sample = self.num_sample if num_sample == 0 else num_sample
 
-        qs_out_inf = self.infer_network_posterior_s(
-            emb_inputs,
-            self.qs_temperature,
-            self.qs_hard,
-        )
+        if carry is not None:
+            network = self.infer_network_posterior_s
+            feature_sum = network.qyx_features(emb_inputs).sum(1)
+            if "qs_feature_sum" in carry:
+                feature_sum = feature_sum + carry["qs_feature_sum"]
+            carry["qs_feature_sum"] = feature_sum
+            carry["num_obs"] = carry.get("num_obs", 0) + emb_inputs.shape[1]
+            qs_out_inf = network.posterior(
+                feature_sum / carry["num_obs"],
+                emb_inputs,
+                self.qs_temperature,
+                self.qs_hard,
+            )
+        else:
+            qs_out_inf = self.infer_network_posterior_s(
+                emb_inputs,
+                self.qs_temperature,
+                self.qs_hard,
+            )
 
         s_category = qs_out_inf["categorical"]  # [bs, 1, num_cat]
+        # logits and probabilities of the category; used by the categorical loss
+        self.logits = qs_out_inf["logits"]  # [bs, 1, num_cat]
+        self.probs = qs_out_inf["prob_cat"]  # [bs, 1, num_cat]
         s_mean = qs_out_inf["s_mu_infer"]  # [bs, 1, time, dim_s]
         s_var = qs_out_inf["s_var_infer"]  # [bs, 1, time, dim_s]
 
-        s_var_mat = torch.diag_embed(s_var + EPS)  # [bs, 1, time, dim_s, dim_s]
-        qs_dist = distributions.MultivariateNormal(
-            loc=s_mean, scale_tril=torch.tril(s_var_mat)
-        )
+        qs_dist = DiagonalNormal(loc=s_mean, scale=s_var + EPS)
 
-        self.register_buffer("qs_category", s_category.clone().detach())
+        self.diagnostics.capture(qs_category=s_category)
 
         return qs_dist
 
@@ -613,7 +710,8 @@ class AmortizedPSIKT(PSIKT):
         feed_dict: Tuple[torch.Tensor, torch.Tensor],
         emb_inputs: Optional[torch.Tensor] = None,
         eval: bool = False,
-    ) -> distributions.MultivariateNormal:
+        carry: Dict[str, torch.Tensor] = None,
+    ) -> DiagonalNormal:
         """
         Compute the posterior distribution of `z_t` using an inference network.
 
@@ -625,34 +723,35 @@ class AmortizedPSIKT(PSIKT):
             eval (bool, optional): A boolean flag indicating whether to run in evaluation mode.
                 Evaluation mode may change the behavior of certain operations like dropout.
                 Defaults to False.
+            carry (Dict[str, torch.Tensor], optional): State of the earlier chunks of the
+                sequences (see `forward`); the LSTM continues from its hidden state, which
+                is updated in place.
 
         Returns:
-            torch.distributions.MultivariateNormal: The posterior distribution of `z_t` with mean and covariance matrix.
-                The mean has shape [batch_size, times, num_node], and the covariance matrix has shape [batch_size, times, num_node, num_node].
+            DiagonalNormal: The posterior distribution of `z_t` with mean and standard deviation.
+                Both the mean and the standard deviation have shape [batch_size, times, num_node].
         """
 
         # Compute the output of the posterior network
-        self.infer_network_posterior_z.flatten_parameters()  # useful when using DistributedDataParallel (DDP)
-        qz_emb_out, _ = self.infer_network_posterior_z(
-            emb_inputs, None
+        if isinstance(self.infer_network_posterior_z, nn.LSTM):  # not when quantized
+            self.infer_network_posterior_z.flatten_parameters()  # useful when using DistributedDataParallel (DDP)
+        hidden = None if carry is None else carry.get("hidden_z")
+        qz_emb_out, hidden = self.infer_network_posterior_z(
+            emb_inputs, hidden
         )  # [bs, times, dim*2]
+        if carry is not None:
+            carry["hidden_z"] = hidden
 
         # Compute the mean and covariance matrix of the posterior distribution of `z_t`
         qz_mean, qz_log_var = self.infer_network_posterior_mean_var_z(qz_emb_out)
 
         qz_log_var = torch.minimum(qz_log_var, self.var_log_max.to(qz_log_var.device))
-        qz_cov_mat = torch.diag_embed(
-            torch.exp(qz_log_var) + EPS
-        )  # [bs, times, num_node, num_node]
-        qz_dist = distributions.MultivariateNormal(
-            loc=qz_mean, scale_tril=torch.tril(qz_cov_mat)
-        )  # [bs, times, num_node]; [bs, times, num_node, num_node]
+        qz_dist = DiagonalNormal(
+            loc=qz_mean, scale=torch.exp(qz_log_var) + EPS
+        )  # [bs, times, num_node]
 
-        if not eval:
-            self.register_buffer(name="qz_mean", tensor=qz_mean.clone().detach())
-            self.register_buffer(
-                name="qz_var", tensor=torch.exp(qz_log_var).clone().detach()
-            )
+        if not eval and self.diagnostics.active:
+            self.diagnostics.capture(qz_mean=qz_mean, qz_var=torch.exp(qz_log_var))
 
         return qz_dist
 
@@ -702,6 +801,7 @@ class AmortizedPSIKT(PSIKT):
         emb_history: torch.Tensor,
         feed_dict: Dict[str, torch.Tensor] = None,
         eval: bool = False,
+        carry: Dict[str, torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Perform the inference process to sample continuous hidden variables.
@@ -713,6 +813,8 @@ class AmortizedPSIKT(PSIKT):
             eval (bool, optional): A boolean flag indicating whether to run in evaluation mode.
                 Evaluation mode may change the behavior of certain operations like dropout.
                 Defaults to False.
+            carry (Dict[str, torch.Tensor], optional): State of the earlier chunks of the
+                sequences, see `forward`.
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: A tuple containing the sampled continuous hidden variables
@@ -720,35 +822,61 @@ class AmortizedPSIKT(PSIKT):
         """
 
         # sample continuous hidden variable from `q(s[1:T] | y[1:T])'
-        qs_dist = self.st_transition_infer(emb_inputs=emb_history, eval=eval)
+        qs_dist = self.st_transition_infer(
+            emb_inputs=emb_history, eval=eval, carry=carry
+        )
 
         # sample continuous hidden variable from `q(z[1:T] | y[1:T])'
         qz_dist = self.zt_transition_infer(
-            feed_dict=feed_dict, emb_inputs=emb_history, eval=eval
+            feed_dict=feed_dict, emb_inputs=emb_history, eval=eval, carry=carry
         )
 
         return qs_dist, qz_dist
 
     def generative_process(
         self,
-        qs_dist: distributions.MultivariateNormal,
-        qz_dist: distributions.MultivariateNormal,
+        qs_dist: DiagonalNormal,
+        qz_dist: DiagonalNormal,
         feed_dict: Dict[str, torch.Tensor] = None,
         eval: bool = False,
+        carry: Dict[str, torch.Tensor] = None,
     ) -> Tuple[distributions.MultivariateNormal, distributions.MultivariateNormal]:
         """
         Perform generative process.
 
         Args:
-            qs_dist (distributions.MultivariateNormal): Multivariate Gaussian distribution for s.
-            qz_dist (distributions.MultivariateNormal): Multivariate Gaussian distribution for z.
+            qs_dist (DiagonalNormal): Diagonal Gaussian distribution for s.
+            qz_dist (DiagonalNormal): Diagonal Gaussian distribution for z.
             feed_dict (Dict[str, torch.Tensor], optional): Dictionary of feed-forward tensors (default: None).
             eval (bool, optional): Flag to indicate evaluation mode (default: False).
+            carry (Dict[str, torch.Tensor], optional): State of the earlier chunks of the
+                sequences (see `forward`); their first steps are transitions from the last
+                posteriors of the previous chunk instead of p(s0) p(z0).
 
         Returns:
             Tuple[distributions.MultivariateNormal, distributions.MultivariateNormal]: Tuple of generative
             distributions for s and z.
         """
+        if carry is not None and "s_mean" in carry:
+            # prepend the last step of the previous chunk, and drop its priors
+            qs_dist = DiagonalNormal(
+                loc=torch.cat([carry["s_mean"], qs_dist.loc], dim=-2),
+                scale=torch.cat([carry["s_scale"], qs_dist.scale], dim=-2),
+            )
+            qz_dist = DiagonalNormal(
+                loc=torch.cat([carry["z_mean"], qz_dist.loc], dim=1),
+                scale=torch.cat([carry["z_scale"], qz_dist.scale], dim=1),
+            )
+            time = torch.cat([carry["time"], feed_dict["time_seq"]], dim=1)
+            ps_dist, pz_dist = self.generative_process(
+                qs_dist, qz_dist, dict(feed_dict, time_seq=time), eval=eval
+            )
+            ps_dist = distributions.MultivariateNormal(
+                loc=ps_dist.loc[:, :, 1:], scale_tril=ps_dist.scale_tril[:, :, 1:]
+            )
+            pz_dist = DiagonalNormal(loc=pz_dist.loc[:, 1:], scale=pz_dist.scale[:, 1:])
+            return ps_dist, pz_dist
+
         # generative model for s (Karman filter)
         ps_dist = self.st_transition_gen(qs_dist, eval=eval)
 
@@ -762,6 +890,7 @@ class AmortizedPSIKT(PSIKT):
     def forward(
         self,
         feed_dict: Dict[str, torch.Tensor],
+        carry: Dict[str, torch.Tensor] = None,
     ) -> Dict[str, torch.Tensor]:
         """
         Forward pass through the model.
@@ -770,10 +899,20 @@ class AmortizedPSIKT(PSIKT):
             feed_dict (Dict[str, torch.Tensor]): A dictionary containing input tensors,
                 including 'time_seq' (shape [batch_size, times]), 'label_seq' (shape [batch_size, times]),
                 and 'skill_seq' (shape [batch_size]).
+            carry (Dict[str, torch.Tensor], optional): For chunked training (see
+                `split_chunks`), a dictionary shared by the consecutive chunks of the
+                same sequences, empty for the first one. It is updated with the state of
+                the inference networks and the last posteriors of the chunk, so that the
+                posterior of z and the transitions across chunk boundaries match the
+                whole sequences. The category of s is inferred from the steps up to the
+                current chunk only (as in filtering), so the chunked objective is a
+                causal approximation of that of the whole sequences; only the last chunk
+                sees the category of the whole sequences. Requires `--qs_pooling`.
 
         Returns:
             Dict[str, torch.Tensor]: A dictionary containing the computed objective values.
         """
+        initial = carry is None or "s_mean" not in carry
 
         # Embed the input sequence
         t_train = feed_dict["time_seq"]
@@ -784,21 +923,30 @@ class AmortizedPSIKT(PSIKT):
         )
 
         # Compute the posterior distribution of `s_t` and `z_t`
-        qs_dist, qz_dist = self.inference_process(emb_history, feed_dict)
+        qs_dist, qz_dist = self.inference_process(emb_history, feed_dict, carry=carry)
 
         # Compute the prior distribution of `s_t` and `z_t`
-        ps_dist, pz_dist = self.generative_process(qs_dist, qz_dist, feed_dict)
+        ps_dist, pz_dist = self.generative_process(
+            qs_dist, qz_dist, feed_dict, carry=carry
+        )
 
         return_dict = self.get_objective_values(
             [qs_dist, qz_dist],
             [ps_dist, pz_dist],
             feed_dict,
+            initial=initial,
         )
 
-        self.register_buffer(
-            name="output_emb_input", tensor=emb_history.clone().detach()
-        )
-        return_dict = {}
+        if carry is not None:
+            carry.update(
+                s_mean=qs_dist.loc[:, :, -1:],
+                s_scale=qs_dist.scale[:, :, -1:],
+                z_mean=qz_dist.loc[:, -1:],
+                z_scale=qz_dist.scale[:, -1:],
+                time=feed_dict["time_seq"][:, -1:],
+            )
+
+        self.diagnostics.capture(output_emb_input=emb_history)
         return_dict["label"] = feed_dict["label_seq"]
         return_dict["item"] = feed_dict["skill_seq"]
         return_dict["time"] = feed_dict["time_seq"]
@@ -807,6 +955,176 @@ class AmortizedPSIKT(PSIKT):
 
         return return_dict
 
+    @staticmethod
+    def split_chunks(
+        feed_dict: Dict[str, torch.Tensor],
+        chunk_size: int,
+    ) -> List[Dict[str, torch.Tensor]]:
+        """
+        Split a batch along time into consecutive chunks of at most `chunk_size` steps,
+        to be passed in order to `forward` with a shared carry.
+
+        Args:
+            feed_dict (Dict[str, torch.Tensor]): The batch; the tensors with a time
+                dimension (the second one, as 'time_seq') are split, the others (e.g.
+                'user_id') are shared by the chunks.
+            chunk_size (int): The number of time steps of a chunk; a last chunk of a
+                single step is merged into the previous one.
+
+        Returns:
+            List[Dict[str, torch.Tensor]]: The chunks, views of the batch.
+        """
+        num_step = feed_dict["time_seq"].shape[1]
+        starts = list(range(0, num_step, chunk_size))
+        if len(starts) > 1 and num_step - starts[-1] < 2:
+            starts.pop()
+        chunks = []
+        for start, end in zip(starts, starts[1:] + [num_step]):
+            chunk = dict(feed_dict)
+            for key, value in feed_dict.items():
+                if (
+                    isinstance(value, torch.Tensor)
+                    and value.dim() > 1
+                    and value.shape[1] == num_step
+                ):
+                    chunk[key] = value[:, start:end]
+            chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def detach_carry(carry: Dict[str, torch.Tensor]) -> None:
+        """
+        Detach the carry of chunked training in place, truncating the backpropagation
+        through time at the end of the current chunk.
+
+        Args:
+            carry (Dict[str, torch.Tensor]): The carry updated by `forward`.
+        """
+        for key, value in carry.items():
+            if isinstance(value, tuple):
+                carry[key] = tuple(tensor.detach() for tensor in value)
+            elif isinstance(value, torch.Tensor):
+                carry[key] = value.detach()
+
+    def predictive_rollout(
+        self,
+        s_last_mean: torch.Tensor,
+        s_last_cov_mat: torch.Tensor,
+        z_last_mean: torch.Tensor,
+        dt: torch.Tensor,
+        parallel: bool = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Roll the generative model out from the last posterior, for all future steps at once.
+
+        The s-chain is linear-Gaussian, so step t has the closed form
+        p(st) = N(st | s0 H^t, H^t P0 H^t' + sum_{k<t} H^k R H^k'), computed from the powers
+        of H. Given the means of s, the means of z follow the affine recursion
+        zt = zt-1 (decay_t I + c_t A) + (1 - decay_t) mu_t, with c_t = (1 - decay_t) gamma_t / K.
+        In the eigenbasis of the expected adjacency A every node evolves independently, so
+        the recursion becomes elementwise and is solved with an associative scan. The scan
+        does O(T log T) work in O(log T) steps, which pays off where the T sequential steps
+        are bound by kernel launches (GPUs). The step-by-step recursion is used otherwise,
+        when gradients are needed (the derivatives of the eigendecomposition are unstable
+        for close eigenvalues), for top-k graphs, and for ill-conditioned eigenbases.
+
+        Args:
+            s_last_mean (torch.Tensor): Mean of the last s, of shape [bs, 1, dim_s].
+            s_last_cov_mat (torch.Tensor): Covariance of the last s, of shape [bs, 1, dim_s, dim_s].
+            z_last_mean (torch.Tensor): Mean of the last z, of shape [bs, 1, num_node].
+            dt (torch.Tensor): Scaled time intervals of the future steps, of shape [bs, time, 1].
+            parallel (bool, optional): Whether the z recursion may be solved with the
+                associative scan (default: on GPUs only).
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: The means
+                [bs, time, dim_s] and covariances [bs, time, dim_s, dim_s] of s, and the means
+                and variances [bs, time, num_node] of z.
+        """
+        test_step = dt.shape[1]
+
+        # p(st-1) = N(m, P), p(st|st-1) = N(st|H*st-1 + b, R)
+        # p(st) = N(st|H*m + b, H*P*H' + R)
+        st_tran_r = torch.diag_embed(torch.exp(self.gen_st_log_r) + EPS)
+        h_powers = matrix_powers(self.gen_st_h, test_step)  # [time+1, dim_s, dim_s]
+        h_next = h_powers[1:]
+        # [bs, 1, 1, dim_s] @ [time, dim_s, dim_s] -> [bs, time, dim_s]
+        pred_s_mean = (s_last_mean.unsqueeze(1) @ h_next).squeeze(2)
+        tran_cov_mat = torch.cumsum(
+            h_powers[:-1] @ st_tran_r @ h_powers[:-1].transpose(-1, -2), dim=0
+        )  # [time, dim_s, dim_s]
+        pred_s_cov_mat = (
+            h_next @ s_last_cov_mat @ h_next.transpose(-1, -2) + tran_cov_mat
+        )  # [bs, time, dim_s, dim_s]
+
+        # p(zt) = N(zt|zt-1, st)
+        q_alpha = torch.relu(pred_s_mean[..., 0:1]) + EPS
+        q_mu = pred_s_mean[..., 1:2]
+        q_sigma = pred_s_mean[..., 2:3]  # [bs, time, 1]
+        q_gamma = torch.sigmoid(pred_s_mean[..., 3:4])
+        pz_ou_decay = torch.exp(-q_alpha * dt)  # [bs, time, 1]
+        pz_ou_var = (
+            q_sigma * q_sigma * (1 - pz_ou_decay * pz_ou_decay) / (2 * q_alpha + EPS)
+        )  # [bs, time, 1]
+        pred_z_var = pz_ou_var.repeat(1, 1, self.num_node)  # [bs, time, num_node]
+
+        eigen = None
+        if parallel is None:
+            parallel = z_last_mean.is_cuda
+        if parallel and not torch.is_grad_enabled() and not self.node_dist.topk:
+            eigen = self._graph_eigenbasis(z_last_mean.device)
+
+        if eigen is None:
+            pz_graph_empower = self.node_dist.empowerment(
+                self.num_sample
+            )  # adj_ij means i has influence on j
+            pred_z_mean = []
+            for i in range(test_step):
+                pz_empower = pz_graph_empower(z_last_mean) / self.num_node
+                pz_empower = pz_empower * q_gamma[:, i : i + 1]
+                pz_empowered_mu = q_mu[:, i : i + 1] + pz_empower  # [bs, 1, num_node]
+                z_last_mean = (
+                    pz_ou_decay[:, i : i + 1] * z_last_mean
+                    + (1 - pz_ou_decay[:, i : i + 1]) * pz_empowered_mu
+                )  # [bs, 1, num_node]
+                pred_z_mean.append(z_last_mean)
+            pred_z_mean = torch.cat(pred_z_mean, dim=1)  # [bs, time, num_node]
+            return pred_s_mean, pred_s_cov_mat, pred_z_mean, pred_z_var
+
+        # with A = V diag(lambda) V^-1 and w = z V: wt = wt-1 (decay_t + c_t lambda) + b_t
+        eigvals, eigvecs, eigvecs_inv = eigen
+        empower_coef = (1 - pz_ou_decay) * q_gamma / self.num_node  # [bs, time, 1]
+        scan_a = pz_ou_decay + empower_coef * eigvals  # [bs, time, num_node]
+        scan_b = ((1 - pz_ou_decay) * q_mu) * eigvecs.sum(0)  # the constant 1 V
+        w_last = z_last_mean.to(eigvecs.dtype) @ eigvecs  # [bs, 1, num_node]
+        pred_w_mean = affine_scan(
+            scan_a, scan_b, x0=w_last, dim=1
+        )  # [bs, time, num_node]
+        pred_z_mean = (pred_w_mean @ eigvecs_inv).real.to(z_last_mean.dtype)
+
+        return pred_s_mean, pred_s_cov_mat, pred_z_mean, pred_z_var
+
+    def _graph_eigenbasis(
+        self, device: torch.device
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """
+        Eigendecomposition A = V diag(lambda) V^-1 of the expected adjacency matrix, reused as
+        long as the graph returns the same (cached) matrix.
+
+        Returns:
+            (lambda, V, V^-1), or None if V is too ill-conditioned to be inverted accurately.
+        """
+        adj = self.node_dist.expected_A(self.num_sample).to(device)
+        if self._graph_eigen is None or self._graph_eigen[0] is not adj:
+            eigvals, eigvecs = torch.linalg.eig(adj.double())
+            eigen = None
+            if torch.linalg.cond(eigvecs) < MAX_EIGENBASIS_COND:
+                eigvecs_inv = torch.linalg.inv(eigvecs)
+                dtype = torch.complex64 if adj.dtype != torch.float64 else eigvals.dtype
+                eigen = (eigvals.to(dtype), eigvecs.to(dtype), eigvecs_inv.to(dtype))
+            self._graph_eigen = (adj, eigen)
+        return self._graph_eigen[1]
+
     def predictive_model(
         self,
         feed_dict: Dict[str, torch.Tensor],
@@ -835,67 +1153,19 @@ class AmortizedPSIKT(PSIKT):
 
         qs_dist, qz_dist = self.inference_process(emb_history, eval=True)
 
-        # analytical solution
-        pred_s_mean, pred_s_var, pred_z_mean, pred_z_var = [], [], [], []
         s_last_mean = qs_dist.mean[:, 0, -1:]  # [bs, 1, dim_s]
         s_last_cov_mat = qs_dist.covariance_matrix[:, 0, -1:]  # [bs, 1, dim_s, dim_s]
-        st_tran_r = torch.diag_embed(torch.exp(self.gen_st_log_r) + EPS)
         z_last_mean = qz_dist.mean[:, -1:]  # [bs, 1, num_node]
-        pz_graph_adj = (
-            self.node_dist.sample_A(self.num_sample)[-1][:, 0]
-            .mean(0)
-            .to(z_last_mean.device)
-        )  # adj_ij means i has influence on j
         dt = (
             torch.diff(t_all[:, -test_step - 1 :], dim=-1).unsqueeze(-1) / T_SCALE + EPS
         )  # [bs, num_steps-1, 1]
-        for i in range(test_step):
-            # p(st-1) = N(m, P), p(st|st-1) = N(st|H*st-1 + b, R)
-            # p(st) = N(st|H*m + b, H*P*H' + R)
-            s_next_mean = s_last_mean @ self.gen_st_h  # [bs, 1, dim_s]
-            s_next_cov_mat = (
-                self.gen_st_h @ s_last_cov_mat @ self.gen_st_h.transpose(-1, -2)
-                + st_tran_r
-            )  # [bs, 1, dim_s, dim_s]
-            pred_s_mean.append(s_next_mean)
-            pred_s_var.append(s_next_cov_mat)
-            s_last_mean = s_next_mean
-            s_last_cov_mat = s_next_cov_mat
-
-            # p(zt) = N(zt|zt-1, st)
-            q_alpha = torch.relu(s_next_mean[..., 0:1]) + EPS
-            q_mu = s_next_mean[..., 1:2]
-            q_sigma = s_next_mean[..., 2:3]  # [bs, 1, 1]
-            q_gamma = torch.sigmoid(s_next_mean[..., 3:4])
-            # calculate useful variables
-            pz_ou_decay = torch.exp(-q_alpha * dt[:, i : i + 1])  # [bs, 1, 1]
-            pz_ou_var = (
-                q_sigma
-                * q_sigma
-                * (1 - pz_ou_decay * pz_ou_decay)
-                / (2 * q_alpha + EPS)
-            )  # [bs, num_steps-1, 1]
-            pz_empower = (z_last_mean @ pz_graph_adj) / self.num_node * q_gamma
-            pz_empowered_mu = q_mu + pz_empower  # [bs, time-1, num_node]
-            pz_ou_mean = (
-                pz_ou_decay * z_last_mean + (1 - pz_ou_decay) * pz_empowered_mu
-            )  # [bs, 1, num_node]
-            z_last_mean = pz_ou_mean
-            pred_z_mean.append(pz_ou_mean)
-            pred_z_var.append(pz_ou_var)
-
-        pred_s_mean = torch.cat(pred_s_mean, dim=1)  # [bs, time, dim_s]
-        pred_s_cov_mat = torch.cat(pred_s_var, dim=1)  # [bs, time, dim_s, dim_s]
-        pred_z_mean = torch.cat(pred_z_mean, dim=1)  # [bs, time, num_node]
-        pred_z_var = torch.cat(pred_z_var, dim=1).repeat(
-            1, 1, self.num_node
-        )  # [bs, time, num_node]
-
-        pred_z_dist = distributions.MultivariateNormal(
-            loc=pred_z_mean, scale_tril=torch.tril(torch.diag_embed(pred_z_var + EPS))
+        pred_s_mean, pred_s_cov_mat, pred_z_mean, pred_z_var = self.predictive_rollout(
+            s_last_mean, s_last_cov_mat, z_last_mean, dt
         )
+
+        pred_z_dist = DiagonalNormal(loc=pred_z_mean, scale=pred_z_var + EPS)
         pred_z_sampled = pred_z_dist.sample(
-            (self.num_sample,)
+            (self.num_sample,), sampler=self.sampler
         )  # [n, bs, time, num_node]
         pred_z_sampled = pred_z_sampled.transpose(1, 0).reshape(
             bsn, test_step, self.num_node
@@ -925,6 +1195,277 @@ class AmortizedPSIKT(PSIKT):
             "pred_s_cov_mat": pred_s_cov_mat,
         }
 
+    def state_fields(self) -> Dict[str, Tuple[Tuple[int, ...], torch.dtype]]:
+        """
+        Layout of the filtering state of one learner, e.g. to persist it in a
+        LearnerStateStore.
+
+        The state carries what the inference networks need to absorb one more interaction:
+        the hidden states (h, c) of the LSTMs, the last `train_step` embeddings (the
+        posterior of s is inferred from a window of fixed length, zero-padded until it is
+        full) or, with --qs_pooling, the sum of the pooled features of all the embeddings,
+        the posterior moments and the timestamp of the last step and the number of
+        interactions. Updating it costs O(1) in the history length.
+
+        Returns:
+            Dict[str, Tuple[Tuple[int, ...], torch.dtype]]: The shape (without the batch
+                dimension) and dtype of every tensor of the state.
+        """
+        window = int(self.args.max_step * self.args.train_time_ratio)
+        lstm_shape = (2, 1, self.infer_network_posterior_z.hidden_size)
+        fields = {
+            "num_obs": ((), torch.long),
+            "time": ((1,), torch.float64),
+            "emb_window": ((window, self.node_dim), torch.float32),
+            "hidden_z": (lstm_shape, torch.float32),
+            "s_mean": ((1, self.dim_s), torch.float32),
+            "s_var": ((1, self.dim_s), torch.float32),
+            "z_mean": ((1, self.num_node), torch.float32),
+        }
+        if self._pooled_posterior_s():
+            del fields["emb_window"]
+            feature_dim = self.infer_network_posterior_s.feature_dim
+            fields["qs_feature_sum"] = ((feature_dim,), torch.float32)
+        if isinstance(self.infer_network_emb, nn.LSTM):
+            emb_shape = (2, 1, self.infer_network_emb.hidden_size)
+            fields["hidden_emb"] = (emb_shape, torch.float32)
+        return fields
+
+    def init_state(
+        self,
+        learner: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Create the filtering state of learners without any interaction, for `observe` and
+        `predict`. The posterior moments start at the priors p(s0) and p(z0).
+
+        Args:
+            learner (torch.Tensor): Ids of the learners, of shape [bs].
+
+        Returns:
+            Dict[str, torch.Tensor]: The filtering state of the learners, with the layout of
+                `state_fields`.
+        """
+        bs = learner.shape[0]
+        device = learner.device
+        state = {
+            name: torch.zeros((bs,) + shape, dtype=dtype, device=device)
+            for name, (shape, dtype) in self.state_fields().items()
+        }
+        state["learner"] = learner
+        state["s_mean"][:] = self.gen_s0_mean.detach()
+        state["s_var"][:] = torch.exp(self.gen_s0_log_var.detach())
+        state["z_mean"][:] = self.gen_z0_mean.detach()
+        return state
+
+    def load_state(
+        self,
+        store: LearnerStateStore,
+        learner: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Read the filtering state of learners from a store; learners without a stored state
+        start from `init_state`.
+
+        Args:
+            store (LearnerStateStore): A store created with the layout of `state_fields`.
+            learner (torch.Tensor): Ids of the learners, of shape [bs].
+
+        Returns:
+            Dict[str, torch.Tensor]: The filtering state of the learners.
+        """
+        state = self.init_state(learner)
+        stored, found = store.get(learner)
+        found = found.to(learner.device)
+        for name, value in stored.items():
+            state[name][found] = value.to(learner.device)[found]
+        return state
+
+    def save_state(
+        self,
+        store: LearnerStateStore,
+        state: Dict[str, torch.Tensor],
+    ) -> None:
+        """
+        Write the filtering state of learners to a store.
+
+        Args:
+            store (LearnerStateStore): A store created with the layout of `state_fields`.
+            state (Dict[str, torch.Tensor]): The filtering state from `observe`.
+        """
+        store.put(state["learner"], state)
+
+    def _pooled_posterior_s(self) -> bool:
+        return (
+            isinstance(self.infer_network_posterior_s, InferenceNet)
+            and self.infer_network_posterior_s.pooling
+        )
+
+    @staticmethod
+    def _lstm_step(
+        network: nn.LSTM,
+        inputs: torch.Tensor,
+        hidden: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Run an LSTM over one step from a hidden state stored batch-first.
+
+        Args:
+            network (nn.LSTM): The LSTM.
+            inputs (torch.Tensor): The inputs of the step, of shape [bs, 1, input_size].
+            hidden (torch.Tensor): The stacked (h, c), of shape [bs, 2, layers, hidden_size].
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The outputs [bs, 1, hidden_size] and the new
+                hidden state [bs, 2, layers, hidden_size].
+        """
+        h, c = hidden.permute(1, 2, 0, 3).contiguous()
+        output, (h, c) = network(inputs, (h, c))
+        return output, torch.stack([h, c]).permute(2, 0, 1, 3)
+
+    def _infer_step(
+        self,
+        state: Dict[str, torch.Tensor],
+        emb: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Update the posteriors of s and z with the embedding of one new interaction. The
+        moments are returned without building distributions, which dominate the cost of a
+        single step.
+
+        Args:
+            state (Dict[str, torch.Tensor]): The filtering state, updated in place.
+            emb (torch.Tensor): Embedding of the interaction, of shape [bs, 1, dim].
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: The posterior mean and variance
+                of s [bs, 1, dim_s] and the posterior mean of z [bs, 1, num_node] at the new
+                interaction.
+        """
+        if self._pooled_posterior_s():
+            # the mean of the features over the whole history, from their running sum
+            network = self.infer_network_posterior_s
+            state["qs_feature_sum"] = (
+                state["qs_feature_sum"] + network.qyx_features(emb)[:, 0]
+            )
+            features = state["qs_feature_sum"] / (state["num_obs"] + 1).unsqueeze(-1)
+            qs_out_inf = network.posterior(
+                features, emb, self.qs_temperature, self.qs_hard
+            )
+        else:
+            state["emb_window"] = torch.cat([state["emb_window"][:, 1:], emb], dim=1)
+            qs_out_inf = self.infer_network_posterior_s(
+                state["emb_window"], self.qs_temperature, self.qs_hard
+            )
+        s_mean = qs_out_inf["s_mu_infer"][:, 0, -1:]  # [bs, 1, dim_s]
+        s_std = qs_out_inf["s_var_infer"][:, 0, -1:] + EPS
+
+        qz_emb_out, state["hidden_z"] = self._lstm_step(
+            self.infer_network_posterior_z, emb, state["hidden_z"]
+        )  # [bs, 1, dim*2]
+        z_mean, _ = self.infer_network_posterior_mean_var_z(qz_emb_out)
+
+        return s_mean, s_std * s_std, z_mean
+
+    @torch.no_grad()
+    def observe(
+        self,
+        state: Dict[str, torch.Tensor],
+        skill: torch.Tensor,
+        label: torch.Tensor,
+        time: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Filter the posterior of learners with one new interaction each.
+
+        After the same interactions, the posterior of the last step matches the one
+        `predictive_model` infers from the whole history (once the window of the s-network
+        is full, or from the first interaction with --qs_pooling).
+
+        Args:
+            state (Dict[str, torch.Tensor]): The filtering state from `init_state` or
+                `observe`, updated in place.
+            skill (torch.Tensor): Practiced skills, of shape [bs].
+            label (torch.Tensor): Outcomes of the interactions, of shape [bs].
+            time (torch.Tensor): Timestamps of the interactions, of shape [bs].
+
+        Returns:
+            Dict[str, torch.Tensor]: The updated filtering state.
+        """
+        # float64 keeps millisecond timestamps exact, as the integer sequences of the batches
+        time = time.reshape(-1, 1).double()
+        label = label.reshape(-1, 1).float()
+        skill = skill.reshape(-1, 1)
+
+        if isinstance(self.infer_network_emb, nn.LSTM):
+            t_pe = self.get_time_embedding(time, "absolute")  # [bs, 1, dim]
+            y_pe = torch.tile(label.unsqueeze(-1), (1, 1, self.node_dim))
+            node_pe = self.node_dist._get_node_embedding()[skill]  # [bs, 1, dim]
+            emb_input = torch.cat([node_pe, y_pe], dim=-1)  # [bs, 1, dim*2]
+            emb, state["hidden_emb"] = self._lstm_step(
+                self.infer_network_emb, emb_input, state["hidden_emb"]
+            )
+            emb = emb + t_pe
+        else:
+            emb = self.embedding_process(time=time, label=label, item=skill)
+
+        state["s_mean"], state["s_var"], state["z_mean"] = self._infer_step(state, emb)
+        state["time"] = time
+        state["num_obs"] = state["num_obs"] + 1
+        return state
+
+    @torch.no_grad()
+    def predict(
+        self,
+        state: Dict[str, torch.Tensor],
+        horizon: torch.Tensor,
+        skill: torch.Tensor = None,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Forecast the performance of learners from their filtering state, as
+        `predictive_model` does from the whole history.
+
+        Args:
+            state (Dict[str, torch.Tensor]): The filtering state from `observe`.
+            horizon (torch.Tensor): Timestamps of the future steps, of shape [bs, time].
+            skill (torch.Tensor, optional): Skills to predict at the future steps, of shape
+                [bs, time]. If None, all skills are predicted.
+
+        Returns:
+            Dict[str, torch.Tensor]: The predicted success probabilities, of shape
+                [bs, num_sample, time] ([bs, num_sample, time, num_node] without `skill`),
+                and the predictive moments of s and z.
+        """
+        bs, test_step = horizon.shape
+        times = torch.cat([state["time"], horizon.double()], dim=-1)
+        dt = torch.diff(times, dim=-1).unsqueeze(-1).float() / T_SCALE + EPS
+        pred_s_mean, pred_s_cov_mat, pred_z_mean, pred_z_var = self.predictive_rollout(
+            state["s_mean"],
+            torch.diag_embed(state["s_var"]),
+            state["z_mean"],
+            dt,
+        )
+
+        pred_z_dist = DiagonalNormal(loc=pred_z_mean, scale=pred_z_var + EPS)
+        pred_z_sampled = pred_z_dist.sample(
+            (self.num_sample,), sampler=self.sampler
+        ).transpose(
+            1, 0
+        )  # [bs, n, time, num_node]
+        if skill is not None:
+            skill_mc = skill.reshape(bs, 1, test_step, 1).expand(
+                -1, self.num_sample, -1, -1
+            )
+            pred_z_sampled = torch.gather(pred_z_sampled, -1, skill_mc).squeeze(-1)
+
+        return {
+            "prediction": self.y_emit(pred_z_sampled),
+            "pred_s_mean": pred_s_mean,
+            "pred_s_cov_mat": pred_s_cov_mat,
+            "pred_z_mean": pred_z_mean,
+            "pred_z_var": pred_z_var,
+        }
+
     def get_objective_values(
         self,
         q_dists: Tuple[
@@ -935,6 +1476,7 @@ class AmortizedPSIKT(PSIKT):
         ],
         feed_dict: Dict[str, torch.Tensor],
         temperature: float = 1.0,
+        initial: bool = True,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Calculate objective values.
@@ -946,6 +1488,9 @@ class AmortizedPSIKT(PSIKT):
                 Tuple of Multivariate Gaussian distributions for p (ps_dist, pz_dist).
             feed_dict (Dict[str, torch.Tensor]): Dictionary containing input data with dtype torch.Tensor.
             temperature (float, optional): Temperature parameter (default: 1.0).
+            initial (bool, optional): Whether the first time step is the start of the
+                sequences; false for the later chunks of chunked training, whose first
+                step is a transition like the others (default: True).
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Tuple of st_log_prob, zt_log_prob, yt_log_prob.
@@ -959,29 +1504,52 @@ class AmortizedPSIKT(PSIKT):
         bs, time_step = item.shape
         bsn = bs * self.num_sample
 
-        # st_log_prob
-        qs_sampled = qs_dist.rsample(
-            (self.num_sample,)
-        )  # [num_sample, bs, 1, time, dim_s]
-        qs_log_prob = ps_dist.log_prob(qs_sampled)  # [num_sample, bs, 1, time]
-        qs_log_prob = qs_log_prob.reshape(-1, time_step).squeeze(1)  # [bs, time]
-
-        # zt_log_prob
-        qz_sampled = qz_dist.rsample(
-            (self.num_sample,)
-        )  # [num_sample, bs, time, num_node]
-        qz_log_prob = pz_dist.log_prob(qz_sampled)  # [num_sample, bs, time]
-        qz_log_prob = qz_log_prob.reshape(-1, time_step).squeeze(1)  # [bs, time]
-
-        # yt_log_prob
-        items = (
-            item.unsqueeze(1).repeat(1, self.num_sample, 1).reshape(bsn, 1, -1)
-        )  # [bsn, 1, time]
-        qz_sampled = (
-            qz_sampled.permute(1, 0, 3, 2).contiguous().reshape(bsn, self.num_node, -1)
-        )  # [bsn, num_node, time]
-        qz_sampled_item = (
-            torch.gather(qz_sampled, 1, items).transpose(-1, -2).contiguous()
+        if self.args.objective == "analytic":
+            # E_q[log p] of the Gaussian transitions in closed form; only the Bernoulli
+            # emission below is estimated with samples of z
+            qs_sampled = qs_dist.mean.unsqueeze(0)  # [1, bs, 1, time, dim_s]
+            qs_log_prob = expected_log_prob(qs_dist, ps_dist)  # [bs, 1, time]
+            qs_log_prob = qs_log_prob.reshape(-1, time_step)  # [bs, time]
+
+            qz_log_prob = expected_log_prob(qz_dist, pz_dist)  # [bs, time]
+
+            # z of the other nodes is not needed, the emission samples the practiced items
+            qz_sampled = None
+            if self.diagnostics.active:
+                qz_sampled = qz_dist.rsample(
+                    (self.num_sample,), sampler=self.sampler
+                )  # [num_sample, bs, time, num_node]
+        else:
+            # st_log_prob
+            qs_sampled = qs_dist.rsample(
+                (self.num_sample,), sampler=self.sampler
+            )  # [num_sample, bs, 1, time, dim_s]
+            qs_log_prob = ps_dist.log_prob(qs_sampled)  # [num_sample, bs, 1, time]
+            qs_log_prob = qs_log_prob.reshape(-1, time_step).squeeze(1)  # [bs, time]
+
+            # zt_log_prob
+            qz_sampled = qz_dist.rsample(
+                (self.num_sample,), sampler=self.sampler
+            )  # [num_sample, bs, time, num_node]
+            qz_log_prob = pz_dist.log_prob(qz_sampled)  # [num_sample, bs, time]
+            qz_log_prob = qz_log_prob.reshape(-1, time_step).squeeze(1)  # [bs, time]
+
+        # yt_log_prob; only the practiced item of every time step is emitted
+        item_idx = item.unsqueeze(-1)  # [bs, time, 1]
+        if qz_sampled is None:
+            qz_item_dist = DiagonalNormal(
+                torch.gather(qz_dist.loc, -1, item_idx),
+                torch.gather(qz_dist.scale, -1, item_idx),
+            )
+            qz_sampled_item = qz_item_dist.rsample(
+                (self.num_sample,), sampler=self.sampler
+            )  # [num_sample, bs, time, 1]
+        else:
+            qz_sampled_item = torch.gather(
+                qz_sampled, -1, item_idx.expand(self.num_sample, -1, -1, -1)
+            )  # [num_sample, bs, time, 1]
+        qz_sampled_item = qz_sampled_item.transpose(0, 1).reshape(
+            bsn, time_step, 1
         )  # [bsn, time, 1]
 
         y_prob_train = self.y_emit(qz_sampled_item)
@@ -991,23 +1559,29 @@ class AmortizedPSIKT(PSIKT):
         )
         yt_log_prob = y_dist_train.log_prob(y_train_mc)  # [bsn, time, 1]
         yt_log_prob = yt_log_prob.squeeze(-1)
+        if self.args.objective == "analytic":
+            # average the samples, to align with the per-learner s and z terms
+            yt_log_prob = yt_log_prob.reshape(bs, self.num_sample, time_step).mean(1)
 
-        recon_inputs = self.y_emit(qz_sampled)  # [bsn, num_node, time]
-        recon_inputs = recon_inputs.reshape(
-            bs, self.num_sample, self.num_node, time_step, -1
-        )
         recon_inputs_items = y_prob_train.reshape(bs, self.num_sample, 1, time_step, -1)
 
-        if not eval:
-            self.register_buffer(
-                name="pred_y_all_sampled", tensor=recon_inputs.clone().detach()
+        if self.diagnostics.active:
+            # emission of every node, not only the practiced items; debugging only
+            items = (
+                item.unsqueeze(1).repeat(1, self.num_sample, 1).reshape(bsn, 1, -1)
+            )  # [bsn, 1, time]
+            qz_sampled = qz_sampled.permute(1, 0, 3, 2).reshape(
+                bsn, self.num_node, -1
+            )  # [bsn, num_node, time]
+            recon_inputs = self.y_emit(qz_sampled)  # [bsn, num_node, time]
+            recon_inputs = recon_inputs.reshape(
+                bs, self.num_sample, self.num_node, time_step, -1
             )
-            self.register_buffer(
-                name="pred_y_sampled", tensor=recon_inputs_items.clone().detach()
-            )
-            self.register_buffer(name="output_items", tensor=items.clone().detach())
-            self.register_buffer(
-                name="pred_z_sampled", tensor=qz_sampled_item.clone().detach()
+            self.diagnostics.capture(
+                pred_y_all_sampled=recon_inputs,
+                pred_y_sampled=recon_inputs_items,
+                output_items=items,
+                pred_z_sampled=qz_sampled_item,
             )
 
         temp_s, temp_z = self.args.s_entropy_weight, self.args.z_entropy_weight
@@ -1016,17 +1590,21 @@ class AmortizedPSIKT(PSIKT):
             self.args.z_log_weight,
             self.args.y_log_weight,
         )
+        first = 1 if initial else 0
         sequence_likelihood = (
-            w_s * qs_log_prob[:, 1:]
-            + w_z * qz_log_prob[:, 1:]
-            + w_y * yt_log_prob[:, 1:]
+            w_s * qs_log_prob[:, first:]
+            + w_z * qz_log_prob[:, first:]
+            + w_y * yt_log_prob[:, first:]
         ) / 3  # [bs,]
         initial_likelihood = (
             w_s * qs_log_prob[:, 0] + w_z * qz_log_prob[:, 0] + w_y * yt_log_prob[:, 0]
         ) / 3
 
         t1_mean = torch.mean(sequence_likelihood)
-        t2_mean = torch.mean(initial_likelihood) * 1e-4
+        if initial:
+            t2_mean = torch.mean(initial_likelihood) * 1e-4
+        else:
+            t2_mean = torch.zeros_like(t1_mean)
 
         t3_mean = torch.mean(qs_dist.entropy())
         t4_mean = torch.mean(qz_dist.entropy())
@@ -1083,13 +1661,6 @@ class AmortizedPSIKT(PSIKT):
         loss_cat = -gmvae_loss.entropy(self.logits, self.probs) - numpy.log(0.1)
         losses["loss_cat"] = loss_cat * self.args.cat_weight
 
-        loss_cat_in_entropy = gmvae_loss.prior_entropy(
-            self.num_category, self.gen_network_transition_s, self.device
-        )
-        losses["loss_cat_in_entropy"] = (
-            loss_cat_in_entropy * self.args.cat_in_entropy_weight
-        )
-
         losses["loss_total"] = -outdict["elbo"].mean() + losses["loss_cat"]
 
         # Evaluate metrics
@@ -1104,6 +1675,14 @@ class AmortizedPSIKT(PSIKT):
 
 
 class ContinualPSIKT(AmortizedPSIKT):
+    # Parameters of earlier versions holding the moments of all learners and time steps
+    LEGACY_STATE_PARAMETERS = tuple(
+        "{}_{}_{}{}".format(*key)
+        for key in itertools.product(
+            ["pred", "infer"], ["s", "z"], ["means", "vars"], ["", "_update"]
+        )
+    )
+
     def __init__(
         self,
         mode: str = "train",
@@ -1116,63 +1695,32 @@ class ContinualPSIKT(AmortizedPSIKT):
     ) -> None:
         super().__init__(mode, num_node, args, device, logs, nx_graph)
 
-        time_step_save = args.max_step
         self.num_seq_save = num_seq
 
-        s_shape = (num_seq, 1, time_step_save, self.dim_s)
-        z_shape = (num_seq, 1, time_step_save, self.num_node)
-        z_shape_pred = (num_seq, 1, time_step_save, self.num_node)
-
-        self.pred_s_means = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-        self.pred_s_vars = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-        self.infer_s_means = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-        self.infer_s_vars = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-
-        self.pred_s_means_update = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-        self.pred_s_vars_update = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-        self.infer_s_means_update = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-        self.infer_s_vars_update = nn.Parameter(
-            torch.zeros(s_shape, device=self.device), requires_grad=False
-        )
-
-        self.pred_z_means = nn.Parameter(
-            torch.zeros(z_shape_pred, device=self.device), requires_grad=False
-        )
-        self.pred_z_vars = nn.Parameter(
-            torch.zeros(z_shape_pred, device=self.device), requires_grad=False
-        )
-        self.infer_z_means = nn.Parameter(
-            torch.zeros(z_shape, device=self.device), requires_grad=False
-        )
-        self.infer_z_vars = nn.Parameter(
-            torch.zeros(z_shape, device=self.device), requires_grad=False
-        )
-
-        self.pred_z_means_update = nn.Parameter(
-            torch.zeros(z_shape_pred, device=self.device), requires_grad=False
-        )
-        self.pred_z_vars_update = nn.Parameter(
-            torch.zeros(z_shape_pred, device=self.device), requires_grad=False
-        )
-        self.infer_z_means_update = nn.Parameter(
-            torch.zeros(z_shape, device=self.device), requires_grad=False
-        )
-        self.infer_z_vars_update = nn.Parameter(
-            torch.zeros(z_shape, device=self.device), requires_grad=False
+        # Moments of the predicted (pred) and inferred (infer) distributions of s and z of
+        # every learner, and of the posteriors after the optimization step (infer_*_update),
+        # the priors of the next step. Only the current and the previous time steps are
+        # read, so the last state_window steps are kept, in a LearnerStateStore which
+        # keeps state_capacity learners in memory and spills the others to state_path.
+        if args.state_window < 2:
+            raise ValueError(
+                "state_window must be at least 2, got {}".format(args.state_window)
+            )
+        var_dtype = STATE_VAR_DTYPES[args.state_var_dtype]
+        fields = {}
+        for (stage, suffix), name in itertools.product(
+            [("pred", ""), ("infer", ""), ("infer", "_update")], ["s", "z"]
+        ):
+            dim = self.dim_s if name == "s" else self.num_node
+            fields["{}_{}_means{}".format(stage, name, suffix)] = (dim, torch.float32)
+            fields["{}_{}_vars{}".format(stage, name, suffix)] = (dim, var_dtype)
+        self.state_buffers = WindowedStateBuffers(
+            fields,
+            num_seq,
+            args.state_window,
+            path=args.state_path or None,
+            device=self.device,
+            capacity=args.state_capacity or None,
         )
 
         self.var_minimum = torch.log(torch.tensor(1).to(self.device))
@@ -1197,12 +1745,26 @@ class ContinualPSIKT(AmortizedPSIKT):
             self.node_dim * 2, self.node_dim, self.dim_s
         )
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for name in self.LEGACY_STATE_PARAMETERS:
+            state_dict.pop(prefix + name, None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def save_model(
+        self, epoch: int, mini_epoch: int = 0, model_path: str = None
+    ) -> None:
+        """
+        Save the model, and write the memory-mapped state buffers to their files.
+        """
+        self.state_buffers.flush()
+        super().save_model(epoch, mini_epoch, model_path)
+
     def st_transition_infer(
         self,
         feed_dict: Dict[str, torch.Tensor] = None,
         emb_inputs: torch.Tensor = None,
         idx: int = None,
-    ) -> torch.distributions.MultivariateNormal:
+    ) -> DiagonalNormal:
         """
         Compute the posterior distribution of the latent variable `s_t`.
 
@@ -1215,8 +1777,8 @@ class ContinualPSIKT(AmortizedPSIKT):
                 distribution. Default is None.
 
         Returns:
-            torch.distributions.MultivariateNormal: The posterior distribution of `s_t`
-                as a Multivariate Normal distribution.
+            DiagonalNormal: The posterior distribution of `s_t`
+                as a Gaussian with diagonal covariance.
 
         """
         output, _ = self.infer_network_posterior_s(emb_inputs)
@@ -1226,10 +1788,7 @@ class ContinualPSIKT(AmortizedPSIKT):
         )  # [bs, time_step, dim_s]
 
         log_var = torch.minimum(log_var, self.var_minimum)
-        cov_mat = torch.diag_embed(torch.exp(log_var) + EPS)
-        dist_s = distributions.multivariate_normal.MultivariateNormal(
-            loc=mean, scale_tril=torch.tril(cov_mat)
-        )
+        dist_s = DiagonalNormal(loc=mean, scale=torch.exp(log_var) + EPS)
 
         return dist_s
 
@@ -1238,7 +1797,7 @@ class ContinualPSIKT(AmortizedPSIKT):
         feed_dict: Dict[str, torch.Tensor] = None,
         emb_inputs: torch.Tensor = None,
         idx: int = None,
-    ) -> torch.distributions.MultivariateNormal:
+    ) -> DiagonalNormal:
         """
         Compute the posterior distribution of the latent variable `z_t` given the input and output sequences.
 
@@ -1262,13 +1821,55 @@ class ContinualPSIKT(AmortizedPSIKT):
 
         # mean, log_var = self.infer_network_posterior_mean_var_z(emb_inputs)  # [batch_size, time_step, dim_s]
         log_var = torch.minimum(log_var, self.var_minimum)
-        cov_mat = torch.diag_embed(torch.exp(log_var) + EPS)
+        dist_z = DiagonalNormal(loc=mean, scale=torch.exp(log_var) + EPS)
+
+        return dist_z
+
+    def state_fields(self) -> Dict[str, Tuple[Tuple[int, ...], torch.dtype]]:
+        """
+        Layout of the filtering state of one learner. The posterior of s comes from an
+        LSTM, so its hidden state replaces the window of embeddings.
+
+        Returns:
+            Dict[str, Tuple[Tuple[int, ...], torch.dtype]]: The shape (without the batch
+                dimension) and dtype of every tensor of the state.
+        """
+        fields = super().state_fields()
+        del fields["emb_window"]
+        lstm_shape = (2, 1, self.infer_network_posterior_s.hidden_size)
+        fields["hidden_s"] = (lstm_shape, torch.float32)
+        return fields
 
-        dist_z = distributions.multivariate_normal.MultivariateNormal(
-            loc=mean, scale_tril=torch.tril(cov_mat)
+    def _infer_step(
+        self,
+        state: Dict[str, torch.Tensor],
+        emb: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Update the posteriors of s and z with the embedding of one new interaction, carrying
+        the hidden states of both LSTMs.
+
+        Args:
+            state (Dict[str, torch.Tensor]): The filtering state, updated in place.
+            emb (torch.Tensor): Embedding of the interaction, of shape [bs, 1, dim].
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: The posterior mean and variance
+                of s [bs, 1, dim_s] and the posterior mean of z [bs, 1, num_node] at the new
+                interaction.
+        """
+        output, state["hidden_s"] = self._lstm_step(
+            self.infer_network_posterior_s, emb, state["hidden_s"]
         )
+        s_mean, s_log_var = self.infer_network_posterior_mean_var_s(output)
+        s_std = torch.exp(torch.minimum(s_log_var, self.var_minimum)) + EPS
 
-        return dist_z
+        output, state["hidden_z"] = self._lstm_step(
+            self.infer_network_posterior_z, emb, state["hidden_z"]
+        )
+        z_mean, _ = self.infer_network_posterior_mean_var_z(output)
+
+        return s_mean, s_std * s_std, z_mean
 
     def predictive_model(
         self,
@@ -1276,11 +1877,9 @@ class ContinualPSIKT(AmortizedPSIKT):
         idx: int = None,
         eval: bool = False,
         update: bool = False,
-        s_prior: torch.distributions.MultivariateNormal = None,
-        z_prior: torch.distributions.MultivariateNormal = None,
-    ) -> Tuple[
-        torch.distributions.MultivariateNormal, torch.distributions.MultivariateNormal
-    ]:
+        s_prior: DiagonalNormal = None,
+        z_prior: DiagonalNormal = None,
+    ) -> Tuple[DiagonalNormal, DiagonalNormal]:
         """
         Perform predictive modeling.
 
@@ -1296,27 +1895,23 @@ class ContinualPSIKT(AmortizedPSIKT):
         if idx == 0:
             t_idx = feed_dict["time_seq"][:, : idx + 1]  # [bs, 2]
             dt = t_idx / T_SCALE + EPS
-            s_tilde_dist = distributions.MultivariateNormal(
+            s_tilde_dist = DiagonalNormal(
                 self.gen_s0_mean.unsqueeze(0).repeat(bs, 1, 1),
-                scale_tril=torch.tril(
-                    torch.diag_embed(torch.exp(self.gen_s0_log_var) + EPS)
-                ),
+                scale=torch.exp(self.gen_s0_log_var) + EPS,
             )
 
             s_tilde_dist_mean = s_tilde_dist.mean  # [num_seq, 1, dim_s]
-            s_tilde_dist_var = torch.diagonal(s_tilde_dist.scale_tril, dim1=-2, dim2=-1)
+            s_tilde_dist_var = s_tilde_dist.scale
 
             # p_theta(z_0)
-            z_tilde_dist = distributions.MultivariateNormal(
+            z_tilde_dist = DiagonalNormal(
                 self.gen_z0_mean.unsqueeze(0).repeat(bs, 1, self.num_node),
-                scale_tril=torch.tril(
-                    torch.diag_embed(
-                        torch.exp(self.gen_z0_log_var.repeat(1, self.num_node)) + EPS
-                    )
+                scale=(
+                    torch.exp(self.gen_z0_log_var.repeat(1, self.num_node)) + EPS
                 ).unsqueeze(0),
             )
             z_tilde_dist_mean = z_tilde_dist.mean  # [1, 1, dim_z]
-            z_tilde_dist_var = torch.diagonal(z_tilde_dist.scale_tril, dim1=-2, dim2=-1)
+            z_tilde_dist_var = z_tilde_dist.scale
 
         else:
             t_idx = feed_dict["time_seq"][:, idx - 1 : idx + 1]  # [bs, 2]
@@ -1324,39 +1919,37 @@ class ContinualPSIKT(AmortizedPSIKT):
 
             if s_prior != None:
                 s_prior_mean = s_prior.mean
-                s_prior_cov = torch.diagonal(s_prior.scale_tril, dim1=1, dim2=2)
+                s_prior_cov = s_prior.scale
 
             else:
-                s_prior_mean = self.infer_s_means_update[user, :, idx - 1]
-                s_prior_cov = self.infer_s_vars_update[user, :, idx - 1]
+                s_prior_mean = self.state_buffers.read(
+                    "infer_s_means_update", user, idx - 1
+                )
+                s_prior_cov = self.state_buffers.read(
+                    "infer_s_vars_update", user, idx - 1
+                )
 
             s_tilde_dist_mean = s_prior_mean @ self.gen_st_h  # [bs, 1, dim_s]
-            s_prior_cov_mat = torch.diag_embed(s_prior_cov)  # [bs, 1, dim_s, dim_s]
+            # diag(H diag(P) H' + R), without building the [bs, 1, dim_s, dim_s] matrices
             pst_transition_var = torch.exp(self.gen_st_log_r)
-            pst_transition_cov_mat = torch.diag_embed(
-                pst_transition_var + EPS
-            )  # [1, dim_s, dim_s]
-            s_tilde_dist_var_mat = (
-                self.gen_st_h @ s_prior_cov_mat @ self.gen_st_h.transpose(-1, -2)
-                + pst_transition_cov_mat
-            )  # [bs, 1, dim_s, dim_s]
-            s_tilde_dist_var = torch.diagonal(
-                s_tilde_dist_var_mat, dim1=-2, dim2=-1
+            s_tilde_dist_var = (
+                s_prior_cov @ (self.gen_st_h * self.gen_st_h).transpose(-1, -2)
+                + pst_transition_var
+                + EPS
             )  # [bs, 1, dim_s]
-            s_tilde_dist = distributions.multivariate_normal.MultivariateNormal(
-                loc=s_tilde_dist_mean,
-                scale_tril=torch.tril(torch.diag_embed(s_tilde_dist_var)),
-            )
+            s_tilde_dist = DiagonalNormal(loc=s_tilde_dist_mean, scale=s_tilde_dist_var)
 
             # q_phi(z_t-1) the posterior of last time step is the prior of this time step
             if z_prior != None:
                 z_prior_mean = z_prior.mean
-                z_prior_cov = torch.diagonal(z_prior.scale_tril, dim1=1, dim2=2)  # TODO
+                z_prior_cov = z_prior.scale
             else:
-                z_prior_mean = self.infer_z_means_update[
-                    user, :, idx - 1
-                ]  # [bs, 1, dim_z]
-                z_prior_cov = self.infer_z_vars_update[user, :, idx - 1]
+                z_prior_mean = self.state_buffers.read(
+                    "infer_z_means_update", user, idx - 1
+                )  # [bs, 1, dim_z]
+                z_prior_cov = self.state_buffers.read(
+                    "infer_z_vars_update", user, idx - 1
+                )
 
             s_next_sample = s_tilde_dist_mean  # [bs, 1, dim_s]
             z_last_sample = z_prior_mean  # [bs, 1, num_node]
@@ -1367,11 +1960,9 @@ class ContinualPSIKT(AmortizedPSIKT):
             sampled_gamma = torch.sigmoid(s_next_sample[..., 3:4])
 
             ou_decay = torch.exp(-sampled_alpha * dt.reshape(bs, 1, 1))  # [bs, 1, 1]
-            graph_adj = (
-                self.node_dist.sample_A(self.num_sample)[-1][:, 0].mean(0).to(device)
-            )
+            graph_empower = self.node_dist.empowerment(self.num_sample)
             empower = (
-                sampled_gamma * (z_last_sample @ graph_adj) / self.num_node
+                sampled_gamma * graph_empower(z_last_sample) / self.num_node
             )  # [bs, 1, num_node]
             empowered_mu = sampled_mu + empower
 
@@ -1380,32 +1971,18 @@ class ContinualPSIKT(AmortizedPSIKT):
                 sampled_sigma**2 * (1 - ou_decay**2) / (2 * sampled_alpha + EPS)
                 + EPS
             )
-            z_tilde_dist = distributions.multivariate_normal.MultivariateNormal(
+            z_tilde_dist = DiagonalNormal(
                 loc=z_tilde_dist_mean,
-                scale_tril=torch.tril(
-                    torch.diag_embed(z_tilde_dist_var.repeat(1, 1, self.num_node))
-                ),
+                scale=z_tilde_dist_var.repeat(1, 1, self.num_node),
             )
 
-        if not eval:
-            if not update:
-                self.pred_s_means[user, :, idx] = s_tilde_dist_mean.detach().clone()
-                self.pred_s_vars[user, :, idx] = s_tilde_dist_var.detach().clone()
-                self.pred_z_means[user, :, idx] = z_tilde_dist_mean.detach().clone()
-                self.pred_z_vars[user, :, idx] = z_tilde_dist_var.detach().clone()
-            else:
-                self.pred_s_means_update[
-                    user, :, idx
-                ] = s_tilde_dist_mean.detach().clone()
-                self.pred_s_vars_update[
-                    user, :, idx
-                ] = s_tilde_dist_var.detach().clone()
-                self.pred_z_means_update[
-                    user, :, idx
-                ] = z_tilde_dist_mean.detach().clone()
-                self.pred_z_vars_update[
-                    user, :, idx
-                ] = z_tilde_dist_var.detach().clone()
+        # the moments after the optimization step are not stored: comparison_function
+        # recomputes them
+        if not eval and not update:
+            self.state_buffers.write("pred_s_means", user, idx, s_tilde_dist_mean)
+            self.state_buffers.write("pred_s_vars", user, idx, s_tilde_dist_var)
+            self.state_buffers.write("pred_z_means", user, idx, z_tilde_dist_mean)
+            self.state_buffers.write("pred_z_vars", user, idx, z_tilde_dist_var)
 
         return s_tilde_dist, z_tilde_dist
 
@@ -1415,7 +1992,7 @@ class ContinualPSIKT(AmortizedPSIKT):
         idx: int = None,
         eval: bool = False,
         update: bool = False,
-    ) -> Tuple[distributions.MultivariateNormal, distributions.MultivariateNormal]:
+    ) -> Tuple[DiagonalNormal, DiagonalNormal]:
         """
         Args:
             eval: if True, it will not update the parameters.
@@ -1451,26 +2028,54 @@ class ContinualPSIKT(AmortizedPSIKT):
         if not eval:
             users = feed_dict["user_id"]
             if not update:
-                self.infer_s_means[users, :, idx] = s_dist.mean.detach().clone()
-                self.infer_s_vars[users, :, idx] = (
-                    torch.diagonal(s_dist.scale_tril, dim1=-2, dim2=-1).detach().clone()
+                self.state_buffers.write("infer_s_means", users, idx, s_dist.mean)
+                self.state_buffers.write("infer_s_vars", users, idx, s_dist.scale)
+                self.state_buffers.write("infer_z_means", users, idx, z_dist.mean)
+                self.state_buffers.write("infer_z_vars", users, idx, z_dist.scale)
+            else:
+                self.state_buffers.write(
+                    "infer_s_means_update", users, idx, s_dist.mean
                 )
-                self.infer_z_means[users, :, idx] = z_dist.mean.detach().clone()
-                self.infer_z_vars[users, :, idx] = (
-                    torch.diagonal(z_dist.scale_tril, dim1=-2, dim2=-1).detach().clone()
+                self.state_buffers.write(
+                    "infer_s_vars_update", users, idx, s_dist.scale
                 )
-            else:
-                self.infer_s_means_update[users, :, idx] = s_dist.mean.detach().clone()
-                self.infer_s_vars_update[users, :, idx] = (
-                    torch.diagonal(s_dist.scale_tril, dim1=-2, dim2=-1).detach().clone()
+                self.state_buffers.write(
+                    "infer_z_means_update", users, idx, z_dist.mean
                 )
-                self.infer_z_means_update[users, :, idx] = z_dist.mean.detach().clone()
-                self.infer_z_vars_update[users, :, idx] = (
-                    torch.diagonal(z_dist.scale_tril, dim1=-2, dim2=-1).detach().clone()
+                self.state_buffers.write(
+                    "infer_z_vars_update", users, idx, z_dist.scale
                 )
 
         return s_dist, z_dist
 
+    def filtering_step(
+        self,
+        feed_dict: Dict[str, torch.Tensor],
+        idx: int,
+        eval: bool = False,
+    ) -> Tuple[
+        Tuple[DiagonalNormal, DiagonalNormal], Tuple[DiagonalNormal, DiagonalNormal]
+    ]:
+        """
+        Compute the predictive distributions of s and z at time step idx, from the
+        posteriors of the previous step, and their posteriors given the interaction at idx,
+        for a batch of learners, storing their moments unless eval.
+
+        After the optimization step, only the posteriors, the priors of the next step, need
+        to be recomputed with `inference_model(..., update=True)`.
+
+        Args:
+            feed_dict (Dict[str, torch.Tensor]): The batch of learners.
+            idx (int): The time step.
+            eval (bool, optional): If True, the moments are not stored.
+
+        Returns:
+            The predictive distributions (s, z) and the posteriors (s, z).
+        """
+        pred_dist = self.predictive_model(feed_dict=feed_dict, idx=idx, eval=eval)
+        post_dist = self.inference_model(feed_dict=feed_dict, idx=idx, eval=eval)
+        return pred_dist, post_dist
+
     def objective_function(
         self,
         feed_dict_idx: Dict[str, torch.Tensor],
@@ -1509,15 +2114,21 @@ class ContinualPSIKT(AmortizedPSIKT):
 
         # log tilde_p_theta(s_t)
         s_vp_sample = s_infer_dist.rsample(
-            (self.num_sample,)
+            (self.num_sample,), sampler=self.sampler
         )  # [num_sample, bs, 1, dim_s]
-        log_prob_st = s_tilde_dist.log_prob(s_vp_sample)  # [num_sample, bs, 1, dim_s]
+        if self.args.objective == "analytic":
+            log_prob_st = expected_log_prob(s_infer_dist, s_tilde_dist)
+        else:
+            log_prob_st = s_tilde_dist.log_prob(s_vp_sample)  # [num_sample, bs, 1, dim_s]
         log_prob_st = log_prob_st.mean() / self.dim_s
 
         z_vp_sample = z_infer_dist.rsample(
-            (self.num_sample,)
+            (self.num_sample,), sampler=self.sampler
         )  # [num_sample, bs, 1, dim_z]
-        log_prob_zt = z_tilde_dist.log_prob(z_vp_sample)  # [num_sample, bs, 1, dim_z]
+        if self.args.objective == "analytic":
+            log_prob_zt = expected_log_prob(z_infer_dist, z_tilde_dist)
+        else:
+            log_prob_zt = z_tilde_dist.log_prob(z_vp_sample)  # [num_sample, bs, 1, dim_z]
         log_prob_zt = log_prob_zt.mean() / self.dim_z
 
         item_idx_mc = item_idx.unsqueeze(0).repeat(self.num_sample, 1, 1)  # [n, bs, 1]
@@ -1588,14 +2199,11 @@ class ContinualPSIKT(AmortizedPSIKT):
         items = feed_dict["skill_seq"][:, idx]  # [bs, times]
 
         # ------ comparison 1: check if optimization works ------
-        old_z_tilde_dist = torch.distributions.MultivariateNormal(
-            loc=self.pred_z_means[users, :, idx],
-            scale_tril=torch.diag_embed(self.pred_z_vars[users, :, idx]),
-        )
-        new_z_tilde_dist = torch.distributions.MultivariateNormal(
-            loc=self.pred_z_means_update[users, :, idx],
-            scale_tril=torch.diag_embed(self.pred_z_vars_update[users, :, idx]),
+        old_z_tilde_dist = DiagonalNormal(
+            loc=self.state_buffers.read("pred_z_means", users, idx),
+            scale=self.state_buffers.read("pred_z_vars", users, idx),
         )
+        _, new_z_tilde_dist = self.predictive_model(feed_dict, idx, eval=True)
         old_y = self.y_emit(old_z_tilde_dist.sample((self.num_sample,))).mean(0)
         new_y = self.y_emit(new_z_tilde_dist.sample((self.num_sample,))).mean(0)
         old_y = torch.gather(old_y, dim=2, index=items.reshape(-1, 1, 1))
@@ -1605,13 +2213,13 @@ class ContinualPSIKT(AmortizedPSIKT):
             new_y.flatten(), labels.flatten()
         ) - loss_fn(old_y.flatten(), labels.flatten())
 
-        old_z_infer_dist = torch.distributions.MultivariateNormal(
-            loc=self.infer_z_means[users, :, idx],
-            scale_tril=torch.diag_embed(self.infer_z_vars[users, :, idx]),
+        old_z_infer_dist = DiagonalNormal(
+            loc=self.state_buffers.read("infer_z_means", users, idx),
+            scale=self.state_buffers.read("infer_z_vars", users, idx),
         )
-        new_z_infer_dist = torch.distributions.MultivariateNormal(
-            loc=self.infer_z_means_update[users, :, idx],
-            scale_tril=torch.diag_embed(self.infer_z_vars_update[users, :, idx]),
+        new_z_infer_dist = DiagonalNormal(
+            loc=self.state_buffers.read("infer_z_means_update", users, idx),
+            scale=self.state_buffers.read("infer_z_vars_update", users, idx),
         )
         old_y = self.y_emit(old_z_infer_dist.sample((self.num_sample,))).mean(0)
         new_y = self.y_emit(new_z_infer_dist.sample((self.num_sample,))).mean(0)
@@ -1668,8 +2276,8 @@ class ContinualPSIKT(AmortizedPSIKT):
             pred = pred.detach().cpu().data.numpy()
             gt = gt.detach().cpu().data.numpy()
             evaluations = BaseModel.pred_evaluate_method(pred, gt, metrics)
-        for key in evaluations.keys():
-            losses[key] = evaluations[key]
+            for key in evaluations.keys():
+                losses[key] = evaluations[key]
 
         return losses
 
@@ -1683,88 +2291,43 @@ class ContinualPSIKT(AmortizedPSIKT):
 
         Args:
             feed_dict (Dict[str, torch.Tensor]): Dictionary containing input data with dtype torch.Tensor.
+            idx (int): The time step of the stored posteriors; the next (at most 10) steps
+                are predicted.
         """
 
-        test_step = 10
+        horizon = 10
         user = feed_dict["user_id"]
-        s_tilde_dist = torch.distributions.MultivariateNormal(
-            loc=self.infer_s_means_update[user, :, idx],
-            scale_tril=torch.diag_embed(self.infer_s_vars_update[user, :, idx]),
+        s_tilde_dist = DiagonalNormal(
+            loc=self.state_buffers.read("infer_s_means_update", user, idx),
+            scale=self.state_buffers.read("infer_s_vars_update", user, idx),
         )
-        z_tilde_dist = torch.distributions.MultivariateNormal(
-            loc=self.infer_z_means_update[user, :, idx],
-            scale_tril=torch.diag_embed(self.infer_z_vars_update[user, :, idx]),
+        z_tilde_dist = DiagonalNormal(
+            loc=self.state_buffers.read("infer_z_means_update", user, idx),
+            scale=self.state_buffers.read("infer_z_vars_update", user, idx),
         )
 
-        y_all = feed_dict["label_seq"][:, idx + 1 : idx + test_step + 1]  # [bs, times]
-        item_all = feed_dict["skill_seq"][:, idx + 1 : idx + test_step + 1]
-        t_all = feed_dict["time_seq"][:, idx : idx + test_step + 1]  # [bs, 10]
-        bs, _ = t_all.shape
+        y_all = feed_dict["label_seq"][:, idx + 1 : idx + horizon + 1]  # [bs, times]
+        item_all = feed_dict["skill_seq"][:, idx + 1 : idx + horizon + 1]
+        t_all = feed_dict["time_seq"][:, idx : idx + horizon + 1]  # [bs, times+1]
+        # fewer steps are left at the end of the sequences
+        bs, test_step = y_all.shape
         bsn = bs * self.num_sample
 
         qs_dist, qz_dist = s_tilde_dist, z_tilde_dist
 
-        # analytical solution
-        pred_s_mean, pred_s_var, pred_z_mean, pred_z_var = [], [], [], []
         s_last_mean = qs_dist.mean  # [bs, 1, dim_s]
         s_last_cov_mat = qs_dist.covariance_matrix  # [bs, 1, dim_s, dim_s]
-        st_tran_r = torch.diag_embed(torch.exp(self.gen_st_log_r) + EPS)
         z_last_mean = qz_dist.mean  # [bs, 1, num_node]
-        pz_graph_adj = (
-            self.node_dist.sample_A(self.num_sample)[-1][:, 0]
-            .mean(0)
-            .to(z_last_mean.device)
-        )
         dt = (
             torch.diff(t_all, dim=-1).unsqueeze(-1) / T_SCALE + EPS
         )  # [bs, num_steps, 1]
-        for i in range(test_step):
-            # p(st-1) = N(m, P), p(st|st-1) = N(st|H*st-1 + b, R)
-            # p(st) = N(st|H*m + b, H*P*H' + R)
-            s_next_mean = s_last_mean @ self.gen_st_h  # [bs, 1, dim_s]
-            s_next_cov_mat = (
-                self.gen_st_h @ s_last_cov_mat @ self.gen_st_h.transpose(-1, -2)
-                + st_tran_r
-            )  # [bs, 1, dim_s, dim_s]
-            pred_s_mean.append(s_next_mean)
-            pred_s_var.append(s_next_cov_mat)
-            s_last_mean = s_next_mean
-            s_last_cov_mat = s_next_cov_mat
-
-            # p(zt) = N(zt|zt-1, st)
-            q_alpha = torch.relu(s_next_mean[..., 0:1]) + EPS
-            q_mu = s_next_mean[..., 1:2]  # torch.tanh(s_next_mean[..., 1:2])  #
-            q_sigma = s_next_mean[..., 2:3]  # [bs, 1, 1]
-            q_gamma = torch.sigmoid(s_next_mean[..., 3:4])
-            # calculate useful variables
-            pz_ou_decay = torch.exp(-q_alpha * dt[:, i : i + 1])  # [bs, 1, 1]
-            pz_ou_var = (
-                q_sigma
-                * q_sigma
-                * (1 - pz_ou_decay * pz_ou_decay)
-                / (2 * q_alpha + EPS)
-            )  # [bs, num_steps-1, 1]
-            pz_empower = (z_last_mean @ pz_graph_adj) / self.num_node * q_gamma
-            pz_empowered_mu = q_mu + pz_empower  # [bs, time-1, num_node]
-            pz_ou_mean = (
-                pz_ou_decay * z_last_mean + (1 - pz_ou_decay) * pz_empowered_mu
-            )  # [bs, 1, num_node]
-            z_last_mean = pz_ou_mean
-            pred_z_mean.append(pz_ou_mean)
-            pred_z_var.append(pz_ou_var)
-
-        pred_s_mean = torch.cat(pred_s_mean, dim=1)  # [bs, time, dim_s]
-        pred_s_cov_mat = torch.cat(pred_s_var, dim=1)  # [bs, time, dim_s, dim_s]
-        pred_z_mean = torch.cat(pred_z_mean, dim=1)  # [bs, time, num_node]
-        pred_z_var = torch.cat(pred_z_var, dim=1).repeat(
-            1, 1, self.num_node
-        )  # [bs, time, num_node]
-
-        pred_z_dist = torch.distributions.MultivariateNormal(
-            loc=pred_z_mean, scale_tril=torch.tril(torch.diag_embed(pred_z_var + EPS))
+        pred_s_mean, pred_s_cov_mat, pred_z_mean, pred_z_var = self.predictive_rollout(
+            s_last_mean, s_last_cov_mat, z_last_mean, dt
         )
+
+        pred_z_dist = DiagonalNormal(loc=pred_z_mean, scale=pred_z_var + EPS)
         pred_z_sampled = pred_z_dist.sample(
-            (self.num_sample,)
+            (self.num_sample,), sampler=self.sampler
         )  # [n, bs, time, num_node]
         pred_z_sampled = pred_z_sampled.transpose(1, 0).reshape(
             bsn, test_step, self.num_node
@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 import numpy as np
 
@@ -13,10 +13,12 @@ from knowledge_tracing.psikt.GMVAE import EPS
 class VarGT(nn.Module):
     """
     Basic class of graph representations and parameterizations with ground-truth graph.
+    The graph is loaded once and kept in a non-persistent buffer, so it follows the module
+    across devices without being saved in the state_dict.
     Attributes:
         device: Device used.
         num_nodes: Number of nodes in the graph.
-        tau_gumbel: Temperature used for gumbel softmax sampling.
+        gt_adj_path: Path of the ground-truth adjacency matrix (.npy).
     Methods:
         sample_A: Samples an adjacency matrix.
 
@@ -28,17 +30,37 @@ class VarGT(nn.Module):
         self.num_nodes = num_nodes
         self.gt_adj_path = gt_adj_path
 
+        adj = torch.from_numpy(np.load(self.gt_adj_path)).to(self.device)
+        self.register_buffer("adj", adj, persistent=False)
+
     def sample_A(self, num_graph: int = None) -> torch.Tensor:
         """
         Samples an adjacency matrix. Given ground-truth graph, no need to sample.
         Args:
             num_graph: Number of graphs to sample.
         Returns:
-            A binary adjacency matrix, size (num_graph, num_nodes, num_nodes).
+            A binary adjacency matrix, size (1, num_nodes, num_nodes).
+        """
+        return None, None, self.adj.unsqueeze(0)
+
+    def expected_A(self, num_graph: int = None) -> torch.Tensor:
+        """
+        Returns the ground-truth adjacency matrix, size (num_nodes, num_nodes).
+        """
+        return self.adj
+
+    def empowerment(
+        self, num_graph: int = None
+    ) -> Callable[[torch.Tensor], torch.Tensor]:
         """
-        adj = np.load(self.gt_adj_path)
-        adj = torch.from_numpy(adj).to(self.device).unsqueeze(0)
-        return None, None, adj
+        Returns the operator z -> z @ A of the ground-truth graph (adj_ij means i has
+        influence on j).
+        """
+
+        def empower(z: torch.Tensor) -> torch.Tensor:
+            return z @ self.adj.to(z.dtype)
+
+        return empower
 
 
 class VarDistribution(nn.Module):
@@ -58,6 +80,8 @@ class VarDistribution(nn.Module):
         self.device = device
         self.num_nodes = num_nodes
         self.tau_gumbel = tau_gumbel
+        self._expected_A = None
+        self._expected_A_key = None
 
     def edge_log_probs(self, latents: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
@@ -71,22 +95,73 @@ class VarDistribution(nn.Module):
             A binary adjacency matrix, size (num_graph, num_nodes, num_nodes).
         """
         logits = self.edge_log_probs()
+        probs = self._gumbel_A(logits, num_graph, hard=False)
+        adj = self._gumbel_A(logits, num_graph, hard=True)
+        return logits, probs, adj
+
+    def _gumbel_A(
+        self, logits: torch.Tensor, num_graph: int, hard: bool
+    ) -> torch.Tensor:
+        """
+        Draws num_graph gumbel-softmax samples of the edges at once, with independent noise
+        for every graph.
+        Args:
+            logits: Edge log probabilities, size (2, num_nodes, num_nodes).
+            num_graph: Number of graphs to sample.
+            hard: Whether to return one-hot samples (straight-through gradients).
+        Returns:
+            Sampled adjacency matrices, size (num_graph, 1, num_nodes, num_nodes).
+        """
         off_diag_mask = 1 - torch.eye(self.num_nodes, device=logits.device)
+        logits_mc = logits.expand(num_graph, *logits.shape)  # [num_graph, 2, n, n]
+        sample = F.gumbel_softmax(logits_mc, tau=self.tau_gumbel, hard=hard, dim=1)
+        return sample[:, 1:] * off_diag_mask  # Force zero diagonals
 
-        probs = [
-            F.gumbel_softmax(logits, tau=self.tau_gumbel, hard=False, dim=0)[1:]
-            for _ in range(num_graph)
-        ]
-        probs = torch.stack(probs)
-        probs = probs * off_diag_mask
-
-        sample = [
-            F.gumbel_softmax(logits, tau=self.tau_gumbel, hard=True, dim=0)[1:]
-            for _ in range(num_graph)
-        ]
-        sample = torch.stack(sample)
-        adj = sample * off_diag_mask  # Force zero diagonals
-        return logits, probs, adj
+    def expected_A(self, num_graph: int = 1) -> torch.Tensor:
+        """
+        Estimates the expected adjacency matrix by the mean of num_graph sampled graphs.
+        If no gradient can reach the graph parameters (under torch.no_grad, or when they are
+        frozen), the estimate is cached and reused until the parameters are updated.
+        Args:
+            num_graph: Number of graphs to sample.
+        Returns:
+            The expected adjacency matrix, size (num_nodes, num_nodes).
+        """
+        key = self._cache_key(num_graph)
+        if key is not None and key == self._expected_A_key:
+            return self._expected_A
+
+        # only the hard samples are averaged, the soft ones of sample_A are not drawn
+        adj = self._gumbel_A(self.edge_log_probs(), num_graph, hard=True)
+        adj = adj[:, 0].mean(0)
+        if key is not None:
+            self._expected_A, self._expected_A_key = adj, key
+        return adj
+
+    def _cache_key(self, *args) -> Optional[tuple]:
+        """
+        Key identifying the current values of the graph parameters (and args), or None if
+        gradients can reach the parameters, in which case nothing may be cached.
+        """
+        params = list(self.parameters())
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return None
+        # in-place updates (optimizer steps, load_state_dict) bump the tensor versions
+        return args + tuple((p.data_ptr(), p._version) for p in params)
+
+    def empowerment(self, num_graph: int = 1) -> Callable[[torch.Tensor], torch.Tensor]:
+        """
+        Returns the operator z -> z @ E[A] that sums the values of the nodes influencing every
+        node (adj_ij means i has influence on j). The graph is evaluated once, so the operator
+        can be applied at every step of a rollout.
+        Args:
+            num_graph: Number of graphs sampled to estimate E[A].
+        Returns:
+            A function mapping node values of size (..., num_nodes) to the incoming influence
+            of every node, of the same size.
+        """
+        adj = self.expected_A(num_graph)
+        return lambda z: z @ adj.to(z.device)
 
 
 class VarConstant(VarDistribution):
@@ -112,6 +187,12 @@ class VarConstant(VarDistribution):
         logits = torch.log(probs)
         return logits, probs, adj
 
+    def expected_A(self, num_graph: int = 1) -> torch.Tensor:
+        """
+        Returns the constant adjacency matrix, size (num_nodes, num_nodes).
+        """
+        return self.sample_A(num_graph)[-1][0, 0]
+
 
 class VarBasic(VarDistribution):
     """
@@ -526,6 +607,12 @@ class VarTransformation(VarDistribution):
         alpha_linear (float): slope of of linear schedule for inverse temperature :math:`\\alpha`
                                 of sigmoid in latent graph model :math:`p(G | Z)`
         dense_init: whether the initialization of latent variables is from a uniform distribution (False) or torch.ones(True)
+        topk: If > 0, the empowerment only uses the topk source nodes of every node, so its cost
+            is linear in the number of nodes instead of quadratic.
+        refresh_every: Number of optimizer steps (counted with `step`) after which the topk
+            sources are selected again in training mode.
+        chunk_size: Number of target nodes whose incoming edges are evaluated together when
+            selecting the topk sources.
     """
 
     def __init__(
@@ -535,11 +622,25 @@ class VarTransformation(VarDistribution):
         tau_gumbel,
         dense_init=False,
         latent_dim=128,
+        topk=0,
+        refresh_every=100,
+        chunk_size=1024,
     ):
         super().__init__(device, num_nodes, tau_gumbel)
         self.dense_init = dense_init 
         self.latent_dim = latent_dim
 
+        # sparse empowerment: every node is only influenced by its topk strongest sources
+        self.topk = min(topk, num_nodes - 1)
+        self.refresh_every = refresh_every
+        self.chunk_size = chunk_size
+        self.num_steps = 0
+        self.refresh_step = 0
+        self.register_buffer("topk_src", None, persistent=False)
+        self._topk_weights = None
+        self._topk_weights_key = None
+        self._topk_weights_src = None
+
         alpha_linear = 0.05
         self.alpha = lambda t: (alpha_linear * t)
 
@@ -592,3 +693,107 @@ class VarTransformation(VarDistribution):
         log_probs, log_probs_neg = torch.log(probs + EPS), torch.log(1 - probs + EPS)
 
         return torch.stack([log_probs, log_probs_neg])
+
+    def _expected_edges(self, u_src: torch.Tensor, u_dst: torch.Tensor) -> torch.Tensor:
+        """
+        Expectation of the hard samples of sample_A for the edges u_src -> u_dst, evaluated
+        from the node embeddings without building the full adjacency matrix.
+        Args:
+            u_src: Embeddings of the source nodes, size (..., latent_dim).
+            u_dst: Embeddings of the target nodes, broadcastable to u_src.
+        Returns:
+            The expected edge weights, size (...).
+        """
+        u_src_trans = u_src @ self._antisymmetric_transformation(u_src.device)
+        return self._edge_weights(
+            (u_src * u_dst).sum(-1), (u_src_trans * u_dst).sum(-1)
+        )
+
+    def _antisymmetric_transformation(self, device: torch.device) -> torch.Tensor:
+        """
+        The matrix W - W^T of the direction logits u_src @ (W - W^T) @ u_dst.
+        """
+        trans_matrix = self.transformation_layer.to(device)
+        return trans_matrix - trans_matrix.transpose(-1, -2)
+
+    @staticmethod
+    def _edge_weights(
+        logit_existing: torch.Tensor, logit_directed: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Expected edge weights from the logits of the existence and of the direction of the
+        edges, as in _expected_edges.
+        """
+        probs = torch.sigmoid(logit_existing) * torch.sigmoid(logit_directed)
+        log_probs = torch.stack([torch.log(probs + EPS), torch.log(1 - probs + EPS)])
+        return F.softmax(log_probs, dim=0)[1]
+
+    def step(self) -> None:
+        """
+        Counts one optimizer step, called by the runners once per parameter update however
+        many times `empowerment` ran for it (chunks, EM phases, several rollouts).
+        """
+        self.num_steps += 1
+
+    @torch.no_grad()
+    def refresh_topk(self) -> None:
+        """
+        Selects the topk source nodes with the largest expected edge weights for every node.
+        The weights are evaluated for chunk_size target nodes at a time, with the dot
+        products of the embeddings as matrix products, so the memory is
+        O(num_nodes * (chunk_size + latent_dim)) instead of O(num_nodes^2).
+        """
+        u = self._get_node_embedding()
+        u_trans = u @ self._antisymmetric_transformation(u.device)  # [num_nodes, dim]
+        topk_src = []
+        for start in range(0, self.num_nodes, self.chunk_size):
+            u_dst_t = u[start : start + self.chunk_size].t()  # [dim, chunk]
+            weights = self._edge_weights(
+                u @ u_dst_t, u_trans @ u_dst_t
+            )  # [num_nodes, chunk]
+            dst = torch.arange(u_dst_t.shape[1], device=u.device)
+            weights[start + dst, dst] = -float("inf")  # no self-loops
+            topk_src.append(weights.topk(self.topk, dim=0).indices.t())  # [chunk, topk]
+        self.topk_src = torch.cat(topk_src)  # [num_nodes, topk]
+
+    def empowerment(self, num_graph: int = 1) -> Callable[[torch.Tensor], torch.Tensor]:
+        """
+        Returns the operator z -> z @ E[A]. With topk > 0, every node only sums the values of
+        its topk sources, weighted by the exact expected edge weights; the sources are
+        selected again in training mode once refresh_every optimizer steps have passed.
+        Args:
+            num_graph: Number of graphs sampled to estimate E[A] (dense operator only).
+        Returns:
+            A function mapping node values of size (..., num_nodes) to the incoming influence
+            of every node, of the same size.
+        """
+        if not self.topk:
+            return super().empowerment(num_graph)
+
+        if self.topk_src is None or (
+            self.training and self.num_steps - self.refresh_step >= self.refresh_every
+        ):
+            self.refresh_topk()
+            self.refresh_step = self.num_steps
+
+        src = self.topk_src
+        # the cache holds on to its sources, so they are compared by identity
+        key = self._cache_key()
+        if (
+            key is not None
+            and key == self._topk_weights_key
+            and src is self._topk_weights_src
+        ):
+            weights = self._topk_weights
+        else:
+            u = self._get_node_embedding()
+            weights = self._expected_edges(u[src], u.unsqueeze(1))  # [num_nodes, topk]
+            if key is not None:
+                self._topk_weights, self._topk_weights_key = weights, key
+                self._topk_weights_src = src
+
+        def empower(z: torch.Tensor) -> torch.Tensor:
+            z_src = z.index_select(-1, src.flatten()).view(*z.shape, self.topk)
+            return (z_src * weights.to(z.device)).sum(-1)
+
+        return empower
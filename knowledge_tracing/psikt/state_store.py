@@ -0,0 +1,367 @@
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+from collections import OrderedDict
+
+import numpy as np
+
+import torch
+
+EVICTION_POLICIES = ["lru", "fifo"]
+# Storage dtypes of the variances of WindowedStateBuffers
+STATE_VAR_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+# Dtypes without a numpy equivalent, stored as raw bytes on disk
+RAW_DTYPES = {torch.bfloat16}
+
+
+class LearnerStateStore:
+    """
+    Store of per-learner records (e.g. the filtering states of the PSI-KT models), with an
+    in-memory tier of bounded size and an optional memory-mapped tier on disk.
+
+    A record is a fixed set of named tensors, described by `fields` {name: (shape, dtype)}
+    as returned by `state_fields` of the PSI-KT models. The memory tier keeps up to
+    `capacity` records in preallocated tensors, so batched `get`/`put` copy whole
+    micro-batches with one indexing operation per field. When the memory tier is full, the
+    least recently used (`eviction='lru'`) or the oldest (`eviction='fifo'`) records are
+    evicted: they are written to the disk tier if there is one and dropped otherwise.
+    Records are read back from disk into memory on access. `get` and `put` may be limited
+    to some of the fields, e.g. to update one field of the records.
+
+    The disk tier is a numpy memmap of structured records at `path`, which grows by
+    doubling. Each learner keeps its row, and the learner id of every row is saved to
+    `path.index.npy` by `flush`, so a store opened on the same path after `flush` finds the
+    records again.
+
+    Args:
+        fields: The shape (without the batch dimension) and dtype of every tensor of a
+            record.
+        capacity: The maximal number of records in memory.
+        path: The file of the disk tier. If None, evicted records are dropped.
+        eviction: The eviction policy of the memory tier, 'lru' or 'fifo'.
+        device: The device of the memory tier.
+    """
+
+    def __init__(
+        self,
+        fields: Dict[str, Tuple[Tuple[int, ...], torch.dtype]],
+        capacity: int = 100000,
+        path: Path = None,
+        eviction: str = "lru",
+        device: torch.device = "cpu",
+    ) -> None:
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(
+                "Unknown eviction policy {}, expected one of {}".format(
+                    eviction, EVICTION_POLICIES
+                )
+            )
+        self.fields = fields
+        self.capacity = capacity
+        self.eviction = eviction
+        self.device = torch.device(device)
+
+        # memory tier: learner id -> slot, in eviction order
+        self._slots = OrderedDict()
+        self._free_slots = list(range(capacity - 1, -1, -1))
+        self._memory = {
+            name: torch.zeros((capacity,) + tuple(shape), dtype=dtype, device=device)
+            for name, (shape, dtype) in fields.items()
+        }
+
+        # disk tier: learner id -> row of the memmap
+        self.path = Path(path) if path is not None else None
+        self._rows = {}
+        self._disk = None
+        if self.path is not None:
+            self._open_disk()
+
+    def __len__(self) -> int:
+        """
+        Number of learners with a stored record, in memory or on disk.
+        """
+        return len(self._slots.keys() | self._rows.keys())
+
+    def __contains__(self, learner: int) -> bool:
+        return learner in self._slots or learner in self._rows
+
+    @property
+    def index_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".index.npy")
+
+    def _open_disk(self) -> None:
+        """
+        Open the memmap of the disk tier, with the rows saved by a previous `flush`.
+        """
+        disk_fields = []
+        for name, (shape, dtype) in self.fields.items():
+            if dtype in RAW_DTYPES:
+                # numpy has no bfloat16: the memmap holds the raw bytes of the values
+                size = int(np.prod(shape)) * torch.empty(0, dtype=dtype).element_size()
+                disk_fields.append((name, np.uint8, (size,)))
+            else:
+                np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+                disk_fields.append((name, np_dtype, tuple(shape)))
+        self._disk_dtype = np.dtype(disk_fields)
+        if self.path.exists() and self.index_path.exists():
+            row_ids = np.load(self.index_path)
+            self._rows = {int(learner): row for row, learner in enumerate(row_ids)}
+            num_rows = self.path.stat().st_size // self._disk_dtype.itemsize
+            self._disk = np.memmap(
+                self.path, dtype=self._disk_dtype, mode="r+", shape=(num_rows,)
+            )
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._disk = np.memmap(
+                self.path, dtype=self._disk_dtype, mode="w+", shape=(1024,)
+            )
+
+    def _grow_disk(self, num_rows: int) -> None:
+        """
+        Resize the memmap to hold at least num_rows rows, doubling its size.
+        """
+        size = len(self._disk)
+        if num_rows <= size:
+            return
+        while size < num_rows:
+            size *= 2
+        self._disk.flush()
+        self._disk = None
+        with open(self.path, "r+b") as f:
+            f.truncate(size * self._disk_dtype.itemsize)
+        self._disk = np.memmap(
+            self.path, dtype=self._disk_dtype, mode="r+", shape=(size,)
+        )
+
+    def _write_disk(self, learners: list, slots: list) -> None:
+        """
+        Copy the records of the given memory slots to the disk rows of their learners.
+        """
+        if self._disk is None or not learners:
+            return
+        for learner in learners:
+            if learner not in self._rows:
+                self._rows[learner] = len(self._rows)
+        self._grow_disk(len(self._rows))
+        rows = np.array([self._rows[learner] for learner in learners])
+        slots = torch.tensor(slots, device=self.device)
+        for name, memory in self._memory.items():
+            values = memory[slots].cpu()
+            if memory.dtype in RAW_DTYPES:
+                values = values.reshape(len(learners), -1).view(torch.uint8)
+            self._disk[name][rows] = values.numpy()
+
+    def _read_disk(self, learners: list, pinned: set) -> None:
+        """
+        Load the records of learners that are on disk but not in memory into memory.
+        """
+        learners = [i for i in learners if i not in self._slots and i in self._rows]
+        if not learners:
+            return
+        slots = torch.tensor(self._allocate(learners, pinned), device=self.device)
+        rows = np.array([self._rows[i] for i in learners])
+        for name, memory in self._memory.items():
+            values = torch.from_numpy(np.ascontiguousarray(self._disk[name][rows]))
+            if memory.dtype in RAW_DTYPES:
+                values = values.view(memory.dtype).reshape((-1,) + memory.shape[1:])
+            memory[slots] = values.to(self.device)
+
+    def _evict(self, num_slots: int, pinned: set) -> None:
+        """
+        Free num_slots memory slots, skipping the learners of the current batch.
+        """
+        victims, victim_slots = [], []
+        for learner, slot in self._slots.items():
+            if len(victims) == num_slots:
+                break
+            if learner not in pinned:
+                victims.append(learner)
+                victim_slots.append(slot)
+        self._write_disk(victims, victim_slots)
+        for learner in victims:
+            del self._slots[learner]
+        self._free_slots.extend(victim_slots)
+
+    def _allocate(self, learners: list, pinned: set) -> list:
+        """
+        Assign zeroed memory slots to learners that are not in memory, evicting records if
+        needed.
+        """
+        if len(pinned) > self.capacity:
+            raise ValueError(
+                "A batch of {} learners does not fit a store of capacity {}".format(
+                    len(pinned), self.capacity
+                )
+            )
+        if len(learners) > len(self._free_slots):
+            self._evict(len(learners) - len(self._free_slots), pinned)
+        slots = [self._free_slots.pop() for _ in learners]
+        self._slots.update(zip(learners, slots))
+        if slots:
+            index = torch.tensor(slots, device=self.device)
+            for memory in self._memory.values():
+                memory[index] = 0
+        return slots
+
+    def get(
+        self, learner: torch.Tensor, names: Iterable[str] = None
+    ) -> Tuple[Dict[str, torch.Tensor], torch.Tensor]:
+        """
+        Read the records of a batch of learners; records on disk are loaded into memory.
+
+        Args:
+            learner: Ids of the learners, of shape [bs].
+            names: The fields to read. If None, all the fields are read.
+
+        Returns:
+            The records {name: [bs, *shape]}, zero for the learners without a record, and
+            the mask [bs] of the learners with a record.
+        """
+        ids = learner.tolist()
+        pinned = set(ids)
+        self._read_disk(list(dict.fromkeys(ids)), pinned)
+
+        found = [i in self._slots for i in ids]
+        slots = [self._slots[i] if hit else 0 for i, hit in zip(ids, found)]
+        if self.eviction == "lru":
+            for i in pinned & self._slots.keys():
+                self._slots.move_to_end(i)
+
+        found = torch.tensor(found, dtype=torch.bool, device=self.device)
+        slots = torch.tensor(slots, device=self.device)
+        records = {}
+        for name in self._memory if names is None else names:
+            records[name] = self._memory[name][slots]
+            records[name][~found] = 0
+        return records, found
+
+    def put(self, learner: torch.Tensor, records: Dict[str, torch.Tensor]) -> None:
+        """
+        Write the records of a batch of learners to the memory tier. A learner listed
+        several times keeps its last record.
+
+        Args:
+            learner: Ids of the learners, of shape [bs].
+            records: The records {name: [bs, *shape]}; keys that are not fields are ignored,
+                and the missing fields keep their stored values (zero for new learners).
+        """
+        # position of the last record of every learner
+        last = {i: pos for pos, i in enumerate(learner.tolist())}
+        pinned = set(last)
+        if not self._memory.keys() <= records.keys():
+            self._read_disk(list(last), pinned)
+        self._allocate([i for i in last if i not in self._slots], pinned)
+        if self.eviction == "lru":
+            for i in last:
+                self._slots.move_to_end(i)
+
+        slots = torch.tensor([self._slots[i] for i in last], device=self.device)
+        positions = torch.tensor(list(last.values()), device=learner.device)
+        for name, memory in self._memory.items():
+            if name in records:
+                values = records[name].detach()[positions]
+                memory[slots] = values.to(self.device, memory.dtype)
+
+    def flush(self) -> None:
+        """
+        Write all the records in memory to the disk tier, with the index of its rows.
+        """
+        if self._disk is None:
+            return
+        self._write_disk(list(self._slots), list(self._slots.values()))
+        self._disk.flush()
+        row_ids = np.empty(len(self._rows), dtype=np.int64)
+        for learner, row in self._rows.items():
+            row_ids[row] = learner
+        np.save(self.index_path, row_ids)
+
+
+class WindowedStateBuffers:
+    """
+    Per-learner moments of the last `window` time steps, e.g. the predicted and inferred
+    posteriors of ContinualPSIKT, which only read the current and the previous step.
+
+    The moments of every learner are a record of a LearnerStateStore, so that at most
+    `capacity` learners are kept in memory and the others are spilled to disk. Every field
+    is a ring buffer [window, dim] indexed by the time step modulo `window`, so a step
+    older than `window - 1` steps is overwritten. Means are kept in float32 while diagonal
+    variances may be kept in float16/bfloat16; reads return float32. The buffers are
+    outside the `state_dict` of the model. With a `path`, the disk tier of the store is the
+    file `path/moments.bin`, which is reopened after `flush`.
+
+    Args:
+        fields: The dimension and storage dtype of every field.
+        num_seq: The number of learners.
+        window: The number of time steps kept per learner.
+        path: The directory of the disk tier. If None, the moments of the learners evicted
+            from memory are dropped.
+        device: The device of the memory tier.
+        capacity: The maximal number of learners in memory. If None, all the `num_seq`
+            learners are kept in memory.
+        eviction: The eviction policy of the memory tier, 'lru' or 'fifo'.
+    """
+
+    def __init__(
+        self,
+        fields: Dict[str, Tuple[int, torch.dtype]],
+        num_seq: int,
+        window: int,
+        path: Path = None,
+        device: torch.device = "cpu",
+        capacity: int = None,
+        eviction: str = "lru",
+    ) -> None:
+        self.fields = fields
+        self.num_seq = num_seq
+        self.window = window
+        self.path = Path(path) if path is not None else None
+        self.store = LearnerStateStore(
+            {name: ((window, dim), dtype) for name, (dim, dtype) in fields.items()},
+            capacity=capacity or num_seq,
+            path=self.path / "moments.bin" if self.path is not None else None,
+            eviction=eviction,
+            device=device,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the memory tier in bytes.
+        """
+        return sum(m.numel() * m.element_size() for m in self.store._memory.values())
+
+    def read(self, name: str, user: torch.Tensor, idx: int) -> torch.Tensor:
+        """
+        Read the values of a field at time step idx.
+
+        Args:
+            name: The field.
+            user: Ids of the learners, of shape [bs].
+            idx: The time step.
+
+        Returns:
+            The values [bs, 1, dim] in float32, on the device of `user`.
+        """
+        values = self.store.get(user, [name])[0][name][:, idx % self.window]
+        return values.unsqueeze(1).to(user.device, torch.float32)
+
+    def write(
+        self, name: str, user: torch.Tensor, idx: int, value: torch.Tensor
+    ) -> None:
+        """
+        Write the values of a field at time step idx, of a shape broadcastable to
+        [bs, 1, dim].
+        """
+        user = user.to(self.store.device)
+        values = self.store.get(user, [name])[0][name]
+        values[:, idx % self.window] = value.detach().squeeze(-2).to(values)
+        self.store.put(user, {name: values})
+
+    def flush(self) -> None:
+        """
+        Write the moments in memory to the disk tier.
+        """
+        self.store.flush()
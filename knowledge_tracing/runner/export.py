@@ -0,0 +1,185 @@
+import json, inspect
+from pathlib import Path
+from typing import List
+
+import torch
+
+from knowledge_tracing.runner.prediction_server import build_prediction_frame
+
+# Column of the prediction frame (see build_prediction_frame) that every input of the
+# feed dicts of the models is read from
+FEED_COLUMNS = {
+    "skill_seq": "skill_seq",
+    "label_seq": "correct_seq",
+    "time_seq": "time_seq",
+    "problem_seq": "problem_seq",
+    "quest_seq": "problem_seq",
+    "num_history": "num_history",
+    "num_success": "num_success",
+    "num_failure": "num_failure",
+    "user_id": "user_id",
+    "user_seq": "user_id",
+}
+# Inputs of the models that sort the batch by sequence length (DKT); the rows of a
+# prediction frame have the same length, so the identity order is used
+LENGTH_SORT_KEYS = ["length", "indice", "inverse_indice"]
+META_FILE = "meta.json"
+
+
+class PredictiveModule(torch.nn.Module):
+    """
+    Wrap the predictive model of a trained model into a module of positional tensors,
+    returning the probabilities [bs, test_step] of correct answers averaged over the
+    samples, so that it can be traced.
+
+    Args:
+        model: The trained model, with `predictive_model` and `args`.
+        keys: The keys of the feed dict, in the order of the inputs.
+    """
+
+    def __init__(self, model: torch.nn.Module, keys: List[str]) -> None:
+        super().__init__()
+        self.model = model
+        self.keys = keys
+        self.test_step = int(model.args.max_step * model.args.test_time_ratio)
+
+    def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+        out_dict = self.model.predictive_model(dict(zip(self.keys, inputs)))
+        prediction = out_dict["prediction"]
+        return prediction.reshape(prediction.shape[0], -1, self.test_step).mean(1)
+
+
+def export_model(
+    model: torch.nn.Module,
+    corpus,
+    path: Path,
+    model_name: str = None,
+    num_example: int = 2,
+) -> dict:
+    """
+    Trace the predictive model of a trained model (AmortizedPSIKT or a baseline) and save it
+    as a TorchScript artifact, loaded by ExportedModel with torch alone.
+
+    The model is traced on `num_example` learners of the corpus; the artifact accepts any
+    batch size, of sequences of the lengths set by the model's arguments. Random sampling (PSI-KT)
+    is kept in the traced graph, while the graph of PSI-KT is frozen to its estimate at
+    export time, as the cached estimate of an evaluated model.
+
+    Args:
+        model: The trained model.
+        corpus: The corpus the model was trained on.
+        path: The file of the artifact.
+        model_name: The name saved with the artifact.
+        num_example: The number of learners the model is traced on.
+
+    Returns:
+        The metadata saved with the artifact.
+    """
+    if "idx" in inspect.signature(model.predictive_model).parameters:
+        raise ValueError(
+            "{} cannot be exported: its predictions depend on the time step of "
+            "continual learning".format(type(model).__name__)
+        )
+    args = model.args
+    train_step = int(args.max_step * args.train_time_ratio)
+    test_step = int(args.max_step * args.test_time_ratio)
+    example = corpus.data_df["whole"].iloc[:num_example]
+    requests = [
+        {
+            "learner": int(row["user_id"]),
+            "skill_seq": row["skill_seq"][:train_step],
+            "correct_seq": row["correct_seq"][:train_step],
+            "time_seq": row["time_seq"][:train_step],
+            "problem_seq": row["problem_seq"][:train_step],
+            "next_skill_seq": row["skill_seq"][train_step : train_step + test_step],
+            "next_time_seq": row["time_seq"][train_step : train_step + test_step],
+            "next_problem_seq": row["problem_seq"][train_step : train_step + test_step],
+        }
+        for _, row in example.iterrows()
+    ]
+    frame = build_prediction_frame(requests, train_step, test_step)
+    feed_dict = model.get_feed_dict(corpus, frame, 0, len(frame), "test")
+    inputs = {
+        key: value
+        for key, value in feed_dict.items()
+        if isinstance(value, torch.Tensor)
+    }
+    unknown = [
+        key for key in inputs if key not in FEED_COLUMNS and key not in LENGTH_SORT_KEYS
+    ]
+    if unknown:
+        raise ValueError(
+            "{} cannot be exported: the inputs {} are not columns of the requests".format(
+                type(model).__name__, unknown
+            )
+        )
+
+    meta = {
+        "model_name": model_name or type(model).__name__,
+        "train_step": train_step,
+        "test_step": test_step,
+        "inputs": [[key, str(value.dtype)] for key, value in inputs.items()],
+    }
+    module = PredictiveModule(model, list(inputs)).eval()
+    example_inputs = ExportedModel.feed_inputs(meta, frame, args.device)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, tuple(example_inputs), check_trace=False)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(traced, str(path), _extra_files={META_FILE: json.dumps(meta)})
+    return meta
+
+
+class ExportedModel:
+    """
+    Predictive model exported by export_model, which loads without the model classes, the
+    corpus or the training arguments.
+
+    Args:
+        path: The file of the artifact.
+        device: The device the model runs on.
+    """
+
+    def __init__(self, path: Path, device: torch.device = "cpu") -> None:
+        extra_files = {META_FILE: ""}
+        self.module = torch.jit.load(
+            str(path), map_location=device, _extra_files=extra_files
+        )
+        self.meta = json.loads(extra_files[META_FILE])
+        self.model_name = self.meta["model_name"]
+        self.train_step = self.meta["train_step"]
+        self.test_step = self.meta["test_step"]
+        self.device = device
+
+    @staticmethod
+    def feed_inputs(
+        meta: dict, frame, device: torch.device = "cpu"
+    ) -> List[torch.Tensor]:
+        """
+        Build the inputs of the traced module from a prediction frame.
+        """
+        inputs = []
+        num_step = len(frame["skill_seq"].iloc[0])
+        for key, dtype in meta["inputs"]:
+            dtype = getattr(torch, dtype.replace("torch.", ""))
+            if key in FEED_COLUMNS:
+                value = torch.tensor(frame[FEED_COLUMNS[key]].tolist(), dtype=dtype)
+            elif key == "length":
+                value = torch.full((len(frame),), num_step, dtype=dtype)
+            else:
+                value = torch.arange(len(frame), dtype=dtype)
+            inputs.append(value.to(device))
+        return inputs
+
+    def predict_requests(self, requests: List[dict]) -> List[List[float]]:
+        """
+        Predict the correctness probabilities of the next items of a batch of requests, as
+        prediction_server.predict_requests.
+        """
+        frame = build_prediction_frame(requests, self.train_step, self.test_step)
+        inputs = self.feed_inputs(self.meta, frame, self.device)
+        with torch.no_grad():
+            prediction = self.module(*inputs).cpu().numpy()
+        return [
+            prediction[i, : len(request["next_skill_seq"])].tolist()
+            for i, request in enumerate(requests)
+        ]
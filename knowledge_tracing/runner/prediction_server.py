@@ -0,0 +1,499 @@
+import json, asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+HTTP_STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+
+
+def _is_integer(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+def _is_number(value) -> bool:
+    return (
+        isinstance(value, (int, float, np.number))
+        and not isinstance(value, bool)
+        and np.isfinite(value)
+    )
+
+
+def _check_ids(request: dict, key: str, default: str, num_ids: int) -> None:
+    ids = request.get(key, request[default])
+    if not isinstance(ids, list) or not all(_is_integer(i) for i in ids):
+        raise ValueError("{} must be a list of integers".format(key))
+    if len(ids) != len(request[default]):
+        raise ValueError("{} and {} differ in length".format(key, default))
+    if any(i < 0 for i in ids):
+        raise ValueError("{} has negative ids".format(key))
+    if num_ids is not None and any(i >= num_ids for i in ids):
+        raise ValueError("{} has ids outside [0, {})".format(key, num_ids))
+
+
+def validate_request(
+    request: dict,
+    train_step: int,
+    test_step: int,
+    num_skills: int = None,
+    num_problems: int = None,
+) -> None:
+    """
+    Check that a prediction request can be answered, raising a ValueError otherwise.
+
+    A request is a dict with the learner's history, `skill_seq`, `correct_seq` and
+    `time_seq` (optionally `problem_seq` and `learner`), of at least `train_step`
+    interactions, and the next items to predict, `next_skill_seq` and `next_time_seq`
+    (optionally `next_problem_seq`), of 1 to `test_step` items. The ids are integers in
+    [0, num_skills) and [0, num_problems) when these are given (the problems default to
+    the skills), the outcomes 0 or 1 and the times finite numbers.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    for key in [
+        "skill_seq",
+        "correct_seq",
+        "time_seq",
+        "next_skill_seq",
+        "next_time_seq",
+    ]:
+        if key not in request:
+            raise ValueError("Missing field: " + key)
+        if not isinstance(request[key], list):
+            raise ValueError("{} must be a list".format(key))
+    num_history = len(request["skill_seq"])
+    if num_history < train_step:
+        raise ValueError(
+            "The history has {} interactions, the model needs at least {}".format(
+                num_history, train_step
+            )
+        )
+    lengths = {len(request[key]) for key in ["skill_seq", "correct_seq", "time_seq"]}
+    if len(lengths) > 1:
+        raise ValueError("skill_seq, correct_seq and time_seq differ in length")
+    num_next = len(request["next_skill_seq"])
+    if not 1 <= num_next <= test_step:
+        raise ValueError(
+            "{} next items requested, the model predicts 1 to {}".format(
+                num_next, test_step
+            )
+        )
+    if len(request["next_time_seq"]) != num_next:
+        raise ValueError("next_skill_seq and next_time_seq differ in length")
+
+    _check_ids(request, "skill_seq", "skill_seq", num_skills)
+    _check_ids(request, "next_skill_seq", "next_skill_seq", num_skills)
+    _check_ids(request, "problem_seq", "skill_seq", num_problems)
+    _check_ids(request, "next_problem_seq", "next_skill_seq", num_problems)
+    if not all(
+        label in (0, 1) and _is_number(label) for label in request["correct_seq"]
+    ):
+        raise ValueError("correct_seq must only contain 0 and 1")
+    for key in ["time_seq", "next_time_seq"]:
+        if not all(_is_number(t) for t in request[key]):
+            raise ValueError("{} must be a list of numbers".format(key))
+    if "learner" in request and not _is_integer(request["learner"]):
+        raise ValueError("learner must be an integer")
+
+
+def build_prediction_frame(
+    requests: List[dict],
+    train_step: int,
+    test_step: int,
+) -> pd.DataFrame:
+    """
+    Turn prediction requests into a frame with the columns of `corpus.data_df`, so that
+    every model builds its inputs with its own `get_feed_dict`.
+
+    Each row holds the last `train_step` interactions of the history followed by the next
+    items, padded to `test_step` by repeating the last one. As in DataReader, timestamps
+    start at 0 and the per-skill counts cover the whole row; the outcomes of the next items
+    are unknown and set to 0.
+
+    Args:
+        requests: Valid prediction requests (see validate_request).
+        train_step: Number of history steps of the model.
+        test_step: Number of predicted steps of the model.
+
+    Returns:
+        A DataFrame with one row per request.
+    """
+    rows = []
+    for request in requests:
+        num_pad = test_step - len(request["next_skill_seq"])
+
+        def history(key, default):
+            return list(request.get(key, request[default]))[-train_step:]
+
+        def future(key, default):
+            seq = list(request.get(key, request[default]))
+            return seq + seq[-1:] * num_pad
+
+        skill_seq = history("skill_seq", "skill_seq") + future(
+            "next_skill_seq", "next_skill_seq"
+        )
+        problem_seq = history("problem_seq", "skill_seq") + future(
+            "next_problem_seq", "next_skill_seq"
+        )
+        correct_seq = [int(label) for label in history("correct_seq", "correct_seq")]
+        correct_seq += [0] * test_step
+        time_seq = np.array(
+            history("time_seq", "time_seq") + future("next_time_seq", "next_time_seq"),
+            dtype=np.int64,
+        )
+
+        num_history, num_success = [], []
+        skill_count, skill_success = defaultdict(int), defaultdict(int)
+        for skill, label in zip(skill_seq, correct_seq):
+            num_history.append(skill_count[skill])
+            skill_count[skill] += 1
+            skill_success[skill] += label
+            num_success.append(max(skill_success[skill] - 1, 0))
+
+        rows.append(
+            {
+                "user_id": int(request.get("learner", 0)),
+                "skill_seq": skill_seq,
+                "correct_seq": correct_seq,
+                "time_seq": (time_seq - time_seq.min()).tolist(),
+                "problem_seq": problem_seq,
+                "num_history": num_history,
+                "num_success": num_success,
+                "num_failure": [h - s for h, s in zip(num_history, num_success)],
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def predict_requests(
+    model: torch.nn.Module,
+    corpus,
+    requests: List[dict],
+    device: torch.device = "cpu",
+) -> List[List[float]]:
+    """
+    Predict the correctness probabilities of the next items of a batch of requests with
+    the `predictive_model` of a trained model (AmortizedPSIKT or a baseline).
+
+    Predictions drawn from several samples (PSI-KT) are averaged.
+
+    Returns:
+        One list of probabilities per request, for its next items.
+    """
+    train_step = int(model.args.max_step * model.args.train_time_ratio)
+    test_step = int(model.args.max_step * model.args.test_time_ratio)
+    frame = build_prediction_frame(requests, train_step, test_step)
+    batch = model.get_feed_dict(corpus, frame, 0, len(frame), "test")
+    batch = model.batch_to_gpu(batch, device)
+    with torch.no_grad():
+        out_dict = model.predictive_model(batch)
+    prediction = out_dict["prediction"].reshape(len(requests), -1, test_step)
+    prediction = prediction.mean(1).cpu().numpy()
+    return [
+        prediction[i, : len(request["next_skill_seq"])].tolist()
+        for i, request in enumerate(requests)
+    ]
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent prediction requests into micro-batches.
+
+    `submit` queues a request and waits for its result. A worker takes the first queued
+    request and waits at most `max_wait_ms` for others to join it, up to `max_batch_size`
+    requests, then runs `predict_fn` on the batch in a single worker thread so that the
+    event loop keeps accepting requests meanwhile. Requests arriving while a batch is
+    computed are batched together as soon as the model is free, so the batches grow with
+    the load and the waiting deadline only matters at low load. If a batch fails, its
+    requests are predicted one at a time, so that only the failing ones get the error.
+
+    Args:
+        predict_fn: Maps a list of requests to the list of their results.
+        max_batch_size: The maximal number of requests per batch.
+        max_wait_ms: How long the first request of a batch waits for others.
+    """
+
+    def __init__(
+        self,
+        predict_fn: Callable[[List[dict]], list],
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ) -> None:
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.num_batches = 0
+        self.num_requests = 0
+
+    async def submit(self, request: dict):
+        """
+        Queue a request and wait for its result.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[dict, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        """
+        Process the queued requests until cancelled.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            requests = [request for request, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predict_fn, requests
+                )
+            except Exception as e:
+                if len(batch) == 1:
+                    _, future = batch[0]
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                for request_future in batch:
+                    await self._run_single(loop, *request_future)
+                continue
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run_single(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        request: dict,
+        future: asyncio.Future,
+    ) -> None:
+        try:
+            (result,) = await loop.run_in_executor(
+                self.executor, self.predict_fn, [request]
+            )
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.num_batches += 1
+        self.num_requests += 1
+        if not future.done():
+            future.set_result(result)
+
+
+class PredictionServer:
+    """
+    Minimal HTTP/1.1 server (over TCP or a Unix socket) answering prediction requests
+    through a MicroBatcher, with keep-alive connections.
+
+    Endpoints:
+        POST /predict: a JSON request (see validate_request), answered with
+            {"prediction": [probability of a correct answer for every next item]}.
+        GET /health: the number of served requests and batches.
+
+    Args:
+        batcher: The MicroBatcher running the model.
+        train_step: Number of history steps of the model.
+        test_step: Number of predicted steps of the model.
+        num_skills: Number of skills of the model, to reject unknown skill ids.
+        num_problems: Number of problems of the model, to reject unknown problem ids.
+    """
+
+    def __init__(
+        self,
+        batcher: MicroBatcher,
+        train_step: int,
+        test_step: int,
+        num_skills: int = None,
+        num_problems: int = None,
+    ) -> None:
+        self.batcher = batcher
+        self.train_step = train_step
+        self.test_step = test_step
+        self.num_skills = num_skills
+        self.num_problems = num_problems
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, dict]:
+        if method == "GET" and path == "/health":
+            return 200, {
+                "status": "ok",
+                "num_requests": self.batcher.num_requests,
+                "num_batches": self.batcher.num_batches,
+            }
+        if method != "POST" or path != "/predict":
+            return 404, {"error": "Unknown endpoint {} {}".format(method, path)}
+        try:
+            request = json.loads(body)
+            validate_request(
+                request,
+                self.train_step,
+                self.test_step,
+                self.num_skills,
+                self.num_problems,
+            )
+        except (ValueError, TypeError) as e:
+            return 400, {"error": str(e)}
+        try:
+            return 200, {"prediction": await self.batcher.submit(request)}
+        except Exception as e:
+            return 500, {"error": "{}: {}".format(type(e).__name__, e)}
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Serve the requests of one connection until the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, headers, length = await self._read_head(
+                        reader, request_line
+                    )
+                except ValueError as e:
+                    # the rest of the stream cannot be parsed, answer and close
+                    error = "Malformed request: {}".format(e)
+                    await self._respond(writer, 400, {"error": error})
+                    break
+                body = await reader.readexactly(length)
+
+                status, payload = await self.dispatch(method, path, body)
+                await self._respond(writer, status, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_head(
+        reader: asyncio.StreamReader, request_line: bytes
+    ) -> Tuple[str, str, dict, int]:
+        """
+        Parse the request line and the headers, raising a ValueError if malformed.
+
+        Returns:
+            The method, the path, the headers (lower-case keys) and the body length.
+        """
+        method, path, _ = request_line.decode().split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            key, value = line.decode().split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length < 0:
+            raise ValueError("negative Content-Length")
+        return method, path, headers, length
+
+    @staticmethod
+    async def _respond(
+        writer: asyncio.StreamWriter, status: int, payload: dict
+    ) -> None:
+        data = json.dumps(payload).encode()
+        writer.write(
+            "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+            "Content-Length: {}\r\n\r\n".format(
+                status, HTTP_STATUS[status], len(data)
+            ).encode()
+            + data
+        )
+        await writer.drain()
+
+    async def start(
+        self, host: str = "127.0.0.1", port: int = 8000, unix_socket: str = None
+    ) -> asyncio.AbstractServer:
+        """
+        Start the batching worker and listen on a Unix socket if given, on host:port
+        otherwise.
+        """
+        self.worker = asyncio.ensure_future(self.batcher.run())
+        if unix_socket:
+            return await asyncio.start_unix_server(self.handle, path=unix_socket)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve_forever(
+        self, host: str = "127.0.0.1", port: int = 8000, unix_socket: str = None
+    ) -> None:
+        """
+        Start the server and serve until cancelled.
+        """
+        listener = await self.start(host, port, unix_socket)
+        print("Serving on {}".format(unix_socket or "{}:{}".format(host, port)))
+        async with listener:
+            await listener.serve_forever()
+
+
+async def open_connection(
+    host: str = "127.0.0.1", port: int = 8000, unix_socket: str = None
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """
+    Open a client connection to a PredictionServer.
+    """
+    if unix_socket:
+        return await asyncio.open_unix_connection(unix_socket)
+    return await asyncio.open_connection(host, port)
+
+
+async def post_request(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    request: dict,
+    path: str = "/predict",
+) -> Tuple[int, dict]:
+    """
+    Send one request over a keep-alive connection and return (status, response).
+    """
+    data = json.dumps(request).encode()
+    writer.write(
+        "POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        "Content-Length: {}\r\n\r\n".format(path, len(data)).encode() + data
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        key, value = line.decode().split(":", 1)
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
@@ -0,0 +1,41 @@
+import copy
+
+import torch
+from torch import nn
+
+# Layers whose weights are stored in int8 and whose inputs are quantized on the fly
+QUANTIZED_MODULES = {nn.Linear, nn.LSTM}
+
+
+def quantize_model(model: nn.Module, dtype: torch.dtype = torch.qint8) -> nn.Module:
+    """
+    Return a copy of a trained model for CPU inference with dynamic int8 quantization: the
+    weights of its linear layers (build_dense_network, VAEEncoder, output layers) and
+    LSTMs (the posterior of z of PSI-KT, DKT) are quantized once, their activations at
+    every call. The other layers, the graph and the transition parameters stay in float32.
+
+    Args:
+        model: The trained model (AmortizedPSIKT or a baseline), on CPU.
+        dtype: The quantized type of the weights, torch.qint8 or torch.float16.
+
+    Returns:
+        The quantized copy, in evaluation mode; the model itself is unchanged.
+    """
+    device = next(model.parameters()).device
+    if device.type != "cpu":
+        raise ValueError(
+            "Dynamic quantization runs on CPU, the model is on {}".format(device)
+        )
+    # Tensors cached by the last forward pass for the loss (e.g. the category probabilities
+    # of PSI-KT) are part of the autograd graph and cannot be deep-copied; copy them detached
+    memo = {
+        id(value): value.detach()
+        for module in model.modules()
+        for value in vars(module).values()
+        if isinstance(value, torch.Tensor) and not value.is_leaf
+    }
+    quantized = copy.deepcopy(model, memo)
+    torch.ao.quantization.quantize_dynamic(
+        quantized, QUANTIZED_MODULES, dtype=dtype, inplace=True
+    )
+    return quantized.eval()
@@ -3,12 +3,14 @@ from time import time
 from collections import defaultdict
 
 from tqdm import tqdm
+import pandas as pd
 
 import torch
 import torch.optim as optim
 from torch.optim import lr_scheduler
 
 from knowledge_tracing.utils import utils
+from knowledge_tracing.utils.profiler import batch_num_samples
 from knowledge_tracing.data.data_loader import DataReader
 
 OPTIMIZER_MAP = {
@@ -38,7 +40,7 @@ class KTRunner(object):
         self.batch_size = args.batch_size_multiGPU
         self.eval_batch_size = args.eval_batch_size
 
-        self.metrics = "F1, Accuracy"
+        self.metrics = args.metric.strip().lower().split(",")
         for i in range(len(self.metrics)):
             self.metrics[i] = self.metrics[i].strip()
 
@@ -181,26 +183,30 @@ class KTRunner(object):
 
         # Return a random sample of items from an axis of object.
         epoch_train_data = epoch_train_data.sample(frac=1).reset_index(drop=True)
-        self.whole_batches = model.module.prepare_batches(
-            corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
-        )
-        self.train_batches = model.module.prepare_batches(
-            corpus, epoch_train_data, self.batch_size, phase="train"
-        )
-        self.val_batches = None
-        self.test_batches = None
-
-        if self.args.test:
-            self.test_batches = model.module.prepare_batches(
-                corpus, epoch_test_data, self.eval_batch_size, phase="test"
-            )
+        timer = self.logs.timer
+        timer.reset()
+        with timer.phase("batch_build"):
             self.whole_batches = model.module.prepare_batches(
                 corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
             )
-        if self.args.validate:
-            self.val_batches = model.module.prepare_batches(
-                corpus, epoch_val_data, self.eval_batch_size, phase="val"
+            self.train_batches = model.module.prepare_batches(
+                corpus, epoch_train_data, self.batch_size, phase="train"
             )
+            self.val_batches = None
+            self.test_batches = None
+
+            if self.args.test:
+                self.test_batches = model.module.prepare_batches(
+                    corpus, epoch_test_data, self.eval_batch_size, phase="test"
+                )
+                self.whole_batches = model.module.prepare_batches(
+                    corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
+                )
+            if self.args.validate:
+                self.val_batches = model.module.prepare_batches(
+                    corpus, epoch_val_data, self.eval_batch_size, phase="val"
+                )
+        timer.flush("batch_build")
 
         try:
             for epoch in range(self.epoch):
@@ -230,6 +236,9 @@ class KTRunner(object):
             self.logs.write_to_log_file("Early stop manually")
             exit_here = input("Exit completely without evaluation? (y/n) (default n):")
             if exit_here.lower().startswith("y"):
+                # Flush the pending loss curves and profiler traces before exiting
+                self.logs.close_plotter()
+                self.logs.profiler.stop()
                 self.logs.write_to_log_file(
                     os.linesep + "-" * 45 + " END: " + utils.get_time() + " " + "-" * 45
                 )
@@ -291,7 +300,8 @@ class KTRunner(object):
             & (epoch % self.args.test_every == 0)
             & (epoch >= self.early_stop)
         ):
-            with torch.no_grad():
+            self.logs.timer.reset()
+            with torch.no_grad(), self.logs.timer.phase("eval"):
                 test_result = self.evaluate(
                     model, corpus, "test", self.test_batches, epoch=epoch + 1
                 )
@@ -311,6 +321,7 @@ class KTRunner(object):
                     valid_result = test_result
 
             testing_time = self._check_time()
+            self.logs.timer.flush("eval", epoch=epoch)
 
             self.logs.append_epoch_losses(test_result, "test")
             self.logs.write_to_log_file(
@@ -352,6 +363,8 @@ class KTRunner(object):
 
         model.module.train()
         train_losses = defaultdict(list)
+        timer = self.logs.timer
+        timer.reset()
 
         # Iterate through each batch.
         for batch in tqdm(
@@ -361,24 +374,35 @@ class KTRunner(object):
             mininterval=1,
             desc="Epoch %5d" % epoch,
         ):
-            batch = model.module.batch_to_gpu(batch, self.device)
+            with timer.phase("h2d"):
+                batch = model.module.batch_to_gpu(batch, self.device)
+            timer.add_samples(batch_num_samples(batch))
 
             # Reset gradients.
             model.module.optimizer.zero_grad(set_to_none=True)
 
             # Forward pass.
-            output_dict = model(batch)
+            with timer.phase("forward"):
+                output_dict = model(batch)
 
             # Calculate loss and perform backward pass.
-            loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
-            loss_dict["loss_total"].backward()
+            with timer.phase("loss"):
+                loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
+            with timer.phase("backward"):
+                loss_dict["loss_total"].backward()
 
             # Update parameters.
-            torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
-            model.module.optimizer.step()
+            with timer.phase("clip"):
+                torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
+            with timer.phase("optimizer"):
+                model.module.optimizer.step()
 
             # Append the losses to the train_losses dictionary.
             train_losses = self.logs.append_batch_losses(train_losses, loss_dict)
+            self.logs.profiler.step()
+            self.logs.diagnostics.step()
+
+        timer.flush("train", epoch=epoch)
 
         string = self.logs.result_string("train", epoch, train_losses, t=epoch)
         self.logs.write_to_log_file(string)
@@ -387,4 +411,4 @@ class KTRunner(object):
         model.module.scheduler.step()
         model.module.eval()
 
-        return self.logs.train_results["loss_total"][-1]
+        return self.logs.train_results["loss_total"].iloc[-1]
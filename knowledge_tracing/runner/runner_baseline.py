@@ -7,6 +7,7 @@ import numpy as np
 import torch
 
 from knowledge_tracing.utils import utils, logger
+from knowledge_tracing.utils.profiler import batch_num_samples
 from knowledge_tracing.data.data_loader import DataReader
 from knowledge_tracing.runner.runner import KTRunner
 
@@ -64,21 +65,25 @@ class BaselineKTRunner(KTRunner):
         # Shuffle training data
         epoch_train_data = epoch_train_data.sample(frac=1).reset_index(drop=True)
         # Prepare data batches for training and optionally for validation and testing
-        self.train_batches = model.module.prepare_batches(
-            corpus, epoch_train_data, self.batch_size, phase="train"
-        )
-        self.val_batches = None
-        self.test_batches = None
-
-        # Prepare validation and test batches if respective flags are set
-        if self.args.test:
-            self.test_batches = model.module.prepare_batches(
-                corpus, epoch_test_data, self.eval_batch_size, phase="test"
-            )
-        if self.args.validate:
-            self.val_batches = model.module.prepare_batches(
-                corpus, epoch_val_data, self.eval_batch_size, phase="val"
+        timer = self.logs.timer
+        timer.reset()
+        with timer.phase("batch_build"):
+            self.train_batches = model.module.prepare_batches(
+                corpus, epoch_train_data, self.batch_size, phase="train"
             )
+            self.val_batches = None
+            self.test_batches = None
+
+            # Prepare validation and test batches if respective flags are set
+            if self.args.test:
+                self.test_batches = model.module.prepare_batches(
+                    corpus, epoch_test_data, self.eval_batch_size, phase="test"
+                )
+            if self.args.validate:
+                self.val_batches = model.module.prepare_batches(
+                    corpus, epoch_val_data, self.eval_batch_size, phase="val"
+                )
+        timer.flush("batch_build")
 
         try:
             for epoch in range(self.epoch):
@@ -118,6 +123,9 @@ class BaselineKTRunner(KTRunner):
             self.logs.write_to_log_file("Early stop manually")
             exit_here = input("Exit completely without evaluation? (y/n) (default n):")
             if exit_here.lower().startswith("y"):
+                # Flush the pending loss curves and profiler traces before exiting
+                self.logs.close_plotter()
+                self.logs.profiler.stop()
                 self.logs.write_to_log_file(
                     os.linesep + "-" * 45 + " END: " + utils.get_time() + " " + "-" * 45
                 )
@@ -184,12 +192,14 @@ class BaselineKTRunner(KTRunner):
 
         training_time = self._check_time()
         val_result, test_result = None, None
+        self.logs.timer.reset()
 
         with torch.no_grad():
             if self.args.validate:
-                val_result = self.evaluate(
-                    model, corpus, "val", self.val_batches, epoch=epoch
-                )
+                with self.logs.timer.phase("eval"):
+                    val_result = self.evaluate(
+                        model, corpus, "val", self.val_batches, epoch=epoch
+                    )
 
                 self.logs.append_epoch_losses(val_result, "val")
                 if (
@@ -214,9 +224,10 @@ class BaselineKTRunner(KTRunner):
                 & (epoch % self.args.test_every == 0)
                 & (epoch >= self.early_stop)
             ):
-                test_result = self.evaluate(
-                    model, corpus, "test", self.test_batches, epoch=epoch
-                )
+                with self.logs.timer.phase("eval"):
+                    test_result = self.evaluate(
+                        model, corpus, "test", self.test_batches, epoch=epoch
+                    )
 
                 testing_time = self._check_time()
                 self.logs.append_epoch_losses(test_result, "test")
@@ -230,6 +241,10 @@ class BaselineKTRunner(KTRunner):
                     )
                 )
 
+        # only epochs with an evaluation get a timing record
+        if val_result is not None or test_result is not None:
+            self.logs.timer.flush("eval", epoch=epoch)
+
         return test_result, val_result
 
     def fit(
@@ -257,6 +272,8 @@ class BaselineKTRunner(KTRunner):
 
         model.module.train()
         train_losses = defaultdict(list)
+        timer = self.logs.timer
+        timer.reset()
 
         outputs = []
         # Iterate through each batch.
@@ -267,25 +284,36 @@ class BaselineKTRunner(KTRunner):
             mininterval=1,
             desc="Epoch %5d" % epoch,
         ):
-            batch = model.module.batch_to_gpu(batch, self.device)
+            with timer.phase("h2d"):
+                batch = model.module.batch_to_gpu(batch, self.device)
+            timer.add_samples(batch_num_samples(batch))
 
             # Reset gradients.
             model.module.optimizer.zero_grad(set_to_none=True)
 
             # Forward pass.
-            output_dict = model(batch)
+            with timer.phase("forward"):
+                output_dict = model(batch)
             outputs.append(output_dict)
 
             # Calculate loss and perform backward pass.
-            loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
-            loss_dict["loss_total"].backward()
+            with timer.phase("loss"):
+                loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
+            with timer.phase("backward"):
+                loss_dict["loss_total"].backward()
 
             # Update parameters.
-            torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
-            model.module.optimizer.step()
+            with timer.phase("clip"):
+                torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
+            with timer.phase("optimizer"):
+                model.module.optimizer.step()
 
             # Append the losses to the train_losses dictionary.
             train_losses = self.logs.append_batch_losses(train_losses, loss_dict)
+            self.logs.profiler.step()
+            self.logs.diagnostics.step()
+
+        timer.flush("train", epoch=epoch)
 
         string = self.logs.result_string("train", epoch, train_losses, t=epoch)
         self.logs.write_to_log_file(string)
@@ -294,7 +322,7 @@ class BaselineKTRunner(KTRunner):
         model.module.scheduler.step()
         model.module.eval()
 
-        return self.logs.train_results["loss_total"][-1]
+        return self.logs.train_results["loss_total"].iloc[-1]
 
     def predict(
         self,
@@ -330,6 +358,7 @@ class BaselineKTRunner(KTRunner):
         ):
             # Move the batch data to the appropriate device (GPU or CPU)
             batch = model.module.batch_to_gpu(batch, self.device)
+            self.logs.timer.add_samples(batch_num_samples(batch))
             # Perform prediction using the model
             out_dict = model.module.predictive_model(batch)
             # Collect the raw outputs for further analysis or debugging
@@ -428,6 +457,7 @@ class BaselineContinualRunner(BaselineKTRunner):
         self.early_stop = args.early_stop
         self.logs = logs
         self.device = args.device
+        self.incremental = args.incremental
 
     def train(
         self,
@@ -441,10 +471,21 @@ class BaselineContinualRunner(BaselineKTRunner):
         and iterates through a training loop to fit the model on the entire dataset for
         a specified number of epochs or until early stopping is triggered.
 
+        With `incremental`, every time step only processes the newly revealed interaction
+        with `forward_cl_step`, from the recurrent state of every batch carried over the
+        previous time steps, so that the cost of a time step does not grow with it.
+
         Args:
             model: The KT model instance to be trained.
             corpus: The dataset wrapper used for training.
         """
+        if self.incremental and not hasattr(model.module, "forward_cl_step"):
+            raise ValueError(
+                "{} does not support incremental continual learning".format(
+                    type(model.module).__name__
+                )
+            )
+
         # Build the optimizer if it hasn't been built already.
         if model.module.optimizer is None:
             model.module.optimizer, model.module.scheduler = self._build_optimizer(
@@ -469,9 +510,16 @@ class BaselineContinualRunner(BaselineKTRunner):
         # Shuffle the dataset
         epoch_whole_data = epoch_whole_data.sample(frac=1).reset_index(drop=True)
         # Prepare batches from the shuffled dataset for training
-        whole_batches = model.module.prepare_batches(
-            corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
-        )
+        timer = self.logs.timer
+        timer.reset()
+        with timer.phase("batch_build"):
+            whole_batches = model.module.prepare_batches(
+                corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
+            )
+        timer.flush("batch_build")
+
+        # Recurrent state of every batch, over the interactions before the previous one
+        states = [None] * len(whole_batches)
 
         try:
             # Main training loop
@@ -484,7 +532,9 @@ class BaselineContinualRunner(BaselineKTRunner):
                 # Check and log the time
                 self._check_time()
                 # Fit the model on the current batch
-                self.fit(model, whole_batches, epoch=time, time_step=time)
+                self.fit(
+                    model, whole_batches, epoch=time, time_step=time, states=states
+                )
                 # Perform testing using the same batches
                 self.test(model, whole_batches, epoch=time, time_step=time)
 
@@ -492,17 +542,24 @@ class BaselineContinualRunner(BaselineKTRunner):
             self.logs.write_to_log_file("Early stop manually")
             exit_here = input("Exit completely without evaluation? (y/n) (default n):")
             if exit_here.lower().startswith("y"):
+                # Flush the pending loss curves and profiler traces before exiting
+                self.logs.close_plotter()
+                self.logs.profiler.stop()
                 self.logs.write_to_log_file(
                     os.linesep + "-" * 45 + " END: " + utils.get_time() + " " + "-" * 45
                 )
                 exit(1)
 
+        self.logs.close_plotter()
+        self.logs.profiler.stop()
+
     def fit(
         self,
         model: torch.nn.Module,
         batches: list,
         epoch: int = 0,
         time_step: int = 0,
+        states: list = None,
     ) -> dict:
         """
         Trains the given model on the given batches of data.
@@ -512,6 +569,8 @@ class BaselineContinualRunner(BaselineKTRunner):
             batches: A list of data, where each element is a batch to train.
             epoch_train_data: A pandas DataFrame containing the training data.
             epoch: The current epoch number.
+            states: With `incremental`, the recurrent state of every batch over the
+                interactions before time_step - 1, advanced in place by one interaction.
 
         Returns:
             A dictionary containing the training losses.
@@ -519,31 +578,55 @@ class BaselineContinualRunner(BaselineKTRunner):
 
         model.module.train()
         train_losses = defaultdict(list)
+        timer = self.logs.timer
 
         for mini_epoch in range(10):  # self.epoch):
+            timer.reset()
             # Iterate through each batch.
-            for batch in tqdm(
-                batches,
-                leave=False,
-                ncols=100,
-                mininterval=1,
-                desc="Epoch %5d" % epoch + " Time %5d" % mini_epoch,
+            for i, batch in enumerate(
+                tqdm(
+                    batches,
+                    leave=False,
+                    ncols=100,
+                    mininterval=1,
+                    desc="Epoch %5d" % epoch + " Time %5d" % mini_epoch,
+                )
             ):
                 # Move the batch to the GPU.
-                batch = model.module.batch_to_gpu(batch, self.device)
+                with timer.phase("h2d"):
+                    batch = model.module.batch_to_gpu(batch, self.device)
+                timer.add_samples(batch_num_samples(batch))
 
                 # Reset gradients.
                 model.module.optimizer.zero_grad(set_to_none=True)
 
-                output_dict = model.module.forward_cl(batch, idx=time_step)
-                loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
-                loss_dict["loss_total"].backward()
+                with timer.phase("forward"):
+                    if self.incremental:
+                        output_dict = model.module.forward_cl_step(
+                            batch, idx=time_step, state=states[i]
+                        )
+                    else:
+                        output_dict = model.module.forward_cl(batch, idx=time_step)
+                with timer.phase("loss"):
+                    loss_dict = model.module.loss(
+                        batch, output_dict, metrics=self.metrics
+                    )
+                with timer.phase("backward"):
+                    loss_dict["loss_total"].backward()
 
                 # Update parameters.
-                torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
-                model.module.optimizer.step()
+                with timer.phase("clip"):
+                    torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
+                with timer.phase("optimizer"):
+                    model.module.optimizer.step()
 
                 train_losses = self.logs.append_batch_losses(train_losses, loss_dict)
+                self.logs.profiler.step()
+                self.logs.diagnostics.step()
+
+            timer.flush(
+                "train", epoch=epoch, mini_epoch=mini_epoch, time_step=time_step
+            )
 
             if mini_epoch % 10 == 0:
                 model.module.save_model(epoch=epoch, mini_epoch=mini_epoch)
@@ -555,7 +638,18 @@ class BaselineContinualRunner(BaselineKTRunner):
             self.logs.write_to_log_file(string)
             self.logs.append_epoch_losses(train_losses, "train")
 
-        return self.logs.train_results["loss_total"][-1]
+        if self.incremental:
+            # Advance the states by one interaction with the trained model
+            timer.reset()
+            with torch.no_grad(), timer.phase("state_update"):
+                for i, batch in enumerate(batches):
+                    batch = model.module.batch_to_gpu(batch, self.device)
+                    states[i] = model.module.forward_cl_step(
+                        batch, idx=time_step, state=states[i]
+                    )["state"]
+            timer.flush("state_update", epoch=epoch, time_step=time_step)
+
+        return self.logs.train_results["loss_total"].iloc[-1]
 
     def test(
         self,
@@ -588,14 +682,22 @@ class BaselineContinualRunner(BaselineKTRunner):
 
         # Check if testing is enabled and it's the correct epoch for testing
         if (self.args.test) and (epoch % self.args.test_every == 0):
+            timer = self.logs.timer
+            timer.reset()
             with torch.no_grad():  # Disable gradient computation for evaluation
                 for batch in test_batches:  # Iterate through each test batch
                     # Move the batch to the appropriate device (GPU/CPU)
-                    batch = model.module.batch_to_gpu(batch, self.device)
+                    with timer.phase("h2d"):
+                        batch = model.module.batch_to_gpu(batch, self.device)
+                    timer.add_samples(batch_num_samples(batch))
                     # Evaluate the model on the batch and obtain loss/metrics
-                    loss_dict = model.module.evaluate_cl(batch, time_step, self.metrics)
+                    with timer.phase("eval"):
+                        loss_dict = model.module.evaluate_cl(
+                            batch, time_step, self.metrics
+                        )
                     # Append batch losses/metrics to the test losses
                     test_losses = self.logs.append_batch_losses(test_losses, loss_dict)
+            timer.flush("eval", epoch=epoch, time_step=time_step)
 
             # Generate a result string for the current epoch's test performance
             string = self.logs.result_string("test", epoch, test_losses, t=epoch)
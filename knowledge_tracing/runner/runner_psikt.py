@@ -8,6 +8,7 @@ import torch
 from torch.optim import lr_scheduler
 
 from knowledge_tracing.utils import utils
+from knowledge_tracing.utils.profiler import batch_num_samples
 from knowledge_tracing.runner import OPTIMIZER_MAP
 from knowledge_tracing.runner.runner import KTRunner
 from knowledge_tracing.data.data_loader import DataReader
@@ -20,7 +21,71 @@ class PSIKTRunner(KTRunner):
     """
 
     def __init__(self, args, logs):
-        KTRunner.__init__(args, logs)
+        if args.chunk_size and not args.qs_pooling:
+            raise ValueError("--chunk_size requires --qs_pooling 1")
+        if args.chunk_size == 1:
+            raise ValueError("--chunk_size must be at least 2")
+        KTRunner.__init__(self, args, logs)
+
+    def _train_step(self, model: torch.nn.Module, batch: dict) -> dict:
+        """
+        Forward and backward pass of one batch.
+
+        With --chunk_size, the sequences are processed in consecutive chunks of
+        chunk_size steps which carry the state of the inference networks and the last
+        posteriors (see AmortizedPSIKT.forward), on the device of the model rather than
+        split over GPUs. With --chunk_truncate, the backward pass
+        is run after every chunk and the carry is detached (truncated backpropagation
+        through time), so only the activations of one chunk are kept at a time.
+        Otherwise the gradients flow through the whole sequences as without chunks.
+
+        Args:
+            model: The training KT model.
+            batch: The batch, already on the device.
+
+        Returns:
+            The losses of the batch; for chunks, their averages weighted by the number of
+            steps of every chunk.
+        """
+        timer = self.logs.timer
+        chunk_size = self.args.chunk_size
+        if not chunk_size:
+            with timer.phase("forward"):
+                output_dict = model(batch)
+            with timer.phase("loss"):
+                loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
+            with timer.phase("backward"):
+                loss_dict["loss_total"].backward()
+            return loss_dict
+
+        num_step = batch["time_seq"].shape[1]
+        carry = {}
+        loss_total = 0
+        loss_dict = defaultdict(float)
+        for chunk in model.module.split_chunks(batch, chunk_size):
+            weight = chunk["time_seq"].shape[1] / num_step
+            # The module is called directly: DataParallel scatters the keyword
+            # arguments into copies, which would not receive the updated carry.
+            with timer.phase("forward"):
+                output_dict = model.module(chunk, carry=carry)
+            with timer.phase("loss"):
+                chunk_losses = model.module.loss(
+                    chunk, output_dict, metrics=self.metrics
+                )
+            if self.args.chunk_truncate:
+                with timer.phase("backward"):
+                    (chunk_losses["loss_total"] * weight).backward()
+                model.module.detach_carry(carry)
+            else:
+                loss_total = loss_total + chunk_losses["loss_total"] * weight
+            for key, value in chunk_losses.items():
+                if isinstance(value, torch.Tensor):
+                    value = value.detach()
+                loss_dict[key] += float(value) * weight
+        if not self.args.chunk_truncate:
+            with timer.phase("backward"):
+                loss_total.backward()
+        return dict(loss_dict)
 
     def _partition_parameters(self, model: torch.nn.Module):
         """
@@ -83,12 +148,16 @@ class PSIKTRunner(KTRunner):
             return optimizer, scheduler
 
         else:
-            # For EM training, separate the model's parameters into different groups
+            # For EM training, separate the model's parameters into different groups;
+            # fit_em_phases freezes and unfreezes them per phase
             (
                 generative_params,
                 inference_params,
                 graph_params,
             ) = self._partition_parameters(model)
+            self.generative_params = generative_params
+            self.inference_params = inference_params
+            self.graph_params = graph_params
 
             optimizer_infer = optimizer_class(
                 inference_params, lr=lr, weight_decay=weight_decay
@@ -138,19 +207,23 @@ class PSIKTRunner(KTRunner):
         ]
 
         # Return a random sample of items from an axis of object.
-        train_batches = model.module.prepare_batches(
-            corpus, epoch_train_data, self.batch_size, phase="train"
-        )
-        val_batches, test_batches = None, None
-
-        if self.args.test:
-            test_batches = model.module.prepare_batches(
-                corpus, epoch_test_data, self.eval_batch_size, phase="test"
-            )
-        if self.args.validate:
-            val_batches = model.module.prepare_batches(
-                corpus, epoch_val_data, self.eval_batch_size, phase="val"
+        timer = self.logs.timer
+        timer.reset()
+        with timer.phase("batch_build"):
+            train_batches = model.module.prepare_batches(
+                corpus, epoch_train_data, self.batch_size, phase="train"
             )
+            val_batches, test_batches = None, None
+
+            if self.args.test:
+                test_batches = model.module.prepare_batches(
+                    corpus, epoch_test_data, self.eval_batch_size, phase="test"
+                )
+            if self.args.validate:
+                val_batches = model.module.prepare_batches(
+                    corpus, epoch_val_data, self.eval_batch_size, phase="val"
+                )
+        timer.flush("batch_build")
 
         try:
             for epoch in range(self.epoch):
@@ -187,6 +260,9 @@ class PSIKTRunner(KTRunner):
             self.logs.write_to_log_file("Early stop manually")
             exit_here = input("Exit completely without evaluation? (y/n) (default n):")
             if exit_here.lower().startswith("y"):
+                # Flush the pending loss curves and profiler traces before exiting
+                self.logs.close_plotter()
+                self.logs.profiler.stop()
                 self.logs.write_to_log_file(
                     os.linesep + "-" * 45 + " END: " + utils.get_time() + " " + "-" * 45
                 )
@@ -262,7 +338,8 @@ class PSIKTRunner(KTRunner):
 
         # If testing is enabled and the current epoch is a multiple of test_every
         if (self.args.test) & (epoch % self.args.test_every == 0):
-            with torch.no_grad():
+            self.logs.timer.reset()
+            with torch.no_grad(), self.logs.timer.phase("eval"):
                 test_result = self.evaluate(
                     model=model,
                     corpus=corpus,
@@ -287,6 +364,7 @@ class PSIKTRunner(KTRunner):
 
             # Measure testing time
             testing_time = self._check_time()
+            self.logs.timer.flush("eval", epoch=epoch)
 
             # Append test results to logs
             self.logs.append_epoch_losses(test_result, "test")
@@ -329,30 +407,37 @@ class PSIKTRunner(KTRunner):
 
         model.module.train()
         train_losses = defaultdict(list)
+        timer = self.logs.timer
+        timer.reset()
 
         # Iterate through each batch.
         for batch in tqdm(
             batches, leave=False, ncols=100, mininterval=1, desc="Epoch %5d" % epoch
         ):
             # Move batches to GPU if necessary.
-            batch = model.module.batch_to_gpu(batch, self.device)
+            with timer.phase("h2d"):
+                batch = model.module.batch_to_gpu(batch, self.device)
+            timer.add_samples(batch_num_samples(batch))
 
             # Reset gradients.
             model.module.optimizer.zero_grad(set_to_none=True)
 
-            # Forward pass.
-            output_dict = model(batch)
-
-            # Calculate loss and perform backward pass.
-            loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
-            loss_dict["loss_total"].backward()
+            # Forward pass, loss and backward pass.
+            loss_dict = self._train_step(model, batch)
 
             # Update parameters.
-            torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
-            model.module.optimizer.step()
+            with timer.phase("clip"):
+                torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
+            with timer.phase("optimizer"):
+                model.module.optimizer.step()
+                model.module.node_dist.step()
 
             # Append the losses to the train_losses dictionary.
             train_losses = self.logs.append_batch_losses(train_losses, loss_dict)
+            self.logs.profiler.step()
+            self.logs.diagnostics.step()
+
+        timer.flush("train", epoch=epoch)
 
         string = self.logs.result_string("train", epoch, train_losses, t=epoch)
         self.logs.write_to_log_file(string)
@@ -361,7 +446,7 @@ class PSIKTRunner(KTRunner):
         model.module.scheduler.step()
         model.module.eval()
 
-        return self.logs.train_results["loss_total"][-1]
+        return self.logs.train_results["loss_total"].iloc[-1]
 
     def predict(
         self, model: torch.nn.Module, data_batches: list = None, epoch: int = -1
@@ -393,6 +478,7 @@ class PSIKTRunner(KTRunner):
         ):
             # Move batch to GPU
             batch = model.module.batch_to_gpu(batch, self.device)
+            self.logs.timer.add_samples(batch_num_samples(batch))
 
             # Get predictions from the model
             out_dict = model.module.predictive_model(batch)
@@ -512,7 +598,9 @@ class PSIKTRunner(KTRunner):
 
             # Perform training for the current phase
             for i in range(5):  # TODO: 5 is a hyperparameter
-                loss = self.fit_one_phase(model, epoch=epoch, mini_epoch=i, opt=opt)
+                loss = self.fit_one_phase(
+                    model, epoch=epoch, mini_epoch=i, phase=phase, opt=opt
+                )
 
             # Evaluate the model after each phase
             self.test(model, corpus, train_loss=loss)
@@ -526,7 +614,7 @@ class PSIKTRunner(KTRunner):
         model.module.eval()
 
         # Return the total loss after training
-        return self.logs.train_results["loss_total"][-1]
+        return self.logs.train_results["loss_total"].iloc[-1]
 
     def fit_one_phase(
         self,
@@ -552,6 +640,8 @@ class PSIKTRunner(KTRunner):
         """
         # Dictionary to store training losses
         train_losses = defaultdict(list)
+        timer = self.logs.timer
+        timer.reset()
 
         # Iterate over batches for training
         for batch in tqdm(
@@ -561,23 +651,30 @@ class PSIKTRunner(KTRunner):
             mininterval=1,
             desc="Epoch %5d" % epoch,
         ):
+            timer.add_samples(batch_num_samples(batch))
+
             # Zero out gradients for all optimizers
             model.module.optimizer_infer.zero_grad(set_to_none=True)
             model.module.optimizer_graph.zero_grad(set_to_none=True)
             model.module.optimizer_gen.zero_grad(set_to_none=True)
 
-            # Forward pass
-            output_dict = model(batch)
-            loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
+            # Forward pass, loss and backward pass
+            loss_dict = self._train_step(model, batch)
 
-            # Backward pass and optimization
-            loss_dict["loss_total"].backward()
-            torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
-            for o in opt:
-                o.step()
+            # Optimization
+            with timer.phase("clip"):
+                torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
+            with timer.phase("optimizer"):
+                for o in opt:
+                    o.step()
+                model.module.node_dist.step()
 
             # Append the losses to the train_losses dictionary
             train_losses = self.logs.append_batch_losses(train_losses, loss_dict)
+            self.logs.profiler.step()
+            self.logs.diagnostics.step()
+
+        timer.flush("train", epoch=epoch, mini_epoch=mini_epoch, phase=phase)
 
         # Generate result string and write to log file
         string = self.logs.result_string(
@@ -587,7 +684,7 @@ class PSIKTRunner(KTRunner):
         self.logs.append_epoch_losses(train_losses, "train")
 
         # Return the total loss after the training phase
-        return self.logs.train_results["loss_total"][-1]
+        return self.logs.train_results["loss_total"].iloc[-1]
 
 
 class VCLRunner(KTRunner):
@@ -605,7 +702,7 @@ class VCLRunner(KTRunner):
             args:
             logs
         """
-        KTRunner.__init__(args=args, logs=logs)
+        KTRunner.__init__(self, args=args, logs=logs)
 
         self.max_time_step = args.max_step
 
@@ -636,12 +733,16 @@ class VCLRunner(KTRunner):
 
         # Return a random sample of items from an axis of object.
         epoch_whole_data = epoch_whole_data.sample(frac=1).reset_index(drop=True)
-        train_batches = model.module.prepare_batches(
-            corpus, epoch_whole_data, self.batch_size, phase="whole"
-        )
-        eval_batches = model.module.prepare_batches(
-            corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
-        )
+        timer = self.logs.timer
+        timer.reset()
+        with timer.phase("batch_build"):
+            train_batches = model.module.prepare_batches(
+                corpus, epoch_whole_data, self.batch_size, phase="whole"
+            )
+            eval_batches = model.module.prepare_batches(
+                corpus, epoch_whole_data, self.eval_batch_size, phase="whole"
+            )
+        timer.flush("batch_build")
 
         max_time_step = 100  # time_step
 
@@ -658,11 +759,17 @@ class VCLRunner(KTRunner):
             self.logs.write_to_log_file("Early stop manually")
             exit_here = input("Exit completely without evaluation? (y/n) (default n):")
             if exit_here.lower().startswith("y"):
+                # Flush the pending loss curves and profiler traces before exiting
+                self.logs.close_plotter()
+                self.logs.profiler.stop()
                 self.logs.write_to_log_file(
                     os.linesep + "-" * 45 + " END: " + utils.get_time() + " " + "-" * 45
                 )
                 exit(1)
 
+        self.logs.close_plotter()
+        self.logs.profiler.stop()
+
     def fit(
         self,
         model: torch.nn.Module,
@@ -685,8 +792,10 @@ class VCLRunner(KTRunner):
 
         model.module.train()
         train_losses = defaultdict(list)
+        timer = self.logs.timer
 
         for mini_epoch in range(10):  # self.epoch):
+            timer.reset()
             # Iterate through each batch.
             for batch in tqdm(
                 batches,
@@ -696,44 +805,54 @@ class VCLRunner(KTRunner):
                 desc="Epoch %5d" % epoch + " Time %5d" % mini_epoch,
             ):
                 # Move the batch to the GPU.
-                batch = model.module.batch_to_gpu(batch, self.device)
+                with timer.phase("h2d"):
+                    batch = model.module.batch_to_gpu(batch, self.device)
+                timer.add_samples(batch_num_samples(batch))
 
                 # Reset gradients.
                 model.module.optimizer.zero_grad(set_to_none=True)
 
-                # Predictive model before optimization
-                s_tilde_dist, z_tilde_dist = model.module.predictive_model(
-                    feed_dict=batch, idx=time_step
-                )
-                s_post_dist, z_post_dist = model.module.inference_model(
-                    feed_dict=batch, idx=time_step
-                )
+                with timer.phase("forward"):
+                    # Predictive and posterior distributions before optimization
+                    pred_dist, post_dist = model.module.filtering_step(
+                        feed_dict=batch, idx=time_step
+                    )
 
                 # Calculate loss and perform backward pass.
-                output_dict = model.module.objective_function(
-                    batch,
-                    idx=time_step,
-                    pred_dist=[s_tilde_dist, z_tilde_dist],
-                    post_dist=[s_post_dist, z_post_dist],
-                )
-                loss_dict = model.module.loss(batch, output_dict, metrics=self.metrics)
-                loss_dict["loss_total"].backward()
+                with timer.phase("loss"):
+                    output_dict = model.module.objective_function(
+                        batch,
+                        idx=time_step,
+                        pred_dist=pred_dist,
+                        post_dist=post_dist,
+                    )
+                    loss_dict = model.module.loss(
+                        batch, output_dict, metrics=self.metrics
+                    )
+                with timer.phase("backward"):
+                    loss_dict["loss_total"].backward()
 
                 # Update parameters.
-                torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
-                model.module.optimizer.step()
-
-                with torch.no_grad():
-                    # Update after optimization
+                with timer.phase("clip"):
+                    torch.nn.utils.clip_grad_norm_(model.module.parameters(), 100)
+                with timer.phase("optimizer"):
+                    model.module.optimizer.step()
+                    model.module.node_dist.step()
+
+                with torch.no_grad(), timer.phase("state_update"):
+                    # Posteriors after optimization, the priors of the next time step
                     _, _ = model.module.inference_model(
                         feed_dict=batch, idx=time_step, update=True, eval=False
                     )
-                    _, _ = model.module.predictive_model(
-                        feed_dict=batch, idx=time_step, update=True, eval=False
-                    )
 
                 # Append the losses to the train_losses dictionary.
                 train_losses = self.logs.append_batch_losses(train_losses, loss_dict)
+                self.logs.profiler.step()
+                self.logs.diagnostics.step()
+
+            timer.flush(
+                "train", epoch=epoch, mini_epoch=mini_epoch, time_step=time_step
+            )
 
             if mini_epoch % 10 == 0:
                 model.module.save_model(epoch=epoch, mini_epoch=mini_epoch)
@@ -745,7 +864,7 @@ class VCLRunner(KTRunner):
             self.logs.write_to_log_file(string)
             self.logs.append_epoch_losses(train_losses, "train")
 
-        return self.logs.train_results["loss_total"][-1]
+        return self.logs.train_results["loss_total"].iloc[-1]
 
     def test(
         self,
@@ -772,12 +891,18 @@ class VCLRunner(KTRunner):
 
         # If testing is enabled and the current epoch is a multiple of test_every
         if self.args.test and epoch % self.args.test_every == 0:
+            timer = self.logs.timer
+            timer.reset()
             with torch.no_grad():
                 # Iterate over test batches and evaluate
                 for batch in test_batches:
-                    batch = model.module.batch_to_gpu(batch, self.device)
-                    loss_dict = model.module.eval_model(batch, time_step)
+                    with timer.phase("h2d"):
+                        batch = model.module.batch_to_gpu(batch, self.device)
+                    timer.add_samples(batch_num_samples(batch))
+                    with timer.phase("eval"):
+                        loss_dict = model.module.eval_model(batch, time_step)
                     test_losses = self.logs.append_batch_losses(test_losses, loss_dict)
+            timer.flush("eval", epoch=epoch, time_step=time_step)
 
             # Generate result string and write to log file
             string = self.logs.result_string("test", epoch, test_losses, t=epoch)
@@ -106,6 +106,24 @@ def parse_args(parser):
         default=10,
         help="how often to save the model.",
     )
+    parser.add_argument(
+        "--plot_interval",
+        type=float,
+        default=60,
+        help="minimum seconds between loss-curve renders; <0 only plots at the end of the run",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=str,
+        default="",
+        help="training steps to trace with torch.profiler, e.g. 10-20; empty to disable",
+    )
+    parser.add_argument(
+        "--diagnostics_steps",
+        type=str,
+        default="",
+        help="training steps whose intermediate model tensors are saved, e.g. 10-20; empty to disable",
+    )
     parser.add_argument(
         "--expername",
         type=str,
@@ -115,6 +133,13 @@ def parse_args(parser):
 
     ############## KTRunner ##############
     parser.add_argument("--vcl", type=int, default=0, help="whether to use VCL")
+    parser.add_argument(
+        "--incremental",
+        type=int,
+        default=0,
+        help="with --vcl, process only the new interaction at every time step, "
+        + "carrying the recurrent state of the model (DKT, DKTForgetting)",
+    )
     parser.add_argument("--finetune", type=int, default=0, help="whether to finetune")
     parser.add_argument(
         "--train_mode",
@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import torch
+
+from knowledge_tracing.utils.profiler import parse_step_range
+
+
+class DiagnosticsCapture:
+    """
+    Opt-in capture of intermediate tensors of a model for debugging.
+
+    Models report tensors of interest with `capture` (e.g. the means and variances of the
+    generative and inference distributions); the call is a no-op unless the current step is
+    selected, so nothing is copied during regular training. The runners call `step` after
+    every optimization step of their fit loops, with steps counted from 0 over the whole run
+    as for StepProfiler. The tensors captured during a selected step are moved to the CPU and
+    saved to `out_dir/step_<n>.pt` as a dict {name: tensor}.
+
+    Args:
+        out_dir: The folder the captures are written to. If None, the capture is disabled.
+        steps: The range of steps to capture, e.g. '10-20' or '15'. An empty string
+            disables the capture.
+    """
+
+    def __init__(
+        self,
+        out_dir: Path = None,
+        steps: str = "",
+    ) -> None:
+        self.out_dir = out_dir
+        self.enabled = out_dir is not None and bool(steps)
+        self.num_step = 0
+        self.records = {}
+        if not self.enabled:
+            return
+
+        self.first, self.last = parse_step_range(steps)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def active(self) -> bool:
+        """
+        Whether the tensors reported in the current step are recorded.
+        """
+        return self.enabled and self.first <= self.num_step <= self.last
+
+    def capture(self, **tensors: torch.Tensor) -> None:
+        """
+        Record the given tensors (keyword name -> tensor) if the current step is selected.
+        A name reported twice in the same step keeps the last tensor.
+        """
+        if not self.active:
+            return
+        for name, tensor in tensors.items():
+            self.records[name] = tensor.detach().to("cpu", copy=True)
+
+    def step(self) -> None:
+        """
+        Mark the end of one training step and write the tensors recorded during it.
+        """
+        if self.records:
+            torch.save(
+                self.records, Path(self.out_dir, "step_{}.pt".format(self.num_step))
+            )
+            self.records = {}
+        self.num_step += 1
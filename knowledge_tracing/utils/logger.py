@@ -1,13 +1,16 @@
-import time, argparse, math, itertools
+import time, argparse, math, itertools, threading
 from pathlib import Path
 from collections import defaultdict
 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
 
 import torch
 
+from knowledge_tracing.utils.profiler import PhaseTimer, StepProfiler
+from knowledge_tracing.utils.diagnostics import DiagnosticsCapture
+
 
 class Logger:
     def __init__(self, args: argparse.Namespace) -> None:
@@ -26,6 +29,13 @@ class Logger:
             train_results (pd.DataFrame): DataFrame to store training process results.
             test_results (pd.DataFrame): DataFrame to store testing process results.
             val_results (pd.DataFrame): DataFrame to store validation process results.
+            timer (PhaseTimer): Per-phase timing counters of the runners, written to
+                `timing.jsonl` next to `log.txt` when log files are created.
+            profiler (StepProfiler): Opt-in torch.profiler capture of the training steps
+                selected by `args.profile_steps`, written to the `profile` folder.
+            diagnostics (DiagnosticsCapture): Opt-in capture of the intermediate tensors
+                reported by the models during the training steps selected by
+                `args.diagnostics_steps`, written to the `diagnostics` folder.
 
         Methods:
             __init__(self, args: argparse.Namespace) -> None:
@@ -46,9 +56,23 @@ class Logger:
         self.test_results = pd.DataFrame()
         self.val_results = pd.DataFrame()
 
+        self.plotter = None
+        # Disabled until a log path exists to write the timing records to
+        self.timer = PhaseTimer()
+        self.profiler = StepProfiler()
+        self.diagnostics = DiagnosticsCapture()
+
         if args.create_logs:
             self.create_log_path(args)
 
+    def __getstate__(self) -> dict:
+        # The corpus pickles its logger; the plotting thread and the profiler session
+        # belong to the running process and are not saved with it
+        state = self.__dict__.copy()
+        state["plotter"] = None
+        state["profiler"] = StepProfiler()
+        return state
+
     @staticmethod
     def append_batch_losses(
         losses_list: dict,
@@ -97,9 +121,16 @@ class Logger:
 
         self.log_file = Path(args.log_path, "log.txt")
         self.write_to_log_file(args)
+        self.timer = PhaseTimer(Path(args.log_path, "timing.jsonl"), args.device)
+        self.profiler = StepProfiler(Path(args.log_path, "profile"), args.profile_steps)
+        self.timer.annotate = self.profiler.enabled
+        self.diagnostics = DiagnosticsCapture(
+            Path(args.log_path, "diagnostics"), args.diagnostics_steps
+        )
 
         args.plotdir = Path(args.log_path, "plots")
         args.plotdir.mkdir(exist_ok=True)
+        self.plotter = LossCurvePlotter(args.plotdir, args.plot_interval)
         args.visdir = Path(args.log_path, "out_dict")
         args.visdir.mkdir(exist_ok=True)
 
@@ -186,33 +217,32 @@ class Logger:
 
         return string
 
-    def draw_loss_curves(self) -> None:
+    def draw_loss_curves(self, force: bool = False) -> None:
         """
         Draw loss curves for train, validation, and test results.
 
-        This method plots the loss curves based on the train, validation, and test results stored in the class.
+        The rendering is handed over to the background LossCurvePlotter, so the training
+        loop only pays for copying the result frames. Requests are rate-limited by
+        `args.plot_interval`; use `force` (or `close_plotter`) to render immediately.
 
+        Args:
+            force: Render the current results without waiting for the rate limit.
         """
+        if self.plotter is None:
+            return
+        self.plotter.submit(
+            self.train_results, self.val_results, self.test_results, force=force
+        )
 
-        for i in self.train_results.columns:
-            plt.figure()
-            plt.plot(self.train_results[i], "-b", label="train " + i)
-
-            if self.val_results is not None and i in self.val_results:
-                plt.plot(self.val_results[i], "-r", label="val " + i)
-
-            if self.test_results is not None and i in self.test_results:
-                plt.plot(self.test_results[i], "-g", label="test " + i)
-
-            plt.xlabel("epoch")
-            plt.ylabel(i)
-            plt.legend(loc="upper right")
-
-            # save image
-            filename = f"train_{i}.png"
-            filepath = Path(self.args.plotdir, filename)
-            plt.savefig(filepath)
-            plt.close()
+    def close_plotter(self) -> None:
+        """
+        Render the final loss curves and stop the background plotting thread.
+        """
+        if self.plotter is None:
+            return
+        self.draw_loss_curves(force=True)
+        self.plotter.close()
+        self.plotter = None
 
     def save_checkpoint(
         self,
@@ -260,7 +290,11 @@ class Logger:
 
         """
 
-        print("Saving model and log-file to " + args.log_path)
+        print("Saving model and log-file to " + str(args.log_path))
+
+        # Flush the pending loss curves and profiler traces before the run ends
+        self.close_plotter()
+        self.profiler.stop()
 
         # Save losses throughout training and plot
         self.train_results.to_pickle(Path(self.args.log_path, "out_dict", "train_loss"))
@@ -355,3 +389,113 @@ class Logger:
     #             # save image
     #             plt.savefig(Path(self.args.log_path, 'val_' + i + ".png"))
     #             plt.close()
+
+
+class LossCurvePlotter:
+    """
+    Render loss curves on a background thread.
+
+    The training thread hands over snapshots of the result frames with `submit`; only the
+    most recent snapshot is kept, and it is rendered at most once every `min_interval`
+    seconds. Rendering uses the object-oriented matplotlib API, which does not touch the
+    global pyplot state and is therefore safe to call off the main thread.
+
+    Args:
+        plotdir: Folder the `train_<metric>.png` files are written to.
+        min_interval: Minimum number of seconds between two renders. A negative value
+            disables intermediate plots, so curves are only drawn when the plotter is closed.
+    """
+
+    def __init__(self, plotdir: Path, min_interval: float = 60.0) -> None:
+        self.plotdir = plotdir
+        self.min_interval = min_interval
+
+        self._pending = None
+        self._force = False
+        self._closed = False
+        self._last_draw = -math.inf
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(
+            target=self._run, name="loss-curve-plotter", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        train_results: pd.DataFrame,
+        val_results: pd.DataFrame = None,
+        test_results: pd.DataFrame = None,
+        force: bool = False,
+    ) -> None:
+        """
+        Queue a snapshot of the results for rendering; an older pending snapshot is dropped.
+        """
+        snapshot = tuple(
+            None if df is None else df.copy()
+            for df in (train_results, val_results, test_results)
+        )
+        with self._cond:
+            self._pending = snapshot
+            self._force = self._force or force
+            self._cond.notify()
+
+    def close(self) -> None:
+        """
+        Render whatever is still pending and wait for the worker thread to finish.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+
+                if not (self._force or self._closed):
+                    if self.min_interval < 0:
+                        self._cond.wait()
+                        continue
+                    wait_time = self._last_draw + self.min_interval - time.time()
+                    if wait_time > 0:
+                        self._cond.wait(wait_time)
+                        continue
+
+                snapshot, self._pending, self._force = self._pending, None, False
+
+            self.render(self.plotdir, *snapshot)
+            self._last_draw = time.time()
+
+    @staticmethod
+    def render(
+        plotdir: Path,
+        train_results: pd.DataFrame,
+        val_results: pd.DataFrame = None,
+        test_results: pd.DataFrame = None,
+    ) -> None:
+        """
+        Plot one figure per metric column of the training results.
+        """
+        for i in train_results.columns:
+            fig = Figure()
+            ax = fig.add_subplot()
+            ax.plot(train_results[i].values, "-b", label="train " + i)
+
+            if val_results is not None and i in val_results:
+                ax.plot(val_results[i].values, "-r", label="val " + i)
+
+            if test_results is not None and i in test_results:
+                ax.plot(test_results[i].values, "-g", label="test " + i)
+
+            ax.set_xlabel("epoch")
+            ax.set_ylabel(i)
+            ax.legend(loc="upper right")
+
+            # save image
+            filename = f"train_{i}.png"
+            fig.savefig(Path(plotdir, filename))
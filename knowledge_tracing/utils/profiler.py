@@ -0,0 +1,253 @@
+import sys, json, time
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def batch_num_samples(batch: dict) -> int:
+    """
+    Number of learners (rows) in a feed dict; the leading dimension of its first tensor.
+    """
+    for value in batch.values():
+        if isinstance(value, torch.Tensor) and value.dim() > 0:
+            return value.shape[0]
+    return 0
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of the current process in MB (None if it cannot be queried).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class PhaseTimer:
+    """
+    Accumulate the wall-clock time spent in each phase of a training or evaluation loop
+    and write the aggregated counters as JSON lines.
+
+    The runners wrap every step of their loops (batch build, host-to-device copy, forward,
+    loss, backward, gradient clipping, optimizer step and evaluation) in `phase`, count the
+    processed learners with `add_samples`, and call `flush` once per epoch. Each flushed
+    record contains per-phase total/mean/max times, the number of samples per second and
+    the peak host (and CUDA) memory.
+
+    On CUDA devices the timer synchronizes before and after each phase so that the measured
+    time is attributed to the phase that launched the kernels.
+
+    Args:
+        path: The JSON-lines file the records are appended to. If None, the timer is
+            disabled and `phase` is a no-op.
+        device: The device the model is trained on.
+    """
+
+    def __init__(
+        self,
+        path: Path = None,
+        device: torch.device = "cpu",
+    ) -> None:
+        self.path = path
+        self.enabled = path is not None
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        # Label the phases in torch.profiler traces (set while a StepProfiler is active)
+        self.annotate = False
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Clear the counters and restart the wall clock of the current record.
+        """
+        self.totals = defaultdict(float)
+        self.maxima = defaultdict(float)
+        self.steps = defaultdict(int)
+        self.num_samples = 0
+        self.start_time = time.perf_counter()
+        if self.enabled and self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _synchronize(self) -> None:
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time the enclosed block and add it to the counters of phase `name`.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            with (
+                torch.profiler.record_function(name) if self.annotate else nullcontext()
+            ):
+                yield
+        finally:
+            self._synchronize()
+            elapsed = time.perf_counter() - start
+            self.totals[name] += elapsed
+            self.maxima[name] = max(self.maxima[name], elapsed)
+            self.steps[name] += 1
+
+    def add_samples(self, num_samples: int) -> None:
+        """
+        Count the learners processed in the current record (used for samples/sec).
+        """
+        self.num_samples += num_samples
+
+    def flush(self, event: str, **info) -> dict:
+        """
+        Write the current counters as one JSON line and reset them.
+
+        Args:
+            event: The kind of record, e.g. 'batch_build', 'train' or 'eval'.
+            **info: Additional fields stored with the record, e.g. epoch or time_step.
+
+        Returns:
+            The record that was written (None if the timer is disabled).
+        """
+        if not self.enabled:
+            return None
+
+        self._synchronize()
+        wall_time = time.perf_counter() - self.start_time
+        record = {
+            "time": time.time(),
+            "event": event,
+            **info,
+            "wall_s": wall_time,
+            "num_samples": self.num_samples,
+            "samples_per_sec": self.num_samples / wall_time if wall_time > 0 else 0.0,
+            "phases": {
+                name: {
+                    "total_s": self.totals[name],
+                    "mean_s": self.totals[name] / self.steps[name],
+                    "max_s": self.maxima[name],
+                    "steps": self.steps[name],
+                }
+                for name in self.totals
+            },
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if self.cuda:
+            record["peak_cuda_mb"] = (
+                torch.cuda.max_memory_allocated(self.device) / 2**20
+            )
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record))
+            f.write("\n")
+
+        self.reset()
+        return record
+
+
+def parse_step_range(steps: str) -> tuple:
+    """
+    Parse a step range such as '10-20' (inclusive) or '15' into a (first, last) tuple.
+    """
+    try:
+        bounds = [int(b) for b in steps.split("-")]
+    except ValueError:
+        raise ValueError("Invalid step range: " + steps)
+    if len(bounds) == 1:
+        bounds = bounds * 2
+    if len(bounds) != 2 or bounds[0] < 0 or bounds[1] < bounds[0]:
+        raise ValueError("Invalid step range: " + steps)
+    return bounds[0], bounds[1]
+
+
+class StepProfiler:
+    """
+    Capture a torch.profiler trace of selected training steps.
+
+    The runners call `step` after every optimization step of their fit loops; steps are
+    counted from 0 over the whole run. The steps in `steps` (inclusive) are recorded with
+    input shapes, memory and Python stacks, and written to `trace_dir` as a Chrome trace that
+    can also be opened in TensorBoard. A table of the most expensive operators, grouped by
+    input shape, is saved next to it as `summary.txt`.
+
+    Args:
+        trace_dir: The folder the traces are written to. If None, the profiler is disabled.
+        steps: The range of steps to record, e.g. '10-20'. An empty string disables profiling.
+    """
+
+    def __init__(
+        self,
+        trace_dir: Path = None,
+        steps: str = "",
+    ) -> None:
+        self.trace_dir = trace_dir
+        self.enabled = trace_dir is not None and bool(steps)
+        self._prof = None
+        if not self.enabled:
+            return
+
+        first, last = parse_step_range(steps)
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        # One warm-up step right before the recorded range (when there is one)
+        warmup = min(first, 1)
+        self._prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                skip_first=first - warmup,
+                wait=0,
+                warmup=warmup,
+                active=last - first + 1,
+                repeat=1,
+            ),
+            on_trace_ready=self._trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True,
+        )
+        self._prof.start()
+
+    def _trace_ready(self, prof: torch.profiler.profile) -> None:
+        torch.profiler.tensorboard_trace_handler(str(self.trace_dir))(prof)
+        sort_by = (
+            "self_cuda_time_total"
+            if torch.cuda.is_available()
+            else "self_cpu_time_total"
+        )
+        with open(Path(self.trace_dir, "summary.txt"), "w") as f:
+            f.write(
+                prof.key_averages(group_by_input_shape=True).table(
+                    sort_by=sort_by, row_limit=50
+                )
+            )
+
+    def step(self) -> None:
+        """
+        Mark the end of one training step.
+        """
+        if self._prof is not None:
+            self._prof.step()
+
+    def stop(self) -> None:
+        """
+        Stop profiling; a trace that is still being recorded is written out.
+        """
+        if self._prof is not None:
+            self._prof.stop()
+            self._prof = None
@@ -1,5 +1,6 @@
 import os, pickle, datetime, argparse
 from pathlib import Path
+from typing import Union
 
 import numpy as np
 import pandas as pd
@@ -174,15 +175,15 @@ def get_feed_general(
 
 
 def get_feed_continual(
-    keys: dict, data: pd.DataFrame, idx: int, pad_list: bool = False
+    keys: Union[dict, list], data: pd.DataFrame, idx: int, pad_list: bool = False
 ) -> dict:
     """
     Create a feed dictionary for a given index from a DataFrame (for continual learning tasks).
 
     Args:
-        keys (dict): A dictionary where keys are target variable names and values
+        keys (dict or list): A dictionary where keys are target variable names and values
                      are column names in the DataFrame `data` containing the
-                     corresponding sequence data.
+                     corresponding sequence data, or a list of names of both.
         data (pd.DataFrame): The DataFrame containing the sequence data.
         idx (int): The index up to which the sequences should be extracted.
         pad_list (bool, optional): Whether to pad sequences if their keys end with
@@ -198,6 +199,8 @@ def get_feed_continual(
     """
     # Create an empty dictionary to hold the feed_dict values
     feed_dict = {}
+    if isinstance(keys, list):
+        keys = {key: key for key in keys}
 
     # Iterate over the keys in the provided list
     for key, value in keys.items():
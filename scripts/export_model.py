@@ -0,0 +1,31 @@
+import sys
+
+sys.path.append("..")
+
+from pathlib import Path
+
+from serve_predictions import global_parse_args, parse_serving_args, load_model
+
+from knowledge_tracing.utils import utils
+from knowledge_tracing.runner.export import export_model
+
+if __name__ == "__main__":
+    parser = global_parse_args()
+    parser.add_argument(
+        "--export_path",
+        type=str,
+        default="",
+        help="file of the exported model (default: the model file with .jit.pt)",
+    )
+    global_args = parse_serving_args(parser)
+    model, corpus, logs = load_model(global_args)
+
+    export_path = global_args.export_path or str(
+        Path(global_args.load_folder).with_suffix(".jit.pt")
+    )
+    meta = export_model(model, corpus, export_path, global_args.model_name)
+    logs.write_to_log_file(
+        "{} {}: exported to {} ({})".format(
+            utils.get_time(), global_args.model_name, export_path, meta
+        )
+    )
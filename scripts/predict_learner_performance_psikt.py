@@ -113,6 +113,75 @@ def global_parse_args():
         default=10,
         help="the weight of the categorical loss",
     )
+    parser.add_argument(
+        "--objective",
+        type=str,
+        default="mc",
+        choices=["mc", "analytic"],
+        help="estimate the log-likelihood of s and z with num_sample samples (mc) or in closed form (analytic)",
+    )
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="mc",
+        choices=["mc", "antithetic", "qmc"],
+        help="noise of the num_sample samples: independent (mc), antithetic pairs or randomized Sobol points (qmc)",
+    )
+    parser.add_argument(
+        "--qs_pooling",
+        type=int,
+        default=0,
+        help="if 1, the category of s is inferred from pooled per-step features, which accepts histories of any length, instead of the flattened training window",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=0,
+        help="if > 0, AmortizedPSIKT is trained on consecutive chunks of chunk_size steps of the sequences which carry the state of the previous chunk (requires --qs_pooling 1)",
+    )
+    parser.add_argument(
+        "--chunk_truncate",
+        type=int,
+        default=1,
+        help="if 1, the gradients of a chunk do not flow into the previous chunks (truncated backpropagation through time), which bounds the memory of training",
+    )
+    parser.add_argument(
+        "--graph_topk",
+        type=int,
+        default=0,
+        help="if > 0, every skill is only influenced by its graph_topk strongest sources (for large numbers of skills)",
+    )
+    parser.add_argument(
+        "--graph_refresh",
+        type=int,
+        default=100,
+        help="number of optimizer steps after which the graph_topk sources are selected again",
+    )
+    parser.add_argument(
+        "--state_window",
+        type=int,
+        default=2,
+        help="number of time steps of the per-learner moments kept by ContinualPSIKT (at least 2)",
+    )
+    parser.add_argument(
+        "--state_var_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16", "bfloat16"],
+        help="storage dtype of the per-learner variances of ContinualPSIKT (float16/bfloat16 halve their memory)",
+    )
+    parser.add_argument(
+        "--state_path",
+        type=str,
+        default="",
+        help="if set, directory of the memory-mapped file to which ContinualPSIKT spills the per-learner moments",
+    )
+    parser.add_argument(
+        "--state_capacity",
+        type=int,
+        default=0,
+        help="if > 0, maximal number of learners whose moments ContinualPSIKT keeps in memory",
+    )
 
     return parser
 
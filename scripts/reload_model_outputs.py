@@ -119,6 +119,11 @@ if __name__ == "__main__":
             global_args.s_log_weight = 0.01
             global_args.z_log_weight = 0.01
             global_args.y_log_weight = 1
+            global_args.objective = "mc"
+            global_args.sampler = "mc"
+            global_args.qs_pooling = 0
+            global_args.graph_topk = 0
+            global_args.graph_refresh = 100
             cur_model = AmortizedPSIKT(
                 mode=global_args.train_mode,
                 num_node=corpus.n_skills,
@@ -0,0 +1,47 @@
+import sys
+
+sys.path.append("..")
+
+import asyncio
+import argparse
+
+import torch
+
+from knowledge_tracing.runner.export import ExportedModel
+from knowledge_tracing.runner.prediction_server import MicroBatcher, PredictionServer
+
+
+def parse_args():
+    """
+    Serving arguments of a model exported by export_model.py; only torch, numpy and pandas
+    are imported, for a fast cold start.
+    """
+    parser = argparse.ArgumentParser(description="Serve an exported model")
+    parser.add_argument("--path", type=str, required=True, help="exported model")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        default="",
+        help="if set, listen on this Unix socket instead of host:port",
+    )
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--random_seed", type=int, default=2022)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.random_seed)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    model = ExportedModel(args.path, device)
+    batcher = MicroBatcher(
+        model.predict_requests,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    server = PredictionServer(batcher, model.train_step, model.test_step)
+    asyncio.run(server.serve_forever(args.host, args.port, args.unix_socket))
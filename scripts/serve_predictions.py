@@ -0,0 +1,185 @@
+import sys
+
+sys.path.append("..")
+
+import asyncio
+import argparse
+import datetime
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from knowledge_tracing.data import data_loader
+from knowledge_tracing.utils import utils, arg_parser, logger
+from knowledge_tracing.psikt.psikt import AmortizedPSIKT
+from knowledge_tracing.runner.quantization import quantize_model
+from knowledge_tracing.runner.prediction_server import (
+    MicroBatcher,
+    PredictionServer,
+    predict_requests,
+)
+
+from knowledge_tracing.baseline import ppe
+from knowledge_tracing.baseline.pykt import qikt, gkt
+from knowledge_tracing.baseline.HawkesKT import dktforgetting, hkt
+from knowledge_tracing.baseline.EduKTM import dkt, akt
+from knowledge_tracing.baseline.halflife_regression import hlr
+
+
+def global_parse_args():
+    """
+    Serving arguments; the arguments of the model must match those it was trained with.
+    """
+    parser = argparse.ArgumentParser(description="Global")
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="AmortizedPSIKT",
+        help="AmortizedPSIKT or the name of a baseline, e.g. DKT",
+    )
+
+    # Server parameters
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        default="",
+        help="if set, listen on this Unix socket instead of host:port",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=64,
+        help="maximal number of requests predicted together",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5.0,
+        help="how long a request waits for others to fill its micro-batch",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=int,
+        default=0,
+        help="use a copy of the model with dynamic int8 quantization (CPU only)",
+    )
+
+    # PSI-KT parameters (see predict_learner_performance_psikt.py)
+    parser.add_argument("--graph_path", type=str, default="../kt/junyi15/adj.npy")
+    parser.add_argument("--learned_graph", type=str, default="w_gt")
+    parser.add_argument("--node_dim", type=int, default=16)
+    parser.add_argument("--num_sample", type=int, default=100)
+    parser.add_argument(
+        "--sampler", type=str, default="mc", choices=["mc", "antithetic", "qmc"]
+    )
+    parser.add_argument("--qs_pooling", type=int, default=0)
+    parser.add_argument("--var_log_max", type=int, default=10)
+    parser.add_argument("--num_category", type=int, default=10)
+    parser.add_argument("--graph_topk", type=int, default=0)
+    parser.add_argument("--graph_refresh", type=int, default=100)
+
+    return parser
+
+
+def parse_serving_args(parser: argparse.ArgumentParser = None) -> argparse.Namespace:
+    """
+    Parse the serving and model arguments, with the arguments of the baseline if a
+    baseline is served.
+    """
+    parser = parser or global_parse_args()
+    parser = arg_parser.parse_args(parser)
+    global_args, extras = parser.parse_known_args()
+
+    model_name = global_args.model_name
+    if model_name != "AmortizedPSIKT":
+        model_class = eval("{0}.{1}".format(model_name.lower(), model_name.upper()))
+        parser = model_class.parse_model_args(parser)
+        global_args, extras = parser.parse_known_args()
+    global_args.model_name = model_name
+    global_args.time = datetime.datetime.now().isoformat()
+    global_args.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    global_args.num_GPU = None
+    global_args.batch_size_multiGPU = global_args.batch_size
+    # read by Logger and DataReader, but not defined by arg_parser
+    global_args.overfit = getattr(global_args, "overfit", 0)
+    global_args.kfold = getattr(global_args, "kfold", 5)
+    return global_args
+
+
+def load_model(global_args: argparse.Namespace):
+    """
+    Load the corpus and the trained model of global_args.load_folder.
+
+    Returns:
+        The model in evaluation mode (quantized with --quantize), the corpus and the
+        logger.
+    """
+    model_name = global_args.model_name
+    torch.manual_seed(global_args.random_seed)
+    np.random.seed(global_args.random_seed)
+
+    logs = logger.Logger(global_args)
+
+    # The corpus provides the numbers of skills, problems and learners of the model
+    corpus_path = Path(
+        global_args.data_dir,
+        global_args.dataset,
+        "Corpus_{}.pkl".format(global_args.max_step),
+    )
+    data = data_loader.DataReader(global_args, logs)
+    if not corpus_path.exists() or global_args.regenerate_corpus:
+        data.create_corpus()
+    corpus = data.load_corpus(global_args)
+
+    if model_name == "AmortizedPSIKT":
+        adj = np.load(global_args.graph_path)
+        model = AmortizedPSIKT(
+            mode=global_args.train_mode,
+            num_node=1 if not global_args.multi_node else corpus.n_skills,
+            nx_graph=None if not global_args.multi_node else adj,
+            device=global_args.device,
+            args=global_args,
+            logs=logs,
+        )
+    else:
+        model_class = eval("{0}.{1}".format(model_name.lower(), model_name.upper()))
+        model = model_class(global_args, corpus, logs)
+    model.load_state_dict(
+        torch.load(global_args.load_folder, map_location=global_args.device),
+        strict=False,
+    )
+    model = model.to(global_args.device)
+    model.eval()
+    if global_args.quantize:
+        model = quantize_model(model)
+    return model, corpus, logs
+
+
+if __name__ == "__main__":
+    global_args = parse_serving_args()
+    model, corpus, logs = load_model(global_args)
+
+    batcher = MicroBatcher(
+        lambda requests: predict_requests(model, corpus, requests, global_args.device),
+        max_batch_size=global_args.max_batch_size,
+        max_wait_ms=global_args.max_wait_ms,
+    )
+    server = PredictionServer(
+        batcher,
+        train_step=int(global_args.max_step * global_args.train_time_ratio),
+        test_step=int(global_args.max_step * global_args.test_time_ratio),
+        num_skills=corpus.n_skills,
+        num_problems=corpus.n_problems,
+    )
+    logs.write_to_log_file(
+        "{} {}: serving".format(utils.get_time(), global_args.model_name)
+    )
+    asyncio.run(
+        server.serve_forever(
+            global_args.host, global_args.port, global_args.unix_socket
+        )
+    )
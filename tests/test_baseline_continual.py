@@ -0,0 +1,51 @@
+import pytest
+
+import sys
+
+sys.path.append("..")
+
+from types import SimpleNamespace
+
+import pandas as pd
+
+import torch
+
+from knowledge_tracing.baseline.EduKTM.dkt import DKT
+from knowledge_tracing.baseline.HawkesKT.dktforgetting import DKTFORGETTING
+
+
+@pytest.mark.parametrize("model_class", [DKT, DKTFORGETTING])
+def test_forward_cl_step(model_class, tmp_path):
+    args = SimpleNamespace(
+        emb_size=8, hidden_size=8, dropout=0.0, device="cpu", log_path=str(tmp_path)
+    )
+    corpus = SimpleNamespace(n_skills=5, n_problems=5)
+    data = pd.DataFrame(
+        {
+            "user_id": [0, 1, 2],
+            "skill_seq": [[1, 2, 3, 1, 4], [2, 2, 4, 3, 1], [4, 3, 2, 1, 1]],
+            "problem_seq": [[1, 2, 3, 1, 4], [2, 2, 4, 3, 1], [4, 3, 2, 1, 1]],
+            "correct_seq": [[1, 0, 1, 1, 0], [0, 0, 1, 0, 1], [1, 1, 1, 0, 0]],
+            "time_seq": [[0, 60, 300, 1000, 4000]] * 3,
+        }
+    )
+    torch.manual_seed(0)
+    model = model_class(args, corpus, logs=None)
+    feed_dict = model.get_feed_dict(corpus, data, 0, len(data), "whole")
+
+    # Carrying the LSTM state predicts the newest item as the prefix does
+    state = None
+    for idx in range(1, 5):
+        out_dict = model.forward_cl_step(feed_dict, idx=idx, state=state)
+        state = out_dict["state"]
+        prefix_dict = model.forward_cl(feed_dict, idx=idx)
+        assert torch.allclose(
+            out_dict["prediction"][feed_dict["inverse_indice"], 0],
+            prefix_dict["prediction"][:, -1],
+            atol=1e-6,
+        )
+        assert torch.equal(
+            out_dict["label"][feed_dict["inverse_indice"], 0],
+            prefix_dict["label"][:, -1],
+        )
+        assert model.loss(feed_dict, out_dict)["loss_total"].requires_grad
@@ -0,0 +1,55 @@
+import pytest
+
+import sys
+
+sys.path.append("..")
+
+from types import SimpleNamespace
+
+import pandas as pd
+
+from knowledge_tracing.data.data_loader import DataReader
+from knowledge_tracing.utils.logger import Logger
+
+
+def test_create_corpus_skill_counts(tmp_path):
+    args = SimpleNamespace(
+        data_dir=str(tmp_path),
+        dataset="toy",
+        kfold=5,
+        max_step=10,
+        num_learner=0,
+        train_mode="simple_split_time",
+        train_time_ratio=0.5,
+        test_time_ratio=0.5,
+        val_time_ratio=0.0,
+        overfit=0,
+        create_logs=0,
+    )
+    # the rows of a learner are not in time order
+    inter_df = pd.DataFrame(
+        {
+            "user_id": [0, 0, 0, 0, 0, 1, 1],
+            "skill_id": [0, 1, 0, 1, 0, 2, 2],
+            "correct": [1, 1, 0, 0, 1, 1, 1],
+            "timestamp": [0, 400, 200, 100, 300, 50, 60],
+        }
+    )
+    (tmp_path / "toy").mkdir()
+    inter_df.to_csv(tmp_path / "toy" / "interactions_10.csv", sep="\t", index=False)
+
+    logs = Logger(args)
+    logs.log_file = tmp_path / "log.txt"
+    data = DataReader(args, logs)
+    data.create_corpus()
+    assert (data.n_users, data.n_skills, data.n_problems) == (2, 3, 3)
+
+    learner = data.user_seq_df.iloc[0]
+    assert learner["skill_seq"] == [0, 1, 0, 0, 1]
+    assert learner["correct_seq"] == [1, 0, 0, 1, 1]
+    assert learner["time_seq"] == [0, 100, 200, 300, 400]
+    # counts of the earlier interactions with the same skill
+    assert learner["num_history"] == [0, 0, 1, 2, 1]
+    assert learner["num_success"] == [0, 0, 0, 1, 0]
+    assert learner["num_failure"] == [0, 0, 1, 1, 1]
+    assert data.user_seq_df.iloc[1]["num_history"] == [0, 1]
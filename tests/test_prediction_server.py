@@ -0,0 +1,150 @@
+import pytest
+
+import sys
+
+sys.path.append("..")
+
+import asyncio
+
+from knowledge_tracing.runner.prediction_server import (
+    MicroBatcher,
+    PredictionServer,
+    build_prediction_frame,
+    validate_request,
+    open_connection,
+    post_request,
+)
+
+TRAIN_STEP, TEST_STEP = 4, 3
+
+
+def make_request(num_history=6, num_next=2):
+    return {
+        "skill_seq": [i % 3 for i in range(num_history)],
+        "correct_seq": [1] * num_history,
+        "time_seq": [100 + 10 * i for i in range(num_history)],
+        "next_skill_seq": [1] * num_next,
+        "next_time_seq": [1000 + i for i in range(num_next)],
+    }
+
+
+def test_prediction_frame():
+    validate_request(make_request(), TRAIN_STEP, TEST_STEP)
+    for request in [make_request(num_history=3), make_request(num_next=4), {}]:
+        with pytest.raises(ValueError):
+            validate_request(request, TRAIN_STEP, TEST_STEP)
+
+    row = build_prediction_frame([make_request()], TRAIN_STEP, TEST_STEP).iloc[0]
+    assert row["skill_seq"] == [2, 0, 1, 2, 1, 1, 1]
+    assert row["correct_seq"] == [1, 1, 1, 1, 0, 0, 0]
+    assert row["time_seq"] == [0, 10, 20, 30, 880, 881, 881]
+    assert row["num_history"] == [0, 0, 0, 1, 1, 2, 3]
+    assert row["problem_seq"] == row["skill_seq"]
+
+
+def test_server_batches_requests():
+    def predict_fn(requests):
+        return [[float(len(requests))] * len(r["next_skill_seq"]) for r in requests]
+
+    async def main():
+        batcher = MicroBatcher(predict_fn, max_batch_size=8, max_wait_ms=50)
+        server = PredictionServer(batcher, TRAIN_STEP, TEST_STEP)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+
+        async def client(request):
+            reader, writer = await open_connection("127.0.0.1", port)
+            response = await post_request(reader, writer, request)
+            writer.close()
+            return response
+
+        responses = await asyncio.gather(*[client(make_request()) for _ in range(8)])
+        invalid = await client(make_request(num_history=1))
+        listener.close()
+        server.worker.cancel()
+        return responses, invalid, batcher
+
+    responses, invalid, batcher = asyncio.run(main())
+    assert all(status == 200 for status, _ in responses)
+    assert all(len(response["prediction"]) == 2 for _, response in responses)
+    assert batcher.num_requests == 8 and batcher.num_batches < 8
+    assert invalid[0] == 400
+
+
+def test_validate_request_values():
+    validate_request(make_request(), TRAIN_STEP, TEST_STEP, num_skills=3)
+    invalid = [
+        dict(make_request(), skill_seq=[0, 1, 2, 3, 0, 1]),  # unknown skill
+        dict(make_request(), next_skill_seq=[1, 1.5]),
+        dict(make_request(), problem_seq=[0, 1, 2, 0, 1, -1]),
+        dict(make_request(), correct_seq=[1, 0, 2, 1, 0, 1]),
+        dict(make_request(), time_seq=[0, 1, 2, 3, 4, "5"]),
+        dict(make_request(), next_time_seq="10"),
+        dict(make_request(), learner="a"),
+        5,
+    ]
+    for request in invalid:
+        with pytest.raises(ValueError):
+            validate_request(request, TRAIN_STEP, TEST_STEP, num_skills=3)
+
+
+def test_server_isolates_failing_requests():
+    def predict_fn(requests):
+        if any(r["next_time_seq"][0] < 0 for r in requests):
+            raise RuntimeError("bad request")
+        return [[0.5] * len(r["next_skill_seq"]) for r in requests]
+
+    async def main():
+        batcher = MicroBatcher(predict_fn, max_batch_size=8, max_wait_ms=50)
+        server = PredictionServer(batcher, TRAIN_STEP, TEST_STEP, num_skills=3)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+
+        async def client(request):
+            reader, writer = await open_connection("127.0.0.1", port)
+            response = await post_request(reader, writer, request)
+            writer.close()
+            return response
+
+        failing = dict(make_request(), next_time_seq=[-1, 1000])
+        requests = [make_request() for _ in range(7)] + [failing]
+        responses = await asyncio.gather(*[client(request) for request in requests])
+        not_object = await client(5)
+        listener.close()
+        server.worker.cancel()
+        return responses, not_object
+
+    responses, not_object = asyncio.run(main())
+    assert [status for status, _ in responses] == [200] * 7 + [500]
+    assert not_object[0] == 400
+
+
+def test_server_rejects_malformed_http():
+    async def main():
+        batcher = MicroBatcher(lambda requests: [], max_batch_size=8, max_wait_ms=50)
+        server = PredictionServer(batcher, TRAIN_STEP, TEST_STEP)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+
+        responses = []
+        for head in [
+            b"GARBAGE\r\n\r\n",
+            b"POST /predict HTTP/1.1\r\nno colon\r\n\r\n",
+            b"POST /predict HTTP/1.1\r\nContent-Length: ten\r\n\r\n",
+        ]:
+            reader, writer = await open_connection("127.0.0.1", port)
+            writer.write(head)
+            await writer.drain()
+            responses.append(await reader.read())
+            writer.close()
+        after = await post_request(*await open_connection("127.0.0.1", port), {})
+        listener.close()
+        server.worker.cancel()
+        return responses, after
+
+    responses, after = asyncio.run(main())
+    for response in responses:
+        assert response.startswith(b"HTTP/1.1 400")
+        assert b"Malformed request" in response
+    # the server keeps answering the other connections
+    assert after[0] == 400
@@ -7,17 +7,34 @@ import sys
 sys.path.append("..")
 
 import math
+import json
+from types import SimpleNamespace
+
 import numpy as np
+import pandas as pd
 
 import torch
 
 from knowledge_tracing.psikt import EPS
 from knowledge_tracing.psikt.psikt_graph_representation import VarTransformation
 from knowledge_tracing.psikt.psikt import AmortizedPSIKT
+from knowledge_tracing.psikt.state_store import LearnerStateStore
 from knowledge_tracing.psikt.GMVAE.gmvae import InferenceNet
-from knowledge_tracing.psikt.modules import VAEEncoder
+from knowledge_tracing.psikt.modules import (
+    VAEEncoder,
+    DiagonalNormal,
+    standard_normal_noise,
+    expected_log_prob,
+    matrix_powers,
+    affine_scan,
+)
 from knowledge_tracing.runner.runner import KTRunner
+from knowledge_tracing.runner.runner_psikt import PSIKTRunner
+from knowledge_tracing.runner.export import export_model, ExportedModel
+from knowledge_tracing.runner.prediction_server import predict_requests
+from knowledge_tracing.runner.quantization import quantize_model
 from knowledge_tracing.utils.logger import Logger
+from knowledge_tracing.utils.profiler import PhaseTimer
 
 DIM_S = 4
 
@@ -34,6 +51,10 @@ def psikt():
             self.num_category = 5
             self.time_dependent_s = 1
             self.num_sample = 1
+            self.sampler = "mc"
+            self.qs_pooling = 0
+            self.graph_topk = 0
+            self.graph_refresh = 100
             
             self.max_step = 50
             self.train_time_ratio = 0.04
@@ -119,6 +140,408 @@ def test_construct_univariate_normal(psikt):
     assert torch.allclose(dist.covariance_matrix, std.pow(2), atol=EPS)
     
 
+def test_diagonal_normal():
+    loc = torch.randn(2, 3, 10)
+    scale = torch.rand(2, 3, 10) + 0.1
+    dist = DiagonalNormal(loc, scale)
+    mvn = torch.distributions.MultivariateNormal(loc, scale_tril=torch.diag_embed(scale))
+
+    assert dist.batch_shape == mvn.batch_shape
+    assert dist.event_shape == mvn.event_shape
+    assert torch.allclose(dist.covariance_matrix, mvn.covariance_matrix)
+
+    # The same random state gives the same samples
+    torch.manual_seed(0)
+    sample = dist.rsample((4,))
+    torch.manual_seed(0)
+    assert torch.allclose(sample, mvn.rsample((4,)))
+
+    assert torch.allclose(dist.log_prob(sample), mvn.log_prob(sample))
+    assert torch.allclose(dist.entropy(), mvn.entropy())
+
+
+def test_variance_reduced_sampling():
+    loc = torch.randn(3, 10)
+    scale = torch.rand(3, 10) + 0.1
+    dist = DiagonalNormal(loc, scale)
+
+    # Antithetic pairs are symmetric around the mean
+    sample = dist.rsample((6,), sampler="antithetic")
+    assert sample.shape == (6, 3, 10)
+    assert torch.allclose(sample[:3] + sample[3:], 2 * loc.expand(3, -1, -1))
+    assert dist.sample((5,), sampler="antithetic").shape == (5, 3, 10)
+
+    # Randomized Sobol points are standard normal along every dimension
+    noise = standard_normal_noise(torch.Size([1024, 4, 10]), "qmc")
+    assert noise.shape == (1024, 4, 10)
+    assert torch.isfinite(noise).all()
+    assert noise.mean(0).abs().max() < 0.1
+    assert (noise.std(0) - 1).abs().max() < 0.1
+    assert dist.rsample((8,), sampler="qmc").requires_grad == loc.requires_grad
+
+    with pytest.raises(ValueError):
+        standard_normal_noise(torch.Size([4, 3]), "sobol")
+
+
+def test_expected_log_prob():
+    q_dist = DiagonalNormal(torch.randn(2, 3, DIM_S), torch.rand(2, 3, DIM_S) + 0.1)
+    p_dist = DiagonalNormal(torch.randn(2, 3, DIM_S), torch.rand(2, 3, DIM_S) + 0.1)
+
+    # E_q[log p] = -KL(q || p) - H(q)
+    kl = torch.distributions.kl_divergence(
+        torch.distributions.Independent(
+            torch.distributions.Normal(q_dist.mean, q_dist.stddev), 1
+        ),
+        torch.distributions.Independent(
+            torch.distributions.Normal(p_dist.mean, p_dist.stddev), 1
+        ),
+    )
+    expected = -kl - q_dist.entropy()
+    assert torch.allclose(expected_log_prob(q_dist, p_dist), expected, atol=1e-5)
+
+    # The same value through the dense path of MultivariateNormal
+    p_mvn = torch.distributions.MultivariateNormal(
+        p_dist.mean, scale_tril=p_dist.scale_tril
+    )
+    assert torch.allclose(expected_log_prob(q_dist, p_mvn), expected, atol=1e-5)
+
+
+def test_matrix_powers_and_affine_scan():
+    h = torch.randn(4, 4) / 2
+    powers = matrix_powers(h, 5)
+    assert powers.shape == (6, 4, 4)
+    assert torch.allclose(powers[0], torch.eye(4))
+    assert torch.allclose(powers[5], torch.linalg.matrix_power(h, 5), atol=1e-5)
+
+    a, b, x0 = torch.rand(2, 7, 3), torch.randn(2, 7, 3), torch.randn(2, 1, 3)
+    x, xs = x0, []
+    for t in range(7):
+        x = a[:, t : t + 1] * x + b[:, t : t + 1]
+        xs.append(x)
+    assert torch.allclose(affine_scan(a, b, x0=x0, dim=1), torch.cat(xs, 1), atol=1e-5)
+
+
+def test_predictive_rollout(psikt):
+    bs, time_step = 3, 20
+    s_last_mean = torch.randn(bs, 1, DIM_S)
+    s_last_cov_mat = torch.diag_embed(torch.rand(bs, 1, DIM_S))
+    z_last_mean = torch.randn(bs, 1, psikt.num_node)
+    dt = torch.rand(bs, time_step, 1)
+
+    with torch.no_grad():
+        adj = psikt.node_dist.expected_A(psikt.num_sample)
+        sequential = psikt.predictive_rollout(
+            s_last_mean, s_last_cov_mat, z_last_mean, dt, parallel=False
+        )
+        scan = psikt.predictive_rollout(
+            s_last_mean, s_last_cov_mat, z_last_mean, dt, parallel=True
+        )
+    assert psikt._graph_eigen[0] is adj
+    for seq_value, scan_value in zip(sequential, scan):
+        assert torch.allclose(seq_value, scan_value, atol=1e-4)
+
+    # the closed form of the s-chain matches its recursion
+    h, r = psikt.gen_st_h, torch.diag_embed(torch.exp(psikt.gen_st_log_r) + EPS)
+    s_mean, s_cov_mat = s_last_mean, s_last_cov_mat
+    for t in range(time_step):
+        s_mean, s_cov_mat = s_mean @ h, h @ s_cov_mat @ h.transpose(-1, -2) + r
+    assert torch.allclose(sequential[0][:, -1:], s_mean, atol=1e-4)
+    assert torch.allclose(sequential[1][:, -1:], s_cov_mat, atol=1e-4)
+
+
+def test_online_filtering(psikt):
+    bs = 3
+    train_step = int(psikt.args.max_step * psikt.args.train_time_ratio)
+    time_seq = torch.cumsum(torch.rand(bs, train_step + 4) * 1e5, dim=1)
+    label_seq = torch.randint(0, 2, (bs, train_step + 4)).float()
+    skill_seq = torch.randint(0, psikt.num_node, (bs, train_step + 4))
+
+    state = psikt.init_state(torch.arange(bs))
+    for i in range(train_step):
+        torch.manual_seed(0)
+        state = psikt.observe(state, skill_seq[:, i], label_seq[:, i], time_seq[:, i])
+    assert (state["num_obs"] == train_step).all()
+
+    # once the window of the s-network is full, the filtered posterior matches the
+    # posterior inferred from the whole history
+    torch.manual_seed(0)
+    with torch.no_grad():
+        emb_history = psikt.embedding_process(
+            time_seq[:, :train_step],
+            label_seq[:, :train_step],
+            skill_seq[:, :train_step],
+        )
+        qs_dist, qz_dist = psikt.inference_process(emb_history, eval=True)
+    assert torch.allclose(state["s_mean"], qs_dist.mean[:, 0, -1:], atol=1e-6)
+    assert torch.allclose(state["s_var"], qs_dist.variance[:, 0, -1:], atol=1e-6)
+    assert torch.allclose(state["z_mean"], qz_dist.mean[:, -1:], atol=1e-6)
+
+    horizon = time_seq[:, train_step:]
+    output = psikt.predict(state, horizon, skill_seq[:, train_step:])
+    assert output["prediction"].shape == (bs, psikt.num_sample, 4)
+    output = psikt.predict(state, horizon)
+    assert output["prediction"].shape == (bs, psikt.num_sample, 4, psikt.num_node)
+
+    # the state is persisted per learner; unknown learners start from the prior
+    store = LearnerStateStore(psikt.state_fields(), capacity=8)
+    psikt.save_state(store, state)
+    loaded = psikt.load_state(store, torch.tensor([2, 0, 7]))
+    initial = psikt.init_state(torch.tensor([7]))
+    for name in psikt.state_fields():
+        assert torch.equal(loaded[name][:2], state[name][[2, 0]])
+        assert torch.equal(loaded[name][2:], initial[name])
+
+
+def test_pooled_posterior_s(psikt):
+    args = psikt.args
+    args.qs_pooling = 1
+    model = AmortizedPSIKT(
+        num_node=psikt.num_node,
+        args=args,
+        device=psikt.device,
+        logs=psikt.logs,
+        nx_graph=psikt.adj,
+    )
+    num_param = sum(p.numel() for p in model.infer_network_posterior_s.parameters())
+    args.max_step = 10 * args.max_step
+    longer = AmortizedPSIKT(
+        num_node=psikt.num_node,
+        args=args,
+        device=psikt.device,
+        logs=psikt.logs,
+        nx_graph=psikt.adj,
+    )
+    assert num_param == sum(
+        p.numel() for p in longer.infer_network_posterior_s.parameters()
+    )
+    assert "emb_window" not in model.state_fields()
+
+    # histories of any length are filtered exactly, from the first interaction on
+    bs, num_step = 3, 7
+    time_seq = torch.cumsum(torch.rand(bs, num_step) * 1e5, dim=1)
+    label_seq = torch.randint(0, 2, (bs, num_step)).float()
+    skill_seq = torch.randint(0, model.num_node, (bs, num_step))
+    state = model.init_state(torch.arange(bs))
+    for i in range(num_step):
+        torch.manual_seed(0)
+        state = model.observe(state, skill_seq[:, i], label_seq[:, i], time_seq[:, i])
+        torch.manual_seed(0)
+        with torch.no_grad():
+            emb_history = model.embedding_process(
+                time_seq[:, : i + 1], label_seq[:, : i + 1], skill_seq[:, : i + 1]
+            )
+            qs_dist, _ = model.inference_process(emb_history, eval=True)
+        assert torch.allclose(state["s_mean"], qs_dist.mean[:, 0, -1:], atol=1e-5)
+        assert torch.allclose(state["s_var"], qs_dist.variance[:, 0, -1:], atol=1e-5)
+
+
+def test_chunked_processes(psikt):
+    args = psikt.args
+    args.qs_pooling = 1
+    model = AmortizedPSIKT(
+        num_node=psikt.num_node,
+        args=args,
+        device=psikt.device,
+        logs=psikt.logs,
+        nx_graph=psikt.adj,
+    )
+    bs, num_step = 3, 8
+    feed_dict = {
+        "time_seq": torch.cumsum(torch.rand(bs, num_step) * 1e5, dim=1),
+        "label_seq": torch.randint(0, 2, (bs, num_step)).float(),
+        "skill_seq": torch.randint(0, model.num_node, (bs, num_step)),
+        "user_id": torch.arange(bs),
+    }
+    chunks = model.split_chunks(feed_dict, 3)
+    assert [chunk["time_seq"].shape[1] for chunk in chunks] == [3, 3, 2]
+    assert all(torch.equal(chunk["user_id"], feed_dict["user_id"]) for chunk in chunks)
+    assert len(model.split_chunks(feed_dict, 7)) == 1  # no chunk of a single step
+
+    with torch.no_grad():
+        emb_history = model.embedding_process(
+            feed_dict["time_seq"], feed_dict["label_seq"], feed_dict["skill_seq"]
+        )
+        torch.manual_seed(0)
+        qs_dist, qz_dist = model.inference_process(emb_history, feed_dict, eval=True)
+        ps_dist, pz_dist = model.generative_process(qs_dist, qz_dist, feed_dict)
+
+        # the LSTM of z continues across chunks, and s of the last chunk is inferred
+        # from all the steps
+        carry, start = {}, 0
+        for chunk in chunks:
+            end = start + chunk["time_seq"].shape[1]
+            torch.manual_seed(0)
+            chunk_qs, chunk_qz = model.inference_process(
+                emb_history[:, start:end], chunk, eval=True, carry=carry
+            )
+            assert torch.allclose(chunk_qz.loc, qz_dist.loc[:, start:end], atol=1e-5)
+            assert torch.allclose(
+                chunk_qz.scale, qz_dist.scale[:, start:end], atol=1e-5
+            )
+            start = end
+        assert torch.allclose(chunk_qs.loc, qs_dist.loc[:, :, -2:], atol=1e-5)
+
+        # the first step of a later chunk is a transition from the previous chunk
+        carry = dict(
+            s_mean=qs_dist.loc[:, :, 2:3],
+            s_scale=qs_dist.scale[:, :, 2:3],
+            z_mean=qz_dist.loc[:, 2:3],
+            z_scale=qz_dist.scale[:, 2:3],
+            time=feed_dict["time_seq"][:, 2:3],
+        )
+        chunk_ps, chunk_pz = model.generative_process(
+            DiagonalNormal(qs_dist.loc[:, :, 3:6], qs_dist.scale[:, :, 3:6]),
+            DiagonalNormal(qz_dist.loc[:, 3:6], qz_dist.scale[:, 3:6]),
+            chunks[1],
+            carry=carry,
+        )
+        assert torch.allclose(chunk_ps.loc, ps_dist.loc[:, :, 3:6], atol=1e-5)
+        assert torch.allclose(
+            chunk_ps.scale_tril, ps_dist.scale_tril[:, :, 3:6], atol=1e-5
+        )
+        assert torch.allclose(chunk_pz.loc, pz_dist.loc[:, 3:6], atol=1e-5)
+        assert torch.allclose(chunk_pz.scale, pz_dist.scale[:, 3:6], atol=1e-5)
+
+
+@pytest.fixture
+def chunked_psikt(psikt):
+    args = psikt.args
+    args.qs_pooling = 1
+    args.objective = "mc"
+    args.s_entropy_weight = args.z_entropy_weight = 0.1
+    args.s_log_weight = args.z_log_weight = args.y_log_weight = 1
+    args.cat_weight = 10
+    args.num_learner = 3
+    args.chunk_size = 3
+    args.chunk_truncate = 1
+    model = AmortizedPSIKT(
+        num_node=psikt.num_node,
+        args=args,
+        device=psikt.device,
+        logs=psikt.logs,
+        nx_graph=psikt.adj,
+    )
+    bs, num_step = 3, 8
+    feed_dict = {
+        "time_seq": torch.cumsum(torch.rand(bs, num_step) * 1e5, dim=1),
+        "label_seq": torch.randint(0, 2, (bs, num_step)).float(),
+        "skill_seq": torch.randint(0, model.num_node, (bs, num_step)),
+        "user_id": torch.arange(bs),
+    }
+    return model, feed_dict
+
+
+def test_chunked_forward(chunked_psikt):
+    model, feed_dict = chunked_psikt
+    carry = {}
+    for i, chunk in enumerate(model.split_chunks(feed_dict, 3)):
+        output = model(chunk, carry=carry)
+        losses = model.loss(chunk, output)
+        assert torch.isfinite(losses["loss_total"])
+        # only the first chunk starts the sequences
+        assert (output["initial_likelihood"] == 0) == (i > 0)
+        assert carry["num_obs"] == chunk["time_seq"].shape[1] + 3 * i
+        assert torch.equal(carry["time"], chunk["time_seq"][:, -1:])
+    losses["loss_total"].backward()
+    assert model.infer_network_posterior_z.weight_ih_l0.grad is not None
+
+
+class ScatteredKwargs(torch.nn.Module):
+    """
+    Copies the dictionaries of the keyword arguments, as DataParallel does when it
+    scatters them over GPUs.
+    """
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        kwargs = {k: dict(v) if isinstance(v, dict) else v for k, v in kwargs.items()}
+        return self.module(*args, **kwargs)
+
+
+def test_chunked_train_step(chunked_psikt):
+    model, feed_dict = chunked_psikt
+    runner = PSIKTRunner(model.args, model.logs)
+    runner.metrics = None
+
+    losses, grads = {}, {}
+    for truncate in [0, 1]:
+        model.args.chunk_truncate = truncate
+        model.zero_grad(set_to_none=True)
+        torch.manual_seed(0)
+        losses[truncate] = runner._train_step(ScatteredKwargs(model), feed_dict)
+        grads[truncate] = model.infer_network_posterior_z.weight_ih_l0.grad.clone()
+
+    # the carry reaches every chunk, as in the direct forward passes
+    carry, loss_total = {}, 0
+    torch.manual_seed(0)
+    for chunk in model.split_chunks(feed_dict, 3):
+        output = model(chunk, carry=carry)
+        weight = chunk["time_seq"].shape[1] / feed_dict["time_seq"].shape[1]
+        loss_total += float(model.loss(chunk, output)["loss_total"]) * weight
+    for truncate in [0, 1]:
+        assert math.isclose(losses[truncate]["loss_total"], loss_total, rel_tol=1e-5)
+
+    # truncation stops the gradients of the later chunks at their boundaries
+    assert not torch.allclose(grads[0], grads[1])
+
+
+def test_export(psikt, tmp_path):
+    num_step = 4
+    whole = pd.DataFrame(
+        {
+            "user_id": [0, 1, 2],
+            "skill_seq": [[1, 2, 3, 4], [5, 6, 7, 8], [9, 0, 1, 2]],
+            "correct_seq": [[1, 0, 1, 1], [0, 0, 1, 0], [1, 1, 1, 0]],
+            "time_seq": [[i * 3600 * 24 for i in range(num_step)]] * 3,
+            "problem_seq": [[1, 2, 3, 4], [5, 6, 7, 8], [9, 0, 1, 2]],
+        }
+    )
+    corpus = SimpleNamespace(data_df={"whole": whole})
+    path = tmp_path / "psikt.jit.pt"
+    psikt.eval()
+    meta = export_model(psikt, corpus, path)
+    assert meta["train_step"] == 2 and meta["test_step"] == 2
+
+    # the exported model predicts as the model, for any batch size
+    exported = ExportedModel(path)
+    requests = [
+        {
+            "skill_seq": row["skill_seq"][:2],
+            "correct_seq": row["correct_seq"][:2],
+            "time_seq": row["time_seq"][:2],
+            "next_skill_seq": row["skill_seq"][2:],
+            "next_time_seq": row["time_seq"][2:],
+        }
+        for _, row in whole.iterrows()
+    ]
+    torch.manual_seed(0)
+    expected = predict_requests(psikt, corpus, requests)
+    torch.manual_seed(0)
+    assert np.allclose(exported.predict_requests(requests), expected, atol=1e-4)
+
+
+def test_quantize_model(psikt):
+    feed_dict = {
+        "time_seq": torch.arange(4).repeat(3, 1) * 3600 * 24,
+        "label_seq": torch.tensor([[1, 0, 1, 1], [0, 0, 1, 0], [1, 1, 1, 0]]),
+        "skill_seq": torch.tensor([[1, 2, 3, 4], [5, 6, 7, 8], [9, 0, 1, 2]]),
+    }
+    psikt.eval()
+    quantized = quantize_model(psikt)
+    assert isinstance(psikt.infer_network_posterior_z, torch.nn.LSTM)
+    assert not isinstance(quantized.infer_network_posterior_z, torch.nn.LSTM)
+
+    with torch.no_grad():
+        torch.manual_seed(0)
+        expected = psikt.predictive_model(feed_dict)["prediction"]
+        torch.manual_seed(0)
+        prediction = quantized.predictive_model(feed_dict)["prediction"]
+    assert torch.allclose(prediction, expected, atol=0.05)
+
+
 def test_initialize_gaussian_mean_log_var(psikt):
     dim = 3
     use_trainable_cov = True
@@ -162,6 +585,28 @@ def test_positional_encoding1d(psikt):
     assert torch.allclose(pe, expected_pe, atol=1)
     
 
+def test_get_time_embedding(psikt):
+    time = torch.tensor([[0.0, 60.0, 300.0, 1000.0], [5.0, 6.0, 7.0, 8.0]])
+    assert torch.equal(
+        psikt.get_time_embedding(time, "absolute"),
+        psikt._positional_encoding1d(psikt.node_dim, 4, time),
+    )
+
+    # The relative table is cached for max_step positions and extended on demand
+    positions = torch.arange(4.0).expand(2, -1)
+    assert torch.allclose(
+        psikt.get_time_embedding(positions, "relative"),
+        psikt.get_time_embedding(positions, "absolute"),
+    )
+    long_time = torch.zeros(1, psikt.args.max_step + 10)
+    assert psikt.get_time_embedding(long_time, "relative").shape == (
+        1,
+        psikt.args.max_step + 10,
+        psikt.node_dim,
+    )
+    assert "time_frequencies" not in psikt.state_dict()
+
+
 def test_st_transition_gen(psikt, qs_dist):
     # Make sure the shape of qs_dist is correct
     bs, _, time, _ = qs_dist.mean.shape
@@ -215,4 +660,23 @@ def test_zt_transition_gen(psikt):
     pz_dist = psikt.zt_transition_gen(feed_dict)
 
     # Add assertions to check if the output is as expected
-    assert isinstance(pz_dist, torch.distributions.MultivariateNormal)
\ No newline at end of file
+    assert isinstance(pz_dist, DiagonalNormal)
+
+def test_em_phase_timings(chunked_psikt, tmp_path, monkeypatch):
+    model, feed_dict = chunked_psikt
+    args = model.args
+    args.chunk_size, args.em_train = 0, 1
+    args.optimizer, args.lr, args.l2, args.lr_decay, args.gamma = "adam", 1e-3, 0, 50, 0.5
+    model.optimizer = None
+    model.logs.log_file = tmp_path / "log.txt"
+    model.logs.timer = PhaseTimer(tmp_path / "timing.jsonl")
+    runner = PSIKTRunner(args, model.logs)
+    runner.metrics = None
+    runner.whole_batches = [feed_dict]
+    monkeypatch.setattr(runner, "test", lambda *args, **kwargs: None)
+
+    runner.fit_em_phases(ScatteredKwargs(model), None, epoch=0)
+
+    with open(tmp_path / "timing.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["phase"] for record in records] == ["infer"] * 5 + ["gen_graph"] * 5
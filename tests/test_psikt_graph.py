@@ -6,10 +6,12 @@ import sys
 
 sys.path.append("..")
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 
-from knowledge_tracing.groupkt import EPS
-from knowledge_tracing.groupkt import groupkt_graph_representation as ktgraph
+from knowledge_tracing.psikt import EPS
+from knowledge_tracing.psikt import psikt_graph_representation as ktgraph
 
 
 @pytest.fixture
@@ -126,3 +128,82 @@ def test_dense_init(var_transformation_instance, var_transformation_dense_instan
             edge1 = log_probs[0, i, j] >= torch.log(0.5 + torch.tensor(EPS))
             edge2 = log_probs[0, j, i] >= torch.log(0.5 + torch.tensor(EPS))
             assert not (edge1 and edge2)
+
+
+def test_expected_A(var_transformation_instance):
+    num_graph = 50
+    _, probs, adj = var_transformation_instance.sample_A(num_graph)
+    # every graph gets its own gumbel noise
+    assert not torch.all(probs == probs[:1])
+
+    # resampled while the graph parameters can receive gradients
+    adj_1 = var_transformation_instance.expected_A(num_graph)
+    assert adj_1.shape == (10, 10)
+    assert adj_1.requires_grad
+    assert var_transformation_instance._expected_A is None
+
+    # cached without gradients, until the parameters are updated
+    with torch.no_grad():
+        adj_2 = var_transformation_instance.expected_A(num_graph)
+        assert var_transformation_instance.expected_A(num_graph) is adj_2
+        assert var_transformation_instance.expected_A(num_graph + 1) is not adj_2
+        adj_3 = var_transformation_instance.expected_A(num_graph)
+        var_transformation_instance.u.add_(1.0)
+        assert var_transformation_instance.expected_A(num_graph) is not adj_3
+
+
+def test_var_gt(tmp_path, monkeypatch):
+    adj = (np.random.rand(10, 10) > 0.5).astype(np.float32)
+    np.fill_diagonal(adj, 0)
+    np.save(tmp_path / "adj.npy", adj)
+
+    var_gt = ktgraph.VarGT("cpu", 10, tmp_path / "adj.npy")
+    # the graph is loaded once, not on every call
+    monkeypatch.setattr(ktgraph.np, "load", None)
+    _, _, adj_sampled = var_gt.sample_A(2)
+
+    assert adj_sampled.shape == (1, 10, 10)
+    assert np.array_equal(adj_sampled[0].numpy(), adj)
+    assert var_gt.expected_A() is var_gt.adj
+    z = torch.randn(4, 10)
+    assert torch.allclose(var_gt.empowerment()(z), z @ torch.from_numpy(adj))
+    assert "adj" not in var_gt.state_dict()
+
+
+def test_topk_empowerment():
+    num_nodes = 10
+    dense = ktgraph.VarTransformation("cpu", num_nodes, 0.1, latent_dim=16)
+    sparse = ktgraph.VarTransformation(
+        "cpu", num_nodes, 0.1, latent_dim=16, topk=num_nodes, chunk_size=3
+    )
+    sparse.load_state_dict(dense.state_dict())
+    z = torch.randn(4, 5, num_nodes)
+
+    # with all sources kept, the operator is the exact expectation of the sampled graphs
+    logits = dense.edge_log_probs()
+    adj = F.softmax(logits, dim=0)[1] * (1 - torch.eye(num_nodes))
+    assert sparse.topk == num_nodes - 1
+    assert torch.allclose(sparse.empowerment()(z), z @ adj, atol=1e-5)
+    assert torch.allclose(dense.empowerment(num_graph=5000)(z), z @ adj, atol=0.2)
+
+    # the sources are selected again every refresh_every optimizer steps
+    sparse.topk, sparse.refresh_every, sparse.topk_src = 3, 2, None
+    sparse.empowerment()(z).sum().backward()
+    assert sparse.u.grad is not None
+    topk_src = sparse.topk_src
+    assert topk_src.shape == (num_nodes, 3)
+    assert not torch.any(topk_src == torch.arange(num_nodes)[:, None])
+    no_loops = adj.masked_fill(torch.eye(num_nodes, dtype=torch.bool), -float("inf"))
+    expected = no_loops.topk(3, dim=0).indices.t()  # the strongest sources of every node
+    assert torch.equal(topk_src.sort(1).values, expected.sort(1).values)
+    sparse.empowerment()
+    sparse.step()
+    sparse.empowerment()
+    assert sparse.topk_src is topk_src
+    sparse.step()
+    sparse.empowerment()
+    sparse.empowerment()
+    assert sparse.topk_src is not topk_src
+    topk_src = sparse.topk_src
+    sparse.empowerment()
+    assert sparse.topk_src is topk_src
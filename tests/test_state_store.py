@@ -0,0 +1,123 @@
+import pytest
+
+import sys
+
+sys.path.append("..")
+
+import torch
+
+from knowledge_tracing.psikt.state_store import LearnerStateStore, WindowedStateBuffers
+
+FIELDS = {
+    "time": ((1,), torch.float64),
+    "num_obs": ((), torch.long),
+    "z_mean": ((1, 3), torch.float32),
+}
+
+
+def make_records(learner):
+    bs = learner.shape[0]
+    return {
+        "time": learner.double().reshape(bs, 1) * 1e12 + 1,
+        "num_obs": learner * 10,
+        "z_mean": learner.float().reshape(bs, 1, 1).repeat(1, 1, 3),
+    }
+
+
+def assert_records(records, learner):
+    for name, value in make_records(learner).items():
+        assert torch.equal(records[name], value)
+
+
+@pytest.mark.parametrize("eviction", ["lru", "fifo"])
+def test_memory_tier_eviction(eviction):
+    store = LearnerStateStore(FIELDS, capacity=4, eviction=eviction)
+    store.put(torch.arange(4), make_records(torch.arange(4)))
+
+    records, found = store.get(torch.tensor([0, 2, 9]))
+    assert found.tolist() == [True, True, False]
+    assert_records({k: v[:2] for k, v in records.items()}, torch.tensor([0, 2]))
+    assert all((v[2] == 0).all() for v in records.values())
+
+    # without a disk tier, evicted records are dropped
+    store.put(torch.tensor([4, 5]), make_records(torch.tensor([4, 5])))
+    kept = [i for i in range(6) if i in store]
+    assert kept == ([0, 2, 4, 5] if eviction == "lru" else [2, 3, 4, 5])
+
+    with pytest.raises(ValueError):
+        store.put(torch.arange(10, 15), make_records(torch.arange(10, 15)))
+
+
+def test_disk_tier(tmp_path):
+    path = tmp_path / "states.bin"
+    store = LearnerStateStore(FIELDS, capacity=8, path=path)
+    for start in range(0, 3000, 8):
+        learner = torch.arange(start, start + 8)
+        store.put(learner, make_records(learner))
+    assert len(store) == 3000
+
+    # records spilled to disk are read back, and duplicates keep the last record
+    learner = torch.tensor([5, 1234, 2999, 5])
+    records, found = store.get(learner)
+    assert found.all()
+    assert_records(records, learner)
+    store.put(torch.tensor([7, 7]), make_records(torch.tensor([1, 2])))
+    assert_records(store.get(torch.tensor([7]))[0], torch.tensor([2]))
+
+    store.flush()
+    reopened = LearnerStateStore(FIELDS, capacity=8, path=path)
+    learner = torch.tensor([0, 1234, 2999])
+    records, found = reopened.get(learner)
+    assert found.all()
+    assert_records(records, learner)
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_windowed_buffers(tmp_path, on_disk):
+    fields = {"means": (3, torch.float32), "vars": (3, torch.bfloat16)}
+    path = tmp_path / "buffers" if on_disk else None
+    buffers = WindowedStateBuffers(fields, num_seq=5, window=2, path=path)
+    user = torch.tensor([4, 1])
+    for idx in range(3):
+        value = torch.full((2, 1, 3), 1.0 + idx / 3)
+        buffers.write("means", user, idx, value)
+        # broadcast values, e.g. variances shared by the skills, are expanded
+        buffers.write("vars", user, idx, value[:, :, :1])
+
+    # the last two steps are kept, the variances in bfloat16
+    for idx in [1, 2]:
+        expected = torch.full((2, 1, 3), 1.0 + idx / 3)
+        assert torch.equal(buffers.read("means", user, idx), expected)
+        variances = buffers.read("vars", user, idx)
+        assert variances.dtype == torch.float32
+        assert torch.allclose(variances, expected, rtol=1e-2)
+    assert torch.equal(buffers.read("means", user, 0), buffers.read("means", user, 2))
+    assert buffers.nbytes == 5 * 2 * 3 * (4 + 2)
+
+    if on_disk:
+        buffers.flush()
+        reopened = WindowedStateBuffers(fields, num_seq=5, window=2, path=path)
+        assert torch.equal(
+            reopened.read("means", user, 1), buffers.read("means", user, 1)
+        )
+
+
+def test_windowed_buffers_spill(tmp_path):
+    fields = {"means": (3, torch.float32), "vars": (3, torch.bfloat16)}
+    buffers = WindowedStateBuffers(
+        fields, num_seq=100, window=2, path=tmp_path / "buffers", capacity=4
+    )
+    assert buffers.nbytes == 4 * 2 * 3 * (4 + 2)
+    for start in range(0, 100, 4):
+        user = torch.arange(start, start + 4)
+        value = user.float().reshape(4, 1, 1).repeat(1, 1, 3)
+        buffers.write("means", user, 1, value)
+        buffers.write("vars", user, 1, value + 0.5)
+
+    # the moments of the learners evicted from memory are read back from disk, the
+    # fields that were not written are zero
+    user = torch.tensor([0, 57, 99])
+    expected = user.float().reshape(3, 1, 1).repeat(1, 1, 3)
+    assert torch.equal(buffers.read("means", user, 1), expected)
+    assert torch.equal(buffers.read("vars", user, 1), expected + 0.5)
+    assert torch.equal(buffers.read("means", user, 0), torch.zeros(3, 1, 3))